@@ -1,9 +1,11 @@
 import os
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
-from collections import defaultdict
 from scripts.network.mmseqs_network import mmseqs_search
 from scripts.cluster.mmseqs_cluster import mmseqs_makedb
+from scripts.amg.interval_index import INDEX_FILES, sort_hits, build_interval_index, load_interval_index, proximity_counts, neighborhood, colocated_counts
+from scripts.manifest import stage_current, record_stage
 from scripts.utils import pd_read_csv, read_fasta
 
 def filter_hits(df, bitscore_threshold):
@@ -11,54 +13,97 @@ def filter_hits(df, bitscore_threshold):
 
 
 def calculate_proximity_counts(viral_host_search_res, protein_distance):
-    alone_counts = defaultdict(int)
-    total_counts = defaultdict(int)
-    
-    for query, group in viral_host_search_res.groupby('query'):
-        group = group.sort_values('tstart')
-        prev_end = None
-        for _, row in group.iterrows():
-            total_counts[query] += 1
-            if prev_end is None or row['tstart'] - prev_end > protein_distance:
-                alone_counts[query] += 1
-            prev_end = row['tend']
-    
-    return alone_counts, total_counts
+    '''
+    Counts the host hits of every viral PC and the hits that are alone: the first on their contig, or starting
+    more than protein_distance after the end of the previous hit of the same PC on the same contig
+    :param viral_host_search_res: DataFrame with query, target, tstart and tend columns
+    :param protein_distance: distance, or list of distances counted in the same pass
+    :return: (alone_counts, total_counts) as Series indexed by PC, alone_counts is a DataFrame
+        with one column per distance when a list is given
+    '''
+    queries = pd.Categorical(viral_host_search_res['query'])
+    targets = pd.Categorical(viral_host_search_res['target'])
+    order, _, _, gap = sort_hits(queries.codes, targets.codes, viral_host_search_res['tstart'].to_numpy(), viral_host_search_res['tend'].to_numpy())
+    return proximity_counts({"query": queries.codes[order], "gap": gap, "queries": queries.categories}, protein_distance)
 
-def categorize_viral_pcs(viral_host_search_res, viral_go_search_res, bitscore_threshold):
+def categorize_viral_pcs(host_pcs, viral_go_search_res, bitscore_threshold):
     with_go_metabolic_hits = set(viral_go_search_res[viral_go_search_res['bitscore'] >= bitscore_threshold]['query'])
-    without_go_metabolic_hits = set(viral_host_search_res['query']) - with_go_metabolic_hits
+    without_go_metabolic_hits = set(host_pcs) - with_go_metabolic_hits
     
     return with_go_metabolic_hits, without_go_metabolic_hits
 
-def plot_histogram(alone_counts, total_counts, with_go_metabolic_hits, without_go_metabolic_hits):
+def plot_histogram(alone_counts, total_counts, with_go_metabolic_hits, without_go_metabolic_hits, outpath):
     # Prepare data for histogram
-    ratios_with_go = {pc: alone_counts[pc] / total_counts[pc] for pc in with_go_metabolic_hits if total_counts[pc] > 10}
-    ratios_without_go = {pc: alone_counts[pc] / total_counts[pc] for pc in without_go_metabolic_hits if total_counts[pc] > 10}
+    ratios = (alone_counts / total_counts)[total_counts > 10]
     
     # Data for plotting
-    data_with_go = list(ratios_with_go.values())
-    data_without_go = list(ratios_without_go.values())
+    data_with_go = ratios[ratios.index.isin(list(with_go_metabolic_hits))].to_list()
+    data_without_go = ratios[ratios.index.isin(list(without_go_metabolic_hits))].to_list()
 
     plt.figure(figsize=(10, 6))
     plt.hist(data_with_go, bins=20, alpha=0.75, color='blue', label='With GO Metabolic Hits')
     plt.hist(data_without_go, bins=20, alpha=0.75, color='red', label='Without GO Metabolic Hits')
     plt.xlabel('Alone / Total Hits Ratio')
     plt.ylabel('Frequency')
-    plt.title('Histogram of Alone/Total Hits Ratios for Viral PCs')
+    plt.title(f'Histogram of Alone/Total Hits Ratios for Viral PCs (protein distance {alone_counts.name})')
     plt.legend()
     plt.grid(True)
-    plt.show()
+    plt.savefig(outpath)
+    plt.close()
+
+def colocation_counts(index, with_go_metabolic_hits, without_go_metabolic_hits, protein_distance):
+    '''
+    Counts, for every PC, its host hits that lie within protein_distance of a hit of a PC from the other group:
+    PCs with GO metabolic hits are tested against those without and the other way round
+    :return: Series of co-located hit counts indexed by PC
+    '''
+    return pd.concat([
+        colocated_counts(index, with_go_metabolic_hits, without_go_metabolic_hits, protein_distance),
+        colocated_counts(index, without_go_metabolic_hits, with_go_metabolic_hits, protein_distance)
+    ])
+
+def parse_region(region):
+    contig, _, interval = region.rpartition(":")
+    start, end = interval.split("-")
+    return contig, int(start), int(end)
+
+def write_neighborhoods(index, regions, protein_distances, with_go_metabolic_hits, outpath):
+    '''
+    Writes the host hits within every protein distance of each region
+    :param regions: host contig regions as contig:start-end
+    :return: None
+    '''
+    tables = []
+    for region in regions:
+        contig, start, end = parse_region(region)
+        if contig not in index["contigs"]:
+            print(f"No host hits on contig {contig}, skipping region {region}")
+            continue
+        for distance in protein_distances:
+            hits = neighborhood(index, contig, start, end, distance)
+            hits.insert(0, "distance", distance)
+            hits.insert(0, "region", region)
+            hits["go_metabolic"] = hits["query"].isin(list(with_go_metabolic_hits))
+            tables.append(hits)
+    columns = ["region", "distance", "query", "contig", "start", "end", "go_metabolic"]
+    neighborhoods = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
+    neighborhoods.to_csv(outpath, sep="\t", index=False)
 
 def process_mmseqs(search_outdir):
     columns = ["query", "target", "pident", "alnlen", "mismatch", "numgapopen", "qstart", "qend", "tstart", "tend", "evalue", "bitscore"]
     df = pd_read_csv(f"{search_outdir}/network.m8", sep="\t", names=columns)
     return df
 
-def amg(viral_pcs, go_metabolic, host_genomes, protein_distance, threads, outdir):
+def amg(viral_pcs, go_metabolic, host_genomes, protein_distance, threads, outdir, regions=None):
+    '''
+    Compares how often viral PCs with and without GO metabolic hits are alone on host contigs, and how often
+    their hits lie next to hits of the other group
+    :param protein_distance: distance, or list of distances, within which two hits of a PC are neighbours
+    :param regions: optional host contig regions as contig:start-end, their neighbourhoods are written to neighborhoods.tsv
+    '''
     os.makedirs(outdir, exist_ok=True)
     bitscore_threshold = 10
-    protein_distance = 100000
+    protein_distances = list(np.atleast_1d(protein_distance))
 
     db = f"{outdir}/db"
     search_results = f"{outdir}/search_results"
@@ -82,14 +127,32 @@ def amg(viral_pcs, go_metabolic, host_genomes, protein_distance, threads, outdir
     if not os.path.exists(host_viral_outdir):
         mmseqs_search(viral_pcs_db, host_genomes_db, host_viral_outdir, addition="--search-type 4")
     
-    viral_go_search_res = process_mmseqs(viral_metabolic_outdir)
-    viral_host_search_res = process_mmseqs(host_viral_outdir)
-    viral_go_search_res = filter_hits(viral_go_search_res, bitscore_threshold)
-    viral_host_search_res = filter_hits(viral_host_search_res, bitscore_threshold)
+    # The filtered host hits are indexed once, then every distance is answered from the index
+    index_dir = f"{outdir}/interval_index"
+    stage = dict(inputs=[f"{host_viral_outdir}/network.m8"], outputs=[f"{index_dir}/{name}" for name in INDEX_FILES], params={"bitscore": bitscore_threshold})
+    if not stage_current("interval_index", **stage):
+        viral_host_search_res = filter_hits(process_mmseqs(host_viral_outdir), bitscore_threshold)
+        build_interval_index(viral_host_search_res, index_dir)
+        record_stage("interval_index", **stage)
+    else:
+        print("Interval index already exists, using existing index")
+    index = load_interval_index(index_dir)
+
+    viral_go_search_res = filter_hits(process_mmseqs(viral_metabolic_outdir), bitscore_threshold)
+    alone_counts, total_counts = proximity_counts(index, protein_distances)
+    with_go_metabolic_hits, without_go_metabolic_hits = categorize_viral_pcs(total_counts.index, viral_go_search_res, bitscore_threshold)
 
-    alone_counts, total_counts = calculate_proximity_counts(viral_host_search_res, protein_distance)
-    with_go_metabolic_hits, without_go_metabolic_hits = categorize_viral_pcs(viral_host_search_res, viral_go_search_res, bitscore_threshold)
+    counts = alone_counts.add_prefix("alone_")
+    counts.insert(0, "total", total_counts)
+    counts.insert(0, "go_metabolic", counts.index.isin(list(with_go_metabolic_hits)))
+    for distance in protein_distances:
+        counts[f"colocated_{distance}"] = colocation_counts(index, with_go_metabolic_hits, without_go_metabolic_hits, distance).reindex(counts.index, fill_value=0)
+    counts.to_csv(f"{outdir}/proximity_counts.tsv", sep="\t", index_label="pc")
 
-    plot_histogram(alone_counts, total_counts, with_go_metabolic_hits, without_go_metabolic_hits)
+    for distance in protein_distances:
+        plot_histogram(alone_counts[distance], total_counts, with_go_metabolic_hits, without_go_metabolic_hits, f"{outdir}/alone_ratio_histogram_{distance}.png")
+    print(f"Proximity counts saved to {outdir}/proximity_counts.tsv")
 
-# Configuration and call for the function here if necessary
+    if regions:
+        write_neighborhoods(index, regions, protein_distances, with_go_metabolic_hits, f"{outdir}/neighborhoods.tsv")
+        print(f"Region neighbourhoods saved to {outdir}/neighborhoods.tsv")
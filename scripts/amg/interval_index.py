@@ -0,0 +1,172 @@
+from scripts.utils import running_message
+import pandas as pd
+import numpy as np
+import json
+import os
+
+# Hits are stored ordered by (query, contig, start); by_contig reorders them by (contig, start)
+INDEX_TYPES = {
+    "query": "int32",
+    "target": "int32",
+    "start": "int64",
+    "end": "int64",
+    "gap": "float64",
+    "by_contig": "int64"
+}
+INDEX_FILES = [f"{array}.bin" for array in INDEX_TYPES] + ["queries.txt", "contigs.txt", "contig_offsets.bin", "index.json"]
+
+def sort_hits(queries, targets, tstart, tend):
+    '''
+    Orders hits by (query, target, start) and measures the gap from each hit to the previous hit of the same
+    query on the same target, infinite for the first one
+    :param queries: integer query codes
+    :param targets: integer target codes
+    :return: (order, start, end, gap) with start <= end on both strands
+    '''
+    # Hits on the minus strand have tstart > tend
+    start, end = np.minimum(tstart, tend), np.maximum(tstart, tend)
+    order = np.lexsort((start, targets, queries))
+    queries, targets = queries[order], targets[order]
+    start, end = start[order], end[order]
+
+    gap = np.empty(len(order))
+    gap[1:] = start[1:] - end[:-1]
+    first_in_group = np.ones(len(order), dtype=bool)
+    first_in_group[1:] = (queries[1:] != queries[:-1]) | (targets[1:] != targets[:-1])
+    gap[first_in_group] = np.inf
+    return order, start, end, gap
+
+@running_message
+def build_interval_index(hits, index_dir):
+    '''
+    Writes host hits as a per-contig interval index of sorted binary arrays
+    :param hits: DataFrame with query, target, tstart and tend columns
+    :param index_dir: output directory
+    :return: index_dir
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    queries = pd.Categorical(hits['query'])
+    targets = pd.Categorical(hits['target'])
+    order, start, end, gap = sort_hits(queries.codes, targets.codes, hits['tstart'].to_numpy(), hits['tend'].to_numpy())
+    target = targets.codes[order]
+
+    by_contig = np.lexsort((start, target))
+    contig_offsets = np.searchsorted(target[by_contig], np.arange(len(targets.categories) + 1)).astype(np.int64)
+
+    arrays = {"query": queries.codes[order], "target": target, "start": start, "end": end, "gap": gap, "by_contig": by_contig}
+    for name, values in arrays.items():
+        np.ascontiguousarray(values, dtype=INDEX_TYPES[name]).tofile(f"{index_dir}/{name}.bin")
+    contig_offsets.tofile(f"{index_dir}/contig_offsets.bin")
+    for name, categories in (("queries", queries.categories), ("contigs", targets.categories)):
+        with open(f"{index_dir}/{name}.txt", "w") as names:
+            names.writelines(f"{category}\n" for category in categories)
+
+    # The metadata is written last, so an interrupted build is redone on the next run
+    with open(f"{index_dir}/index.json.tmp", "w") as meta:
+        json.dump({"hits": len(order), "contigs": len(targets.categories), "types": INDEX_TYPES}, meta)
+    os.replace(f"{index_dir}/index.json.tmp", f"{index_dir}/index.json")
+    return index_dir
+
+def load_interval_index(index_dir):
+    '''
+    Loads an interval index with memory-mapped arrays
+    :param index_dir: directory written by build_interval_index
+    :return: dictionary of arrays plus 'queries' and 'contigs' name indexes
+    '''
+    with open(f"{index_dir}/index.json") as meta:
+        meta = json.load(meta)
+    index = {}
+    for name, dtype in meta["types"].items():
+        index[name] = np.memmap(f"{index_dir}/{name}.bin", dtype=dtype, mode="r", shape=(meta["hits"],)) if meta["hits"] else np.zeros(0, dtype=dtype)
+    index["contig_offsets"] = np.fromfile(f"{index_dir}/contig_offsets.bin", dtype=np.int64)
+    for name in ("queries", "contigs"):
+        with open(f"{index_dir}/{name}.txt") as names:
+            index[name] = pd.Index([line.rstrip("\n") for line in names])
+    return index
+
+def pc_mask(index, pcs):
+    '''
+    Boolean mask over the hits of the index that belong to a set of PCs, all hits when pcs is None
+    '''
+    if pcs is None:
+        return np.ones(len(index["query"]), dtype=bool)
+    selected = np.zeros(len(index["queries"]) + 1, dtype=bool)
+    selected[index["queries"].get_indexer(list(pcs))] = True
+    selected[-1] = False
+    return selected[index["query"]]
+
+def proximity_counts(index, protein_distance, pcs=None):
+    '''
+    Counts the hits of every PC and the hits that are alone: the first on their contig, or starting more than
+    protein_distance after the end of the previous hit of the same PC on the same contig
+    :param index: interval index from load_interval_index
+    :param protein_distance: distance, or list of distances counted in the same pass
+    :param pcs: PCs to count, all by default
+    :return: (alone_counts, total_counts) as Series indexed by PC, alone_counts is a DataFrame
+        with one column per distance when a list is given
+    '''
+    mask = pc_mask(index, pcs)
+    queries, gap = index["query"][mask], index["gap"][mask]
+    n_queries = len(index["queries"])
+
+    total_counts = pd.Series(np.bincount(queries, minlength=n_queries), index=index["queries"])
+    alone_counts = pd.DataFrame({
+        distance: np.bincount(queries[gap > distance], minlength=n_queries) for distance in np.atleast_1d(protein_distance).tolist()
+    }, index=index["queries"])
+
+    observed = total_counts > 0
+    total_counts, alone_counts = total_counts[observed], alone_counts[observed]
+    if np.ndim(protein_distance) == 0:
+        alone_counts = alone_counts.iloc[:, 0]
+    return alone_counts, total_counts
+
+def neighborhood(index, contig, start, end, protein_distance):
+    '''
+    Returns the hits on a contig that lie within protein_distance of the interval [start, end]
+    :return: DataFrame of query, contig, start and end
+    '''
+    code = index["contigs"].get_loc(contig)
+    first, last = index["contig_offsets"][code], index["contig_offsets"][code + 1]
+    hits = index["by_contig"][first:last]
+    # Hits are sorted by start within the contig: take those starting before the window ends, then test their ends
+    stop = np.searchsorted(index["start"][hits], end + protein_distance, side="right")
+    hits = hits[:stop][index["end"][hits[:stop]] >= start - protein_distance]
+    return pd.DataFrame({
+        "query": index["queries"][index["query"][hits]],
+        "contig": contig,
+        "start": index["start"][hits],
+        "end": index["end"][hits]
+    })
+
+def colocated_counts(index, pcs, partners, protein_distance):
+    '''
+    Counts, for every PC of pcs, its hits that have a hit of one of the partner PCs within protein_distance
+    on the same contig. PCs that are in both sets are dropped from the partners
+    :param index: interval index from load_interval_index
+    :param pcs: PCs whose hits are tested
+    :param partners: PCs to look for around them
+    :param protein_distance: maximum distance between the hits
+    :return: Series of co-located hit counts indexed by PC
+    '''
+    pcs = set(pcs)
+    partner_mask = pc_mask(index, set(partners) - pcs)[index["by_contig"]]
+    partner_hits = index["by_contig"][partner_mask]
+    partner_target = index["target"][partner_hits]
+    # Positions are offset per contig so that one sorted key covers all contigs
+    contig_width = int(index["end"].max(initial=0)) + protein_distance + 1
+    partner_key = partner_target.astype(np.int64) * contig_width + index["start"][partner_hits]
+    # Running maximum of the partner ends along each contig: only the partners starting before a window can overlap it
+    partner_running_end = np.maximum.accumulate(partner_target.astype(np.int64) * contig_width + index["end"][partner_hits]) - partner_target.astype(np.int64) * contig_width
+
+    hits = np.flatnonzero(pc_mask(index, pcs))
+    target, start, end = index["target"][hits], index["start"][hits], index["end"][hits]
+    contig_first = np.searchsorted(partner_target, target, side="left")
+    window_stop = np.searchsorted(partner_key, target.astype(np.int64) * contig_width + end + protein_distance, side="right")
+    has_candidate = window_stop > contig_first
+    colocated = np.zeros(len(hits), dtype=bool)
+    colocated[has_candidate] = partner_running_end[window_stop[has_candidate] - 1] >= start[has_candidate] - protein_distance
+
+    counts = np.bincount(index["query"][hits][colocated], minlength=len(index["queries"]))
+    pc_codes = index["queries"].get_indexer(sorted(pcs))
+    pc_codes = pc_codes[pc_codes >= 0]
+    return pd.Series(counts[pc_codes], index=index["queries"][pc_codes])
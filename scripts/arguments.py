@@ -1,10 +1,14 @@
 import argparse
+import re
 from multiprocessing import cpu_count
 from . import version
+from .benchmark.stages import STAGES
 
 def arguments():
     args = argparse.ArgumentParser(description="Make MCL cluster using Diamond")
     args.add_argument('-v', '--version', action='version', version=f'%(prog)s {version}')
+    args.add_argument('--trace_memory', help="Record the peak Python memory of each stage in <outdir>/metrics.jsonl (slower)", action='store_true')
+    args.add_argument('--profile', help="Write a cProfile dump of each stage to <outdir>/profiles", action='store_true')
     subparsers = args.add_subparsers(dest='command', help='sub-command help')
     
     cluster_parser = subparsers.add_parser('cluster', help='build cluster representative database')
@@ -25,6 +29,19 @@ def arguments():
         type=int,
         choices=[0, 1, 2, 3, 4, 5])
     cluster_parser.add_argument("--mmseqs", help="Use mmseqs instead of diamond", action="store_true")
+    cluster_parser.add_argument("--update", help="Add the proteins of --input to the existing clusters in --outdir instead of clustering from scratch", action="store_true")
+    cluster_parser.add_argument("--native_mcl", help="Cluster with the built-in sparse MCL instead of the mcl binary", action="store_true")
+    cluster_parser.add_argument("--stream_mcl", help="Stream edges into the mcl binary instead of writing mcl_input.tsv. Only the text file is avoided: the hit table is still loaded, memory-mapped, for the same/opposite cluster analysis", action="store_true")
+    cluster_parser.add_argument("--dedup", help="Search and cluster one protein per distinct sequence, then add the identical proteins back to their clusters", action="store_true")
+    cluster_parser.add_argument("--intern_ids", help="Run DIAMOND and MCL on integer protein ids and give MCL a native matrix, mapping names back in the outputs", action="store_true")
+    cluster_parser.add_argument("--top_k", help="Keep at most this many hits per protein, best bitscore first, as MCL edges", default=None, type=int)
+    cluster_parser.add_argument("--min_qcovhsp", help="Minimum query coverage (%%) of a hit used as MCL edge, or with --update of a hit placing a new protein", default=0.0, type=float)
+    cluster_parser.add_argument("--min_pident", help="Minimum identity (%%) of a hit used as MCL edge, or with --update of a hit placing a new protein", default=0.0, type=float)
+    cluster_parser.add_argument("--component_mcl", help="Cluster connected components separately: components of one or two proteins directly, larger ones with mcl in parallel", action="store_true")
+    cluster_parser.add_argument("--inflation", help="MCL inflation (default: 1.3)", default=None, type=float)
+    cluster_parser.add_argument("--sweep_inflation", help="Cluster the graph once per inflation value instead, writing the clusters and a summary.tsv to inflation_sweep", nargs='+', default=None, type=float)
+    cluster_parser.add_argument("--mcl_prune", help="Pruning threshold of the built-in MCL", default=1e-4, type=float)
+    cluster_parser.add_argument("--mcl_select", help="Maximum number of entries kept per column by the built-in MCL", default=1100, type=int)
     cluster_parser.add_argument("--mmseqs_sensitivity", help="Sensitivity of mmseqs clustering", default=7.5, type=float)
     
     network_parser = subparsers.add_parser('network', help='create a network from clusters')
@@ -34,6 +51,12 @@ def arguments():
     network_parser.add_argument("-o", "--outdir", help="Output directory", default="output_network")
     network_parser.add_argument("--mmseqs", action="store_true", help="Use mmseqs instead of diamond")
     network_parser.add_argument("--type", default='nucl', choices=['nucl', 'prot'], help="reference database type")
+    network_parser.add_argument("-j", "--jobs", help="Number of reference shards searched at once; --threads is split evenly between them (default: threads // 8 for mmseqs, 1 for DIAMOND)", default=None, type=int)
+    network_parser.add_argument("--min_orf_length", help="Only search stop-free frame segments of at least this many amino acids, named after their contig coordinates, and write the hits against the contigs to network.contigs.tsv (--type nucl only)", default=None, type=int)
+    network_parser.add_argument("--shards", help="Number of reference shards, balanced by residue count (default: threads)", default=None, type=int)
+    network_parser.add_argument("--tmpdir", help="Scratch directory for mmseqs (default: <outdir>/tmp)", default=None)
+    network_parser.add_argument("--block_size", help="DIAMOND block size in billions of sequence letters", default=2.0, type=float)
+    network_parser.add_argument("--index_chunks", help="Number of DIAMOND index chunks", default=4, type=int)
 
     
     gene_share_parser = subparsers.add_parser('gene_share', help='calculate gene sharing network')
@@ -42,15 +65,29 @@ def arguments():
     gene_share_parser.add_argument("-t", "--threads", help="Number of threads", default=cpu_count(), type=int)
     gene_share_parser.add_argument("-o", "--outdir", help="Output directory", default="output_gene_share")
     gene_share_parser.add_argument("--mmseqs", action="store_true", help="Use mmseqs instead of diamond")
+    gene_share_parser.add_argument("--sparse", action="store_true", help="Only score genome pairs sharing clusters and write an edge list instead of a dense matrix")
+    gene_share_parser.add_argument("--min_shared", help="Minimum number of shared clusters for a genome pair to be scored in --sparse mode", default=1, type=int)
+    gene_share_parser.add_argument("--block_size", help="Number of genomes per parallel scoring block in --sparse mode", default=1000, type=int)
     gene_share_parser.add_argument('--gen_mapping_file', help = 'only use if your protein name is node_id_{some number} made for the developer', action='store_true', default=False)
     
     amg_parser = subparsers.add_parser('amg', help='create AMG network')
     amg_parser.add_argument("-v", "--viral_pcs", help="viral protein clusters", required=True)
     amg_parser.add_argument("-g", "--go_metabolic", help="bacterial protein clusters", required=True)
     amg_parser.add_argument("-r", "--host_genomes", help="host genomes", required=True)
-    amg_parser.add_argument('-d', '--protein_distance', help="protein distance", default=27000, type=int)
+    amg_parser.add_argument('-d', '--protein_distance', help="Protein distance, several distances are answered from the same interval index", nargs='+', default=[27000], type=int)
     amg_parser.add_argument("-t", "--threads", help="Number of threads", default=cpu_count(), type=int)
     amg_parser.add_argument("-o", "--outdir", help="Output directory", default="output_amg")
+    amg_parser.add_argument("--region", help="Host contig regions as contig:start-end, the hits within each protein distance of them are written to neighborhoods.tsv", nargs='+', default=None)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='measure stage scaling on synthetic data')
+    benchmark_parser.add_argument("-o", "--outdir", help="Output directory", default="output_benchmark")
+    benchmark_parser.add_argument("-s", "--sizes", help="Numbers of synthetic proteins", nargs='+', default=[1000, 4000, 16000], type=int)
+    benchmark_parser.add_argument("-t", "--threads", help="Number of threads", default=cpu_count(), type=int)
+    benchmark_parser.add_argument("--repeats", help="Number of runs per size, the median is reported", default=1, type=int)
+    benchmark_parser.add_argument("--seed", help="Random seed of the synthetic data", default=0, type=int)
+    benchmark_parser.add_argument("--stages", help="Stages to time (default: all)", nargs='+', default=None, choices=STAGES)
+    benchmark_parser.add_argument("--pipeline", help="Also run cluster, gene_share and network end to end with stand-ins for diamond, mcl and mmseqs", action="store_true")
+    benchmark_parser.add_argument("--keep_data", help="Keep the synthetic inputs and outputs of every size", action="store_true")
 
     arguments = args.parse_args()
 
@@ -61,17 +98,87 @@ def arguments():
             
         if not arguments.mmseqs and arguments.mmseqs_sensitivity != 7.5:
             args.error("--mmseqs_sensitivity flag is only compatible with --mmseqs flag.")
+
+        if arguments.mmseqs and arguments.native_mcl:
+            args.error("--native_mcl flag is incompatible with --mmseqs flag.")
+
+        if arguments.update and (arguments.mmseqs or arguments.native_mcl or arguments.stream_mcl):
+            args.error("--update flag is incompatible with --mmseqs, --native_mcl and --stream_mcl flags.")
+
+        if arguments.dedup and (arguments.mmseqs or arguments.update):
+            args.error("--dedup flag is incompatible with --mmseqs and --update flags.")
+
+        if arguments.intern_ids and (arguments.mmseqs or arguments.update or arguments.stream_mcl):
+            args.error("--intern_ids flag is incompatible with --mmseqs, --update and --stream_mcl flags.")
+
+        if arguments.component_mcl and (arguments.mmseqs or arguments.update or arguments.native_mcl or arguments.stream_mcl or arguments.intern_ids):
+            args.error("--component_mcl flag is incompatible with --mmseqs, --update, --native_mcl, --stream_mcl and --intern_ids flags.")
+
+        if arguments.top_k is not None and arguments.top_k < 1:
+            args.error("--top_k must be a positive integer")
+
+        if arguments.top_k is not None and (arguments.mmseqs or arguments.update or arguments.stream_mcl):
+            args.error("--top_k flag is incompatible with --mmseqs, --update and --stream_mcl flags.")
+
+        if (arguments.min_qcovhsp or arguments.min_pident) and (arguments.mmseqs or arguments.stream_mcl):
+            args.error("--min_qcovhsp and --min_pident flags are incompatible with --mmseqs and --stream_mcl flags.")
+
+        if arguments.inflation is not None and (arguments.mmseqs or arguments.update or arguments.sweep_inflation):
+            args.error("--inflation flag is incompatible with --mmseqs, --update and --sweep_inflation flags.")
+
+        if arguments.sweep_inflation and (arguments.mmseqs or arguments.update or arguments.stream_mcl or arguments.component_mcl or arguments.dedup):
+            args.error("--sweep_inflation flag is incompatible with --mmseqs, --update, --stream_mcl, --component_mcl and --dedup flags.")
+
+        if (arguments.sweep_inflation and min(arguments.sweep_inflation) <= 1) or (arguments.inflation is not None and arguments.inflation <= 1):
+            args.error("MCL inflation values must be greater than 1")
+
+        if arguments.stream_mcl and (arguments.mmseqs or arguments.native_mcl):
+            args.error("--stream_mcl flag is incompatible with --mmseqs and --native_mcl flags.")
+
+        if not arguments.native_mcl and (arguments.mcl_prune != 1e-4 or arguments.mcl_select != 1100):
+            args.error("--mcl_prune and --mcl_select flags are only compatible with --native_mcl flag.")
     
+    if arguments.command == "network":
+        if arguments.mmseqs and (arguments.block_size != 2.0 or arguments.index_chunks != 4):
+            args.error("--block_size and --index_chunks flags are only compatible with the DIAMOND backend.")
+
+        if not arguments.mmseqs and arguments.tmpdir is not None:
+            args.error("--tmpdir flag is only compatible with --mmseqs flag.")
+
+        if arguments.min_orf_length is not None and (arguments.type != 'nucl' or arguments.min_orf_length < 1):
+            args.error("--min_orf_length must be a positive integer and is only compatible with --type nucl.")
+
+        if arguments.shards is not None and arguments.shards < 1:
+            args.error("Number of shards must be a positive integer")
+
+        if arguments.jobs is not None and arguments.jobs < 1:
+            args.error("Number of jobs must be a positive integer")
+
     if arguments.command == "gene_share":
         if arguments.gen_mapping_file and arguments.mapping != 'None':
             args.error("--gen_mapping_file flag is only compatible when mapping file not provided flag.")
             
         if not arguments.gen_mapping_file and arguments.mapping == 'None':
             args.error("Please provide a mapping file or use --gen_mapping_file flag to generate a mapping if node_id_{some number} = protein_id.")
+
+        if arguments.block_size < 1:
+            args.error("Block size must be a positive integer")
+
+        if (arguments.min_shared != 1 or arguments.block_size != 1000) and not arguments.sparse:
+            args.error("--min_shared and --block_size flags are only compatible with --sparse flag.")
     
+    if arguments.command == "benchmark":
+        if min(arguments.sizes) < 1 or arguments.repeats < 1:
+            args.error("Sizes and number of repeats must be positive integers")
+
     if arguments.command == "amg":
-        if arguments.protein_distance < 1:
+        if min(arguments.protein_distance) < 1:
             args.error("Protein distance must be a positive integer")
+
+        for region in arguments.region or []:
+            match = re.fullmatch(r"(.+):(\d+)-(\d+)", region)
+            if not match or int(match.group(2)) > int(match.group(3)):
+                args.error(f"Region {region} is not of the form contig:start-end with start <= end")
     
     return arguments
 
@@ -0,0 +1,205 @@
+from scripts.benchmark.synthetic import synthetic_proteins, synthetic_mapping, synthetic_hits, synthetic_mcl_output, synthetic_contigs, synthetic_host_hits
+from scripts.benchmark.stand_ins import install_stand_ins
+from scripts.benchmark.stages import STAGES
+from scripts.cluster.hit_cache import DIAMOND_COLUMNS
+from scripts.cluster.cluster import cluster, parsing_clusters
+from scripts.cluster.analyze import analyze, graphics, find_representative_gene, same_cluster_mask
+from scripts.gene_share.gene_share import gene_share, calculate_adjacency_matrix
+from scripts.network.dna_translator import translate
+from scripts.network.network import network
+from scripts.amg.amg import calculate_proximity_counts
+from scripts.utils import pd_read_csv, current_rss_mb
+from matplotlib import pyplot as plt
+import pandas as pd
+import numpy as np
+import threading
+import tracemalloc
+import shutil
+import time
+import gc
+import os
+
+RSS_SAMPLE_INTERVAL = 0.01
+
+def measure(function, *args, **kwargs):
+    '''
+    Runs a function while a thread samples the resident memory. The resident memory misses memory the
+    allocator reuses, so the Python allocation peak is also reported when tracemalloc is tracing (--trace_memory)
+    :return: (result, wall seconds, peak resident memory above the starting point in MB, peak traced MB or None)
+    '''
+    gc.collect()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        traced_baseline = tracemalloc.get_traced_memory()[0]
+    baseline = current_rss_mb() or 0
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], current_rss_mb() or 0)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], current_rss_mb() or 0)
+    traced = (tracemalloc.get_traced_memory()[1] - traced_baseline) / (1 << 20) if tracemalloc.is_tracing() else None
+    return result, seconds, peak[0] - baseline, traced
+
+def generate_inputs(datadir, size, seed):
+    '''
+    Writes the synthetic inputs of one size: size proteins, their all-vs-all hits, clusters and genome mapping,
+    size / 100 contigs of 10 kb and 10 host hits per protein
+    '''
+    os.makedirs(datadir, exist_ok=True)
+    names, families = synthetic_proteins(f"{datadir}/proteins.fasta", size, seed=seed)
+    synthetic_mapping(f"{datadir}/mapping.tsv", names)
+    synthetic_hits(f"{datadir}/diamond.tsv", names, families, seed=seed)
+    synthetic_mcl_output(f"{datadir}/mcl_output.txt", names, families)
+    synthetic_contigs(f"{datadir}/contigs.fasta", max(1, size // 100), length=10000, seed=seed)
+    return synthetic_host_hits(size * 10, max(1, size // 10), max(1, size // 100), seed=seed)
+
+def benchmark_stages(datadir, rundir, host_hits, threads, stages):
+    '''
+    Times the Python stages on the synthetic inputs of one size, feeding each stage the output of the one before
+    :return: list of (stage, rows, seconds, peak resident MB, peak traced MB)
+    '''
+    results = []
+    def run(stage, rows, function, *args, **kwargs):
+        result, *measurements = measure(function, *args, **kwargs)
+        if stage in stages:
+            results.append((stage, len(result) if rows is None else rows, *measurements))
+        return result
+
+    df = run("pd_read_csv", None, pd_read_csv, f"{datadir}/diamond.tsv", sep="\t", names=DIAMOND_COLUMNS)
+    df["neglogeval"] = -np.log10(df["evalue"].clip(lower=1e-300))
+    gene_dict = run("parsing_clusters", None, parsing_clusters, f"{datadir}/mcl_output.txt")
+
+    # The histograms dominate analyze on small inputs, so they are timed as their own stage
+    if "analyze" in stages:
+        run("analyze", len(df), analyze, df, gene_dict, rundir, plots=False)
+    mask = same_cluster_mask(df, gene_dict)
+    same_cluster = df[mask]
+    if "graphics" in stages:
+        os.makedirs(f"{rundir}/graphics", exist_ok=True)
+        run("graphics", len(df), graphics, same_cluster, df[~mask], f"{rundir}/graphics")
+    run("find_representative_gene", len(same_cluster), find_representative_gene, same_cluster, gene_dict)
+
+    if "calculate_adjacency_matrix" in stages:
+        genes = pd.Series(list(gene_dict))
+        rep_df = pd.DataFrame({"Rep": gene_dict.lookup(genes), "Node": genes.str.rsplit("_", n=1).str[0]})
+        presence_absence_matrix = rep_df.groupby(["Node", "Rep"]).size().unstack(fill_value=0)
+        run("calculate_adjacency_matrix", len(presence_absence_matrix), calculate_adjacency_matrix, presence_absence_matrix)
+
+    if "translate" in stages:
+        run("translate", os.path.getsize(f"{datadir}/contigs.fasta"), translate, f"{datadir}/contigs.fasta", f"{rundir}/translated.fasta", threads)
+
+    if "calculate_proximity_counts" in stages:
+        run("calculate_proximity_counts", len(host_hits), calculate_proximity_counts, host_hits, 27000)
+    return results
+
+def benchmark_pipeline(datadir, rundir, threads):
+    '''
+    Times cluster, gene_share and network end to end with the stand-in tools
+    :return: list of (stage, rows, seconds, peak resident MB, peak traced MB)
+    '''
+    proteins = f"{datadir}/proteins.fasta"
+    with open(proteins) as fasta:
+        n_proteins = sum(line.startswith(">") for line in fasta)
+    runs = [
+        ("cluster", cluster, (proteins, f"{rundir}/cluster", threads, 1)),
+        ("gene_share", gene_share, (f"{rundir}/cluster", "None", threads, f"{rundir}/gene_share", True)),
+        ("network", network, (f"{rundir}/cluster", f"{datadir}/contigs.fasta", threads, f"{rundir}/network", "nucl", False))
+    ]
+    return [(stage, n_proteins, *measure(function, *args)[1:]) for stage, function, args in runs]
+
+def memory_column(results):
+    return "peak_traced_mb" if results["peak_traced_mb"].notna().all() else "peak_rss_mb"
+
+def scaling_exponents(results):
+    '''
+    Fits time ~ size^a and memory ~ size^b for every stage on a log-log scale
+    '''
+    rows = []
+    memory = memory_column(results)
+    for stage, group in results.groupby("stage", sort=False):
+        group = group.groupby("size")[["seconds", memory]].median().reset_index().rename(columns={memory: "peak_mb"})
+        fit = len(group) > 1
+        rows.append({
+            "stage": stage,
+            "time_exponent": np.polyfit(np.log(group["size"]), np.log(group["seconds"].clip(lower=1e-6)), 1)[0] if fit else np.nan,
+            "memory_exponent": np.polyfit(np.log(group["size"]), np.log(group["peak_mb"].clip(lower=1e-3)), 1)[0] if fit else np.nan,
+            "largest_size": group["size"].iloc[-1],
+            "seconds_at_largest": group["seconds"].iloc[-1],
+            "peak_mb_at_largest": group["peak_mb"].iloc[-1]
+        })
+    return pd.DataFrame(rows)
+
+def plot_scaling(results, outpath):
+    memory = memory_column(results)
+    medians = results.groupby(["stage", "size"], sort=False)[["seconds", memory]].median().reset_index().rename(columns={memory: "peak_mb"})
+    figure, (time_axis, memory_axis) = plt.subplots(1, 2, figsize=(14, 6))
+    for stage, group in medians.groupby("stage", sort=False):
+        time_axis.plot(group["size"], group["seconds"], marker="o", label=stage)
+        memory_axis.plot(group["size"], group["peak_mb"].clip(lower=1e-3), marker="o", label=stage)
+    for axis, label in ((time_axis, "Wall time (s)"), (memory_axis, "Peak traced allocations (MB)" if memory == "peak_traced_mb" else "Peak resident memory above start (MB)")):
+        axis.set_xscale("log")
+        axis.set_yscale("log")
+        axis.set_xlabel("Synthetic proteins")
+        axis.set_ylabel(label)
+        axis.grid(True)
+    time_axis.legend(loc="upper left", fontsize="small")
+    figure.suptitle("Stage scaling on synthetic data")
+    figure.savefig(outpath)
+    plt.close(figure)
+
+def benchmark(outdir, sizes, threads, repeats=1, seed=0, stages=None, pipeline=False, keep_data=False):
+    '''
+    Measures how the Python stages scale on synthetic data of increasing size
+    :param outdir: output directory for benchmark.tsv, scaling.tsv and scaling.png
+    :param sizes: numbers of synthetic proteins
+    :param threads: number of threads
+    :param repeats: number of runs per size, the median is reported
+    :param seed: random seed of the synthetic data
+    :param stages: names of the stages to time, all of STAGES by default
+    :param pipeline: also run cluster, gene_share and network end to end with the stand-in tools
+    :param keep_data: keep the synthetic inputs and outputs of every size
+    :return: DataFrame of scaling exponents
+    '''
+    stages = stages or STAGES
+    os.makedirs(outdir, exist_ok=True)
+    if pipeline:
+        os.environ["PATH"] = f"{install_stand_ins(os.path.abspath(f'{outdir}/bin'))}{os.pathsep}{os.environ['PATH']}"
+
+    records = []
+    for size in sorted(sizes):
+        datadir = f"{outdir}/size_{size}"
+        print(f"Generating synthetic data for {size} proteins")
+        host_hits = generate_inputs(f"{datadir}/data", size, seed)
+        for repeat in range(repeats):
+            rundir = f"{datadir}/run_{repeat}"
+            os.makedirs(rundir, exist_ok=True)
+            results = benchmark_stages(f"{datadir}/data", rundir, host_hits, threads, stages)
+            if pipeline:
+                results += benchmark_pipeline(f"{datadir}/data", rundir, threads)
+            for stage, rows, seconds, peak_rss, peak_traced in results:
+                print(f"{stage}: {size} proteins, {rows} rows, {seconds:.2f} seconds, {peak_rss:.1f} MB resident" + (f", {peak_traced:.1f} MB traced" if peak_traced is not None else ""))
+                records.append({"stage": stage, "size": size, "repeat": repeat, "rows": rows, "seconds": seconds, "peak_rss_mb": peak_rss, "peak_traced_mb": peak_traced})
+            # Write after every run so an interrupted benchmark keeps its measurements
+            pd.DataFrame(records).to_csv(f"{outdir}/benchmark.tsv", sep="\t", index=False)
+        if not keep_data:
+            shutil.rmtree(datadir)
+
+    results = pd.DataFrame(records)
+    exponents = scaling_exponents(results)
+    exponents.to_csv(f"{outdir}/scaling.tsv", sep="\t", index=False)
+    plot_scaling(results, f"{outdir}/scaling.png")
+    print(exponents.to_string(index=False))
+    print(f"Benchmark results saved to {outdir}/benchmark.tsv, {outdir}/scaling.tsv and {outdir}/scaling.png")
+    return exponents
@@ -0,0 +1,2 @@
+# Stages timed by the benchmark subcommand, kept apart from benchmark.py so the argument parser stays light
+STAGES = ["pd_read_csv", "parsing_clusters", "analyze", "graphics", "find_representative_gene", "calculate_adjacency_matrix", "translate", "calculate_proximity_counts"]
@@ -0,0 +1,280 @@
+'''
+Lightweight local stand-ins for diamond, mcl and mmseqs so the pipeline can run offline on synthetic data.
+They accept the command lines the pipeline builds and write outputs in the same formats, but the
+search is a shared-minimizer heuristic and the clustering is connected components: the results are
+only meant for timing the Python stages around them.
+
+Usage: python -m scripts.benchmark.stand_ins {diamond,mcl,mmseqs} <tool arguments>
+'''
+from scripts.network.dna_translator import SYMBOL_CODES, COMPLEMENT_CODES, translate_codes
+from scripts.cluster.hit_cache import DIAMOND_COLUMNS
+from scripts.network.mmseqs_network import M8_COLUMNS
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import numpy as np
+import pandas as pd
+import shutil
+import sys
+import os
+
+KMER_LENGTH = 5
+WINDOW = 8
+MAX_TARGET_SEQS = 25
+STANDARD_COLUMNS = DIAMOND_COLUMNS[:12]
+STAND_IN_VERSIONS = {"diamond": "diamond version 0.0.0 (stand-in)", "mcl": "mcl 0-0 (stand-in)", "mmseqs": "0.0.0-stand-in"}
+
+def read_sequences(fastafile):
+    names, sequences = [], []
+    with open(fastafile) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                names.append(line[1:].split()[0])
+                sequences.append([])
+            elif names:
+                sequences[-1].append(line.strip())
+    return names, ["".join(sequence) for sequence in sequences]
+
+def minimizers(sequences):
+    '''
+    Samples the (window) minimizers of every sequence, hashed so that the sample is not biased to low-complexity k-mers
+    :param sequences: list of protein sequences
+    :return: DataFrame of sequence number, position and k-mer hash
+    '''
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    residues = np.frombuffer("".join(sequences).encode(), dtype=np.uint8).astype(np.uint64)
+    owner = np.repeat(np.arange(len(sequences)), lengths)
+    if len(residues) < KMER_LENGTH + WINDOW:
+        return pd.DataFrame({"sequence": [], "position": [], "kmer": []})
+
+    kmers = np.zeros(len(residues) - KMER_LENGTH + 1, dtype=np.uint64)
+    for offset in range(KMER_LENGTH):
+        kmers = kmers * np.uint64(256) + residues[offset:offset + len(kmers)]
+    kmers = kmers * np.uint64(0x9E3779B97F4A7C15)
+    # K-mers running into the next sequence can never be picked
+    kmers[owner[:len(kmers)] != owner[KMER_LENGTH - 1:]] = np.iinfo(np.uint64).max
+
+    windows = np.lib.stride_tricks.sliding_window_view(kmers, WINDOW)
+    positions = np.unique(windows.argmin(axis=1) + np.arange(len(windows)))
+    positions = positions[kmers[positions] != np.iinfo(np.uint64).max]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return pd.DataFrame({
+        "sequence": owner[positions],
+        "position": positions - starts[owner[positions]],
+        "kmer": kmers[positions]
+    }).drop_duplicates(["sequence", "kmer"])
+
+def search(query_fasta, target_fasta, translated=False, min_score=0):
+    '''
+    Finds pairs sharing minimizers and scores them from the shared fraction
+    :param translated: the targets are nucleotide sequences searched in six frames
+    :return: DataFrame with the DIAMOND_COLUMNS, target coordinates on the nucleotide sequence when translated
+    '''
+    query_names, query_sequences = read_sequences(query_fasta)
+    target_names, target_sequences = read_sequences(target_fasta)
+
+    frame_offsets, frame_strands, target_owner = [], [], []
+    if translated:
+        frames = []
+        for i, sequence in enumerate(target_sequences):
+            codes = SYMBOL_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+            reverse_complement = COMPLEMENT_CODES[codes][::-1]
+            for strand, strand_codes in ((1, codes), (-1, reverse_complement)):
+                for offset in range(3):
+                    frames.append(translate_codes(strand_codes[offset:]))
+                    frame_offsets.append(offset)
+                    frame_strands.append(strand)
+                    target_owner.append(i)
+        target_lengths = np.array([len(sequence) for sequence in target_sequences])[target_owner] if frames else np.zeros(0, dtype=np.int64)
+        target_sequences = frames
+
+    query_kmers = minimizers(query_sequences)
+    target_kmers = minimizers(target_sequences)
+    shared = query_kmers.merge(target_kmers, on="kmer", suffixes=("_q", "_t"))
+    pairs = shared.groupby(["sequence_q", "sequence_t"]).agg(
+        shared=("kmer", "size"),
+        diagonal=("position_t", "min"),
+        query_position=("position_q", "min")
+    ).reset_index()
+
+    query_counts = query_kmers.groupby("sequence").size()
+    target_counts = target_kmers.groupby("sequence").size()
+    union = query_counts.reindex(pairs["sequence_q"]).to_numpy() + target_counts.reindex(pairs["sequence_t"]).to_numpy() - pairs["shared"].to_numpy()
+    jaccard = pairs["shared"].to_numpy() / union
+    # Mash distance of the minimizer sets as the divergence of the pair
+    distance = np.clip(-np.log(2 * jaccard / (1 + jaccard)) / KMER_LENGTH, 0, 1)
+
+    query_lengths = np.array([len(sequence) for sequence in query_sequences])[pairs["sequence_q"]]
+    subject_lengths = np.array([len(sequence) for sequence in target_sequences])[pairs["sequence_t"]]
+    database_residues = sum(len(sequence) for sequence in target_sequences)
+    length = np.minimum(query_lengths, subject_lengths)
+    pident = (100 * (1 - distance)).round(1)
+    bitscore = (length * (1 - distance) * 2).round(1)
+    sstart = np.clip(pairs["diagonal"].to_numpy() - pairs["query_position"].to_numpy(), 0, None) + 1
+    send = np.minimum(sstart + length - 1, subject_lengths)
+
+    hits = pd.DataFrame({
+        "qseqid": np.array(query_names)[pairs["sequence_q"]],
+        "sseqid": np.array(target_names)[np.asarray(target_owner)[pairs["sequence_t"]]] if translated else np.array(target_names)[pairs["sequence_t"]],
+        "pident": pident,
+        "length": length,
+        "mismatch": (length * distance).astype(np.int64),
+        "gapopen": 0,
+        "qstart": 1,
+        "qend": length,
+        "sstart": sstart,
+        "send": send,
+        "evalue": np.clip(query_lengths * database_residues * np.exp2(-bitscore), 0, 10),
+        "bitscore": bitscore,
+        "qlen": query_lengths,
+        "slen": subject_lengths,
+        "qcovhsp": (100 * length / query_lengths).round(1),
+        "ppos": np.minimum(pident + 5, 100).round(1)
+    }, columns=DIAMOND_COLUMNS)
+
+    if translated and len(hits):
+        # Amino acid coordinates of a frame back to nucleotide coordinates of the contig, reversed on the minus strand
+        frame = pairs["sequence_t"].to_numpy()
+        offsets, strands = np.asarray(frame_offsets)[frame], np.asarray(frame_strands)[frame]
+        contig_lengths = target_lengths[frame]
+        forward_start, forward_end = offsets + (sstart - 1) * 3 + 1, offsets + send * 3
+        hits["sstart"] = np.where(strands == 1, forward_start, contig_lengths - forward_start + 1)
+        hits["send"] = np.where(strands == 1, forward_end, contig_lengths - forward_end + 1)
+        hits["slen"] = contig_lengths
+
+    hits = hits[hits["bitscore"] >= min_score]
+    hits = hits.sort_values(["qseqid", "bitscore"], ascending=[True, False], kind="stable")
+    return hits.groupby("qseqid", sort=False).head(MAX_TARGET_SEQS)
+
+def option(args, *flags, default=None):
+    for flag in flags:
+        if flag in args:
+            return args[args.index(flag) + 1]
+    return default
+
+def positionals(args):
+    '''
+    Drops options and their values, mmseqs accepts them before, between and after the positional arguments
+    '''
+    kept, skip = [], False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith("-"):
+            skip = True
+        else:
+            kept.append(arg)
+    return kept
+
+def diamond(args):
+    if args[0] == "version":
+        print(STAND_IN_VERSIONS["diamond"])
+    elif args[0] == "makedb":
+        database = option(args, "-d", "--db")
+        shutil.copy(option(args, "--in"), f"{database}.dmnd" if not database.endswith(".dmnd") else database)
+    elif args[0] == "blastp":
+        database = option(args, "-d", "--db")
+        database = database if database.endswith(".dmnd") else f"{database}.dmnd"
+        columns = STANDARD_COLUMNS
+        if "--outfmt" in args or "-f" in args:
+            start = args.index("--outfmt" if "--outfmt" in args else "-f") + 2
+            requested = []
+            while start < len(args) and not args[start].startswith("-"):
+                requested.append(args[start])
+                start += 1
+            columns = requested or STANDARD_COLUMNS
+        hits = search(option(args, "-q", "--query"), database, min_score=float(option(args, "--min-score", default=0)))
+        hits[columns].to_csv(option(args, "-o", "--out"), sep="\t", header=False, index=False)
+    else:
+        sys.exit(f"diamond stand-in: unsupported command {args[0]}")
+
+def mcl(args):
+    if args[0] == "--version":
+        print(STAND_IN_VERSIONS["mcl"])
+        return
+    source = sys.stdin if args[0] == "-" else open(args[0])
+    if "--abc" in args:
+        edges = pd.read_csv(source, sep="\t", names=["a", "b", "weight"], dtype={"a": str, "b": str})
+        write_components(edges["a"], edges["b"], option(args, "-o"))
+        return
+
+    # Native matrix: '<row> <col>:<value> ... $' lines between 'begin' and ')', labelled through -use-tab
+    rows, cols = [], []
+    in_matrix = False
+    for line in source:
+        if line.startswith("begin"):
+            in_matrix = True
+        elif in_matrix and line.startswith(")"):
+            break
+        elif in_matrix and line.strip():
+            row, *entries = line.split()
+            cols.extend(entry.split(":")[0] for entry in entries if entry != "$")
+            rows.extend([row] * (len(cols) - len(rows)))
+    labels = pd.read_csv(option(args, "-use-tab"), sep="\t", names=["id", "label"], dtype=str, keep_default_na=False).set_index("id")["label"]
+    write_components(pd.Series(rows, dtype=str).map(labels), pd.Series(cols, dtype=str).map(labels), option(args, "-o"))
+
+def write_components(a, b, output, as_pairs=False):
+    '''
+    Writes the connected components of an edge list, largest first, as MCL lines or mmseqs representative/member pairs
+    '''
+    nodes, codes = np.unique(np.concatenate([a.to_numpy(), b.to_numpy()]), return_inverse=True)
+    graph = coo_matrix((np.ones(len(a)), (codes[:len(a)], codes[len(a):])), shape=(len(nodes), len(nodes)))
+    _, labels = connected_components(graph, directed=False)
+    order = np.argsort(-np.bincount(labels)[labels], kind="stable")
+    components = pd.Series(nodes[order]).groupby(labels[order], sort=False).agg(list)
+    with open(output, "w") as out:
+        for members in components:
+            if as_pairs:
+                out.writelines(f"{members[0]}\t{member}\n" for member in members)
+            else:
+                out.write("\t".join(members) + "\n")
+
+def mmseqs(args):
+    command = args[0]
+    options, args = args, [command] + positionals(args[1:])
+    if command == "version":
+        print(STAND_IN_VERSIONS["mmseqs"])
+    elif command == "createdb":
+        # A stand-in database is the fasta itself plus the type file mmseqs writes next to it
+        shutil.copy(args[1], args[2])
+        _, sequences = read_sequences(args[1])
+        nucleotide = all(set(sequence.upper()) <= set("ACGTUN") for sequence in sequences[:100])
+        with open(f"{args[2]}.dbtype", "w") as dbtype:
+            dbtype.write("nucl" if nucleotide else "prot")
+    elif command == "search":
+        with open(f"{args[2]}.dbtype") as dbtype:
+            translated = dbtype.read() == "nucl"
+        hits = search(args[1], args[2], translated=translated)
+        hits.columns = M8_COLUMNS + DIAMOND_COLUMNS[len(M8_COLUMNS):]
+        hits[M8_COLUMNS].to_csv(args[3], sep="\t", header=False, index=False)
+    elif command in ("convertalis", "createtsv"):
+        # The stand-in search and cluster already write the final tables
+        shutil.copy(args[3], args[4])
+    elif command == "cluster":
+        min_id = float(option(options, "--min-seq-id", default=0))
+        hits = search(args[1], args[1])
+        hits = hits[hits["pident"] >= min_id * 100]
+        write_components(hits["qseqid"], hits["sseqid"], args[2], as_pairs=True)
+    else:
+        sys.exit(f"mmseqs stand-in: unsupported command {command}")
+
+STAND_INS = {"diamond": diamond, "mcl": mcl, "mmseqs": mmseqs}
+
+def install_stand_ins(bindir):
+    '''
+    Writes diamond, mcl and mmseqs executables that run the stand-ins with this interpreter
+    :param bindir: directory to put in front of PATH
+    :return: bindir
+    '''
+    os.makedirs(bindir, exist_ok=True)
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for tool in STAND_INS:
+        path = f"{bindir}/{tool}"
+        with open(path, "w") as script:
+            script.write(f'#!/bin/sh\nPYTHONPATH="{package_root}${{PYTHONPATH:+:$PYTHONPATH}}" exec "{sys.executable}" -m scripts.benchmark.stand_ins {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    return bindir
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in STAND_INS:
+        sys.exit(__doc__)
+    STAND_INS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,143 @@
+from scripts.cluster.hit_cache import DIAMOND_COLUMNS
+from scripts.network.mmseqs_network import M8_COLUMNS
+import numpy as np
+import pandas as pd
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+WRITE_CHUNK_SIZE = 10000
+
+def protein_names(n_proteins, proteins_per_genome=50):
+    '''
+    Names proteins <genome>_<number>, the layout gene_share --gen_mapping_file expects
+    '''
+    return [f"genome{i // proteins_per_genome}_{i % proteins_per_genome}" for i in range(n_proteins)]
+
+def synthetic_proteins(outpath, n_proteins, proteins_per_genome=50, family_size=5, length=300, mutation_rate=0.1, seed=0):
+    '''
+    Writes a protein fasta of families of mutated copies of random template sequences
+    :param outpath: output fasta
+    :param n_proteins: number of proteins
+    :param proteins_per_genome: number of consecutive proteins given the same genome name
+    :param family_size: average number of proteins per family
+    :param length: length of the templates
+    :param mutation_rate: fraction of residues of each copy replaced at random
+    :param seed: random seed
+    :return: (protein names, numpy array of family numbers)
+    '''
+    rng = np.random.default_rng(seed)
+    n_families = max(1, n_proteins // family_size)
+    templates = rng.choice(AMINO_ACIDS, size=(n_families, length))
+    families = rng.integers(0, n_families, n_proteins)
+    names = protein_names(n_proteins, proteins_per_genome)
+
+    with open(outpath, "w") as out:
+        for start in range(0, n_proteins, WRITE_CHUNK_SIZE):
+            sequences = templates[families[start:start + WRITE_CHUNK_SIZE]]
+            mutated = rng.random(sequences.shape) < mutation_rate
+            sequences[mutated] = rng.choice(AMINO_ACIDS, size=int(mutated.sum()))
+            out.writelines(f">{name}\n{sequence.tobytes().decode()}\n" for name, sequence in zip(names[start:start + WRITE_CHUNK_SIZE], sequences))
+    return names, families
+
+def synthetic_mapping(outpath, names):
+    '''
+    Writes the assembly_name / protein_ids mapping of the proteins named by protein_names
+    '''
+    pd.DataFrame({
+        "assembly_name": ["_".join(name.split("_")[:-1]) for name in names],
+        "protein_ids": names
+    }).to_csv(outpath, sep="\t", index=False)
+
+def synthetic_hits(outpath, names, families, hits_per_protein=10, noise=0.1, length=300, seed=0):
+    '''
+    Writes a DIAMOND all-vs-all table in the column layout of cluster's diamond stage
+    Every protein hits itself, members of its family and, with probability noise, random proteins
+    :param outpath: output tsv
+    :param names: protein names
+    :param families: family number of each protein
+    :param hits_per_protein: number of hits drawn per protein besides the self hit
+    :param noise: fraction of hits to random proteins
+    :param length: length of the proteins
+    :param seed: random seed
+    :return: number of hits written
+    '''
+    rng = np.random.default_rng(seed)
+    names = np.asarray(names)
+    order = np.argsort(families, kind="stable")
+    family_starts = np.searchsorted(families[order], families)
+    family_sizes = np.bincount(families)[families]
+
+    queries = np.repeat(np.arange(len(names)), hits_per_protein)
+    random_hit = rng.random(len(queries)) < noise
+    offsets = (rng.random(len(queries)) * family_sizes[queries]).astype(np.int64)
+    subjects = np.where(random_hit, rng.integers(0, len(names), len(queries)), order[family_starts[queries] + offsets])
+
+    queries = np.concatenate([np.arange(len(names)), queries])
+    subjects = np.concatenate([np.arange(len(names)), subjects])
+    pairs = np.unique(np.stack([queries, subjects], axis=1), axis=0)
+    queries, subjects = pairs[:, 0], pairs[:, 1]
+
+    related = families[queries] == families[subjects]
+    pident = np.where(queries == subjects, 100.0, np.where(related, rng.uniform(70, 95, len(queries)), rng.uniform(20, 40, len(queries)))).round(1)
+    aligned = np.where(related, length, rng.integers(30, length, len(queries)))
+    bitscore = (aligned * pident / 100 * 2).round(1)
+    hits = pd.DataFrame({
+        "qseqid": names[queries],
+        "sseqid": names[subjects],
+        "pident": pident,
+        "length": aligned,
+        "mismatch": (aligned * (100 - pident) / 100).astype(np.int64),
+        "gapopen": 0,
+        "qstart": 1,
+        "qend": aligned,
+        "sstart": 1,
+        "send": aligned,
+        "evalue": np.clip(len(names) * length * np.exp2(-bitscore), 1e-300, None),
+        "bitscore": bitscore,
+        "qlen": length,
+        "slen": length,
+        "qcovhsp": (aligned / length * 100).round(1),
+        "ppos": np.minimum(pident + 5, 100).round(1)
+    }, columns=DIAMOND_COLUMNS)
+    hits.to_csv(outpath, sep="\t", header=False, index=False, float_format="%.3g")
+    return len(hits)
+
+def synthetic_mcl_output(outpath, names, families):
+    '''
+    Writes the families as MCL output, one tab separated cluster per line from largest to smallest
+    '''
+    clusters = pd.Series(names).groupby(families).agg(list)
+    clusters = clusters.iloc[np.argsort(-clusters.str.len().to_numpy(), kind="stable")]
+    with open(outpath, "w") as out:
+        out.writelines("\t".join(members) + "\n" for members in clusters)
+
+def synthetic_contigs(outpath, n_contigs, length=50000, seed=0):
+    '''
+    Writes a nucleotide fasta of random contigs
+    '''
+    rng = np.random.default_rng(seed)
+    with open(outpath, "w") as out:
+        for i in range(n_contigs):
+            out.write(f">contig{i}\n{rng.choice(NUCLEOTIDES, size=length).tobytes().decode()}\n")
+
+def synthetic_host_hits(n_hits, n_queries, n_contigs, contig_length=1000000, hit_length=900, seed=0):
+    '''
+    Builds an mmseqs m8 table of viral protein clusters hitting positions on host contigs, as read by amg
+    :return: DataFrame with the M8_COLUMNS
+    '''
+    rng = np.random.default_rng(seed)
+    tstart = rng.integers(1, contig_length - hit_length, n_hits)
+    return pd.DataFrame({
+        "query": pd.Categorical.from_codes(rng.integers(0, n_queries, n_hits), [f"pc{i}" for i in range(n_queries)]).astype(str),
+        "target": pd.Categorical.from_codes(rng.integers(0, n_contigs, n_hits), [f"contig{i}" for i in range(n_contigs)]).astype(str),
+        "pident": rng.uniform(30, 100, n_hits).round(1),
+        "alnlen": hit_length // 3,
+        "mismatch": 0,
+        "numgapopen": 0,
+        "qstart": 1,
+        "qend": hit_length // 3,
+        "tstart": tstart,
+        "tend": tstart + hit_length - 1,
+        "evalue": 1e-20,
+        "bitscore": rng.uniform(10, 500, n_hits).round(1)
+    }, columns=M8_COLUMNS)
@@ -1,8 +1,10 @@
-from scripts.utils import running_message
-from os import makedirs
-from os.path import exists
+from scripts.utils import running_message, write_tsv_chunks
+from scripts.manifest import stage_current, record_stage
+from scripts.cluster.assignments import ClusterAssignments
+from os import makedirs, replace
 from matplotlib import pyplot as plt
 import pandas as pd
+import numpy as np
 
 def graphics(same_df, opposite_df, outdir):
     graph_types=['bitscore', 'length', 'pident', "neglogeval", "qcovhsp", "ppos"]
@@ -18,46 +20,71 @@ def graphics(same_df, opposite_df, outdir):
         plt.close()
 
 def find_representative_gene(same_df, gene_dict):
-    gene_points_df = same_df.groupby('qseqid')['bitscore'].sum().reset_index()
-    gene_points_df['cluster'] = gene_points_df['qseqid'].map(gene_dict)
-    gene_points_df = gene_points_df.dropna(subset=['cluster'])
+    gene_points_df = same_df.groupby('qseqid', observed=True)['bitscore'].sum().reset_index()
+    gene_points_df['cluster'] = cluster_codes(gene_dict, gene_points_df['qseqid'])[0]
+    gene_points_df = gene_points_df[gene_points_df['cluster'] != -1]
     idx = gene_points_df.groupby('cluster')['bitscore'].idxmax()
     representative_genes = gene_points_df.loc[idx]
     representative_genes_dict = representative_genes.set_index('qseqid')['bitscore'].to_dict()
 
     return representative_genes_dict
 
+def cluster_codes(gene_dict, *columns):
+    '''
+    Maps columns of gene ids to integer cluster codes in bulk
+    :param gene_dict: ClusterAssignments or dictionary of gene -> cluster number
+    :param columns: pandas Series of gene ids
+    :return: list of numpy arrays of cluster codes, -1 for genes without a cluster
+    '''
+    if isinstance(gene_dict, ClusterAssignments):
+        return [gene_dict.lookup(column) for column in columns]
+
+    genes = pd.Index(list(gene_dict.keys()))
+    clusters = np.fromiter(gene_dict.values(), dtype=np.int64, count=len(gene_dict))
+    # get_indexer returns -1 for missing genes, which picks up the trailing sentinel
+    clusters = np.append(clusters, -1)
+
+    codes = []
+    for column in columns:
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # Look up each distinct id once, then expand through the categorical codes
+            category_clusters = np.append(clusters[genes.get_indexer(column.cat.categories)], -1)
+            codes.append(category_clusters[column.cat.codes.to_numpy()])
+        else:
+            codes.append(clusters[genes.get_indexer(column)])
+    return codes
+
+def same_cluster_mask(df, gene_dict):
+    query_clusters, subject_clusters = cluster_codes(gene_dict, df["qseqid"], df["sseqid"])
+    return (query_clusters == subject_clusters) & (query_clusters != -1)
+
 @running_message
-def analyze(df, gene_dict, outdir):
-    def filter(row):
-        try:
-            if gene_dict[row["qseqid"]] == gene_dict[row["sseqid"]]:
-                return True
-            else:
-                return False
-        except:
-            return False
-    
+def analyze(df, gene_dict, outdir, sources=(), plots=True):
     path_to_same_cluster = f"{outdir}/same_cluster.tsv"
     path_to_opposite_cluster = f"{outdir}/opposite_cluster.tsv"
+    stage = dict(inputs=list(sources), outputs=[path_to_same_cluster, path_to_opposite_cluster])
 
-    if exists(path_to_same_cluster) and exists(path_to_opposite_cluster):
+    if stage_current("analyze", **stage):
         print("Output file already exists, using existing file\n\n")
         same_cluster = pd.read_csv(path_to_same_cluster, sep="\t")
         opposite_cluster = pd.read_csv(path_to_opposite_cluster, sep="\t")
     else:
-        mask = df.apply(filter, axis=1)
+        mask = same_cluster_mask(df, gene_dict)
 
         same_cluster = df[mask]
         opposite_cluster = df[~mask]
 
-        same_cluster.to_csv(path_to_same_cluster, sep="\t", index=False)
-        opposite_cluster.to_csv(path_to_opposite_cluster, sep="\t", index=False)
+        write_tsv_chunks(same_cluster, f"{path_to_same_cluster}.tmp")
+        write_tsv_chunks(opposite_cluster, f"{path_to_opposite_cluster}.tmp")
+        replace(f"{path_to_same_cluster}.tmp", path_to_same_cluster)
+        replace(f"{path_to_opposite_cluster}.tmp", path_to_opposite_cluster)
+        record_stage("analyze", **stage)
     
-    new_dir = f"{outdir}/graphics"
+    if plots:
+        new_dir = f"{outdir}/graphics"
 
-    makedirs(new_dir, exist_ok=True)
-    graphics(same_cluster, opposite_cluster, new_dir)
+        makedirs(new_dir, exist_ok=True)
+        graphics(same_cluster, opposite_cluster, new_dir)
     
     print("Finding representative genes")
     return find_representative_gene(same_cluster, gene_dict)
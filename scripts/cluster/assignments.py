@@ -0,0 +1,138 @@
+from collections.abc import Mapping
+import pandas as pd
+import numpy as np
+import json
+import os
+
+PARSE_CHUNK_SIZE = 1000000
+
+def encode_ids(genes):
+    '''
+    Converts gene ids to a fixed-width utf-8 bytes array
+    '''
+    if isinstance(genes, np.ndarray) and genes.dtype.kind == "S":
+        return genes
+    encoded = pd.Series(genes, dtype=object, copy=False).str.encode("utf-8").to_numpy()
+    return encoded.astype("S") if len(encoded) else np.zeros(0, dtype="S1")
+
+class ClusterAssignments(Mapping):
+    '''
+    Read-only gene -> cluster number mapping held as a sorted array of interned ids and an int32 array of
+    cluster numbers, about the size of the ids themselves instead of two dictionaries of Python strings
+    '''
+    def __init__(self, ids, clusters):
+        '''
+        :param ids: sorted, unique bytes array of gene ids
+        :param clusters: int32 cluster number of each id
+        '''
+        self.ids = ids
+        self.clusters = clusters
+
+    @classmethod
+    def from_arrays(cls, genes, clusters):
+        '''
+        Builds the mapping from unsorted genes and their clusters, a repeated gene keeps its last cluster like a dict
+        '''
+        genes = encode_ids(genes)
+        order = np.argsort(genes, kind="stable")
+        genes, clusters = genes[order], np.asarray(clusters, dtype=np.int32)[order]
+        last = np.ones(len(genes), dtype=bool)
+        last[:-1] = genes[1:] != genes[:-1]
+        return cls(genes[last], clusters[last])
+
+    @classmethod
+    def from_mcl_output(cls, mcl_output):
+        '''
+        Stream-parses MCL output, numbering the clusters of two or more genes from 1 in file order
+        '''
+        gene_chunks, cluster_chunks = [], []
+        genes, sizes = [], []
+        first_cluster = cluster_num = 1
+        with open(mcl_output, "rb") as clusters:
+            for line in clusters:
+                if b"\t" not in line:
+                    continue
+                members = line.strip().split(b"\t")
+                genes.extend(members)
+                sizes.append(len(members))
+                cluster_num += 1
+                if len(genes) >= PARSE_CHUNK_SIZE:
+                    gene_chunks.append(np.array(genes, dtype="S"))
+                    cluster_chunks.append(np.repeat(np.arange(first_cluster, cluster_num, dtype=np.int32), sizes))
+                    genes, sizes, first_cluster = [], [], cluster_num
+        gene_chunks.append(np.array(genes, dtype="S") if genes else np.zeros(0, dtype="S1"))
+        cluster_chunks.append(np.repeat(np.arange(first_cluster, cluster_num, dtype=np.int32), sizes))
+        return cls.from_arrays(np.concatenate(gene_chunks), np.concatenate(cluster_chunks))
+
+    def positions(self, genes):
+        '''
+        Finds genes in the id table
+        :param genes: sequence of gene ids
+        :return: numpy array of positions, -1 for genes without a cluster
+        '''
+        genes = encode_ids(genes)
+        if len(self.ids) == 0:
+            return np.full(len(genes), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, genes), len(self.ids) - 1)
+        return np.where(self.ids[positions] == genes, positions, -1)
+
+    def lookup(self, genes):
+        '''
+        Maps a column of gene ids to cluster numbers in bulk, resolving each category of a categorical once
+        :param genes: pandas Series or sequence of gene ids
+        :return: numpy array of cluster numbers, -1 for genes without a cluster
+        '''
+        if isinstance(getattr(genes, "dtype", None), pd.CategoricalDtype):
+            category_clusters = np.append(self.lookup(genes.cat.categories), -1)
+            return category_clusters[genes.cat.codes.to_numpy()]
+        positions = self.positions(genes)
+        clusters = np.full(len(positions), -1, dtype=np.int32)
+        found = positions >= 0
+        clusters[found] = self.clusters[positions[found]]
+        return clusters
+
+    def __getitem__(self, gene):
+        position = self.positions([gene])[0]
+        if position < 0:
+            raise KeyError(gene)
+        return int(self.clusters[position])
+
+    def __contains__(self, gene):
+        return self.positions([gene])[0] >= 0
+
+    def __iter__(self):
+        for gene in self.ids:
+            yield gene.decode()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, outdir):
+        os.makedirs(outdir, exist_ok=True)
+        np.save(f"{outdir}/ids.npy", self.ids)
+        np.save(f"{outdir}/clusters.npy", self.clusters)
+        # The metadata is written last, so an interrupted save is redone on the next run
+        with open(f"{outdir}/assignments.json.tmp", "w") as meta:
+            json.dump({"genes": len(self.ids), "clusters": int(self.clusters.max(initial=0))}, meta)
+        os.replace(f"{outdir}/assignments.json.tmp", f"{outdir}/assignments.json")
+
+    @classmethod
+    def load(cls, outdir):
+        return cls(np.load(f"{outdir}/ids.npy", mmap_mode="r"), np.load(f"{outdir}/clusters.npy", mmap_mode="r"))
+
+def assignments_dir(mcl_output):
+    return f"{os.path.splitext(mcl_output)[0]}_assignments"
+
+def cluster_assignments(mcl_output):
+    '''
+    Loads the saved assignments of an MCL output, parsing and saving them first if they are missing or older
+    :param mcl_output: MCL output file
+    :return: ClusterAssignments
+    '''
+    saved = assignments_dir(mcl_output)
+    meta_path = f"{saved}/assignments.json"
+    if os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(mcl_output):
+        return ClusterAssignments.load(saved)
+    assignments = ClusterAssignments.from_mcl_output(mcl_output)
+    assignments.save(saved)
+    return assignments
@@ -1,9 +1,16 @@
-from scripts.utils import running_message, read_fasta, write_fasta, read_lines, pd_read_csv
+from scripts.utils import running_message, run_command, fetch_fasta_records, write_fasta, copy_input
 from scripts.cluster.analyze import analyze
-from subprocess import run
-from math import log10
+from scripts.cluster.assignments import cluster_assignments
+from scripts.cluster.components import prune_graph, mcl_components
+from scripts.cluster.dedup import collapse_duplicates, expand_duplicates
+from scripts.cluster.inflation_sweep import inflation_sweep
+from scripts.cluster.intern_ids import intern_fasta, restore_names, write_mcl_matrix, mcl_matrix
+from scripts.cluster.hit_cache import build_hit_cache, load_hits
+from scripts.cluster.native_mcl import native_mcl
+from scripts.manifest import stage_current, record_stage
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
 import os
 
 @running_message
@@ -19,93 +26,187 @@ def diamond(input, database, tsv_path, bitscore, threads, sensitivity=1):
     if not sensitivity in sensitivity_types:
         raise ValueError("Sensitivity should be between 0 and 4")
     
-    if not os.path.exists(tsv_path):
-        cmd = f"diamond blastp {sensitivity_types[sensitivity]} -q {input} -d {database} --log --min-score {bitscore} -o {tsv_path} --outfmt 6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen qcovhsp ppos --threads {threads}"
-        run(cmd, shell=True)
+    stage = dict(inputs=[input, f"{database}.dmnd"], outputs=[tsv_path], params={"bitscore": bitscore, "sensitivity": sensitivity}, tool="diamond")
+    if not stage_current("diamond", **stage):
+        cmd = f"diamond blastp {sensitivity_types[sensitivity]} -q {input} -d {database} --log --min-score {bitscore} -o {tsv_path}.tmp --outfmt 6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen qcovhsp ppos --threads {threads}"
+        run_command(cmd)
+        os.replace(f"{tsv_path}.tmp", tsv_path)
+        record_stage("diamond", **stage)
     else: 
         print("TSV file already exists, using existing file")
 
 @running_message
-def makedb(input, database):
-    if not os.path.exists(f"{database}.dmnd"):
-        cmd=f"diamond makedb --in {input} -d {database}"
-        run(cmd, shell=True)
+def makedb(input, database, stage_name="makedb"):
+    stage = dict(inputs=[input], outputs=[f"{database}.dmnd"], tool="diamond")
+    if not stage_current(stage_name, **stage):
+        cmd=f"diamond makedb --in {input} -d {database}.tmp"
+        run_command(cmd)
+        os.replace(f"{database}.tmp.dmnd", f"{database}.dmnd")
+        record_stage(stage_name, **stage)
     else:
         print("Database already exists, using existing database")
 
 @running_message 
 def mcl(input, output, inflation, threads):
-    if not os.path.exists(output):
-        cmd = f"mcl {input} --abc -I {inflation} -o {output} -te {threads}"
-        run(cmd, shell=True)
+    stage = dict(inputs=[input], outputs=[output], params={"mode": "abc", "inflation": inflation}, tool="mcl")
+    if not stage_current("mcl", **stage):
+        cmd = f"mcl {input} --abc -I {inflation} -o {output}.tmp -te {threads}"
+        run_command(cmd)
+        os.replace(f"{output}.tmp", output)
+        record_stage("mcl", **stage)
+    else:
+        print("Output file already exists, using existing file")
+
+def mcl_edge_chunks(cache_dir, chunksize=1000000):
+    '''
+    Yields 'qseqid sseqid neglogeval' lines for MCL from a hit cache in bounded chunks
+    :param cache_dir: directory written by build_hit_cache
+    :param chunksize: number of hits converted at a time
+    :return: generator of encoded tsv chunks
+    '''
+    hits = load_hits(cache_dir, columns=["qseqid", "sseqid", "evalue"])
+    for start in tqdm(range(0, len(hits), chunksize), desc="Streaming edges to MCL", unit=" chunks"):
+        chunk = hits.iloc[start:start + chunksize]
+        evalue = chunk['evalue'].to_numpy()
+        edges = pd.DataFrame({
+            "qseqid": chunk['qseqid'],
+            "sseqid": chunk['sseqid'],
+            "neglogeval": -np.log10(np.where(evalue > 0, evalue, 1e-300))
+        })
+        yield edges.to_csv(sep='\t', header=False, index=False).encode()
+
+@running_message
+def mcl_stream(cache_dir, output, inflation, threads):
+    cache_files = [f"{cache_dir}/{column}.bin" for column in ["qseqid", "sseqid", "evalue"]] + [f"{cache_dir}/ids.txt"]
+    stage = dict(inputs=cache_files, outputs=[output], params={"mode": "stream", "inflation": inflation}, tool="mcl")
+    if not stage_current("mcl", **stage):
+        cmd = ["mcl", "-", "--abc", "-I", str(inflation), "-o", f"{output}.tmp", "-te", str(threads)]
+        run_command(cmd, stdin_chunks=mcl_edge_chunks(cache_dir))
+        os.replace(f"{output}.tmp", output)
+        record_stage("mcl", **stage)
     else:
         print("Output file already exists, using existing file")
 
 @running_message
 def parsing_clusters(mcl_output):
-    cluster_lines = read_lines(mcl_output)
-    
-    id=1
-    clust_dict = {}
-    for line in cluster_lines:
-        if "\t" in line:
-            clust_dict[id] = line.strip().split("\t")
-            id+=1
-            
-    gene_dict = {}
-    for clust_num in tqdm(clust_dict, desc="Parsing clusters", unit="clusters"):
-        for gene in clust_dict[clust_num]:
-            gene_dict[gene] = clust_num
-            
-    
-    return gene_dict
+    '''
+    Maps every gene of a cluster of two or more genes to its cluster number, counting from 1 in file order
+    :param mcl_output: MCL output file
+    :return: ClusterAssignments, saved next to mcl_output for reuse
+    '''
+    return cluster_assignments(mcl_output)
 
 
-def cluster(input: str, outdir: str, threads: int, sensitivity: int)->None:
+def cluster(input: str, outdir: str, threads: int, sensitivity: int, native=False, mcl_prune=1e-4, mcl_select=1100, stream=False, intern_ids=False, dedup=False, top_k=None, min_qcovhsp=0.0, min_pident=0.0, component_mcl=False, inflation=None, sweep_inflation=None)->None:
     '''
     Cluster proteins using MCL
     :param input: input fasta file
     :param outdir: output directory
     :param threads: number of threads
-    :param perform_analysis: whether to perform the analysis step
+    :param native: cluster with the in-process sparse MCL instead of the mcl binary
+    :param mcl_prune: pruning threshold of the in-process MCL
+    :param mcl_select: maximum entries per column kept by the in-process MCL
+    :param stream: feed edges to the mcl binary through stdin instead of writing mcl_input.tsv, analyze still loads the whole hit table
+    :param intern_ids: search and cluster integer protein ids, mapping names back only in the outputs
+    :param dedup: search and cluster one protein per distinct sequence, then expand the clusters to all proteins
+    :param top_k: keep at most this many hits per protein as MCL edges
+    :param min_qcovhsp: minimum query coverage of an MCL edge
+    :param min_pident: minimum identity of an MCL edge
+    :param component_mcl: cluster connected components separately, running mcl in parallel on the larger ones
+    :param inflation: MCL inflation, 1.3 by default
+    :param sweep_inflation: list of inflations to cluster the graph at instead, writing inflation_sweep/summary.tsv
     :return: None
     '''
 
     os.makedirs(outdir, exist_ok=True)
+    if inflation is None:
+        inflation = 1.3
     
     fasta_path = f"{outdir}/input.fasta"
-    if not os.path.exists(fasta_path):
-        run(f"cp {input} {fasta_path}", shell=True)
+    copy_input(input, fasta_path)
+    
+    search_input = input
+    if dedup:
+        # Identical sequences are searched once, their duplicates rejoin after clustering
+        search_input = f"{outdir}/unique.fasta"
+        members_path = f"{outdir}/duplicate_members.tsv"
+        collapse_duplicates(fasta_path, search_input, members_path)
+    if intern_ids:
+        # DIAMOND and MCL only ever see dense integer ids
+        id_table = f"{outdir}/input.ids.tab"
+        intern_fasta(search_input if dedup else fasta_path, f"{outdir}/input.interned.fasta", id_table)
+        search_input = f"{outdir}/input.interned.fasta"
     
     # Make database for diamond
     database_path = f"{outdir}/database"
-    makedb(input, database_path)
+    makedb(search_input, database_path)
     
     # Run diamond
     tsv_path = f"{outdir}/diamond.tsv"
-    diamond(input, database_path, tsv_path, 50, threads, sensitivity)
+    diamond(search_input, database_path, tsv_path, 50, threads, sensitivity)
     
-    # Read pd dataframe from tsv
-    columns = ["qseqid", "sseqid", "pident", "length", "mismatch", "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore", "qlen", "slen", "qcovhsp", "ppos"]
-    df = pd_read_csv(tsv_path, sep="\t", names=columns)
+    # Convert the tsv once into binary columns and load them memory-mapped
+    cache_dir = build_hit_cache(tsv_path, f"{outdir}/diamond_cache")
+    df = load_hits(cache_dir)
+    if intern_ids:
+        names, category_ids = restore_names(df, id_table)
     
     # Prepare for MCL
-    df['evalue'] = df['evalue'].apply(lambda x: x if x > 0 else 1e-300)
-    df["neglogeval"] = df['evalue'].apply(lambda x: -log10(x))
+    evalue = df['evalue'].to_numpy()
+    df['evalue'] = np.where(evalue > 0, evalue, 1e-300)
+    df["neglogeval"] = -np.log10(df['evalue'])
+    
+    # Pruning only thins the MCL graph, analyze still sees every hit
+    graph_params = {"top_k": top_k, "min_qcovhsp": min_qcovhsp, "min_pident": min_pident}
+    graph_df = df
+    if top_k or min_qcovhsp or min_pident:
+        graph_df = df[prune_graph(df, top_k, min_qcovhsp, min_pident)]
+        print(f"Kept {len(graph_df)} of {len(df)} hits as MCL edges")
     
-    mcl_input = f"{outdir}/mcl_input.tsv"
-    mcl_df = df[["qseqid", "sseqid", "neglogeval"]]
-    mcl_df.to_csv(mcl_input, sep='\t', header=False, index=False)
+    if sweep_inflation:
+        # One loaded graph, clustered at every inflation
+        inflation_sweep(df, graph_df, sweep_inflation, f"{outdir}/inflation_sweep", threads, sources=[tsv_path], native=native, mcl_prune=mcl_prune, mcl_select=mcl_select, graph_params=graph_params)
+        return
     
-    # Cluster using MCL
-    mcl(mcl_input, f"{outdir}/mcl_output.txt", 1.3, threads)
-    gene_dict = parsing_clusters(f"{outdir}/mcl_output.txt")
+    mcl_output = f"{outdir}/mcl_output.txt"
+    clusters_output = f"{outdir}/mcl_output.unique.txt" if dedup else mcl_output
+    if native:
+        # Cluster the in-memory graph without a text round-trip
+        stage = dict(inputs=[tsv_path], outputs=[clusters_output], params={"mode": "native", "inflation": inflation, "prune": mcl_prune, "select": mcl_select, **graph_params})
+        if not stage_current("mcl", **stage):
+            native_mcl(graph_df, clusters_output, inflation, threads, mcl_prune, mcl_select)
+            record_stage("mcl", **stage)
+        else:
+            print("Output file already exists, using existing file")
+    elif component_mcl:
+        stage = dict(inputs=[tsv_path], outputs=[clusters_output], params={"mode": "components", "inflation": inflation, **graph_params}, tool="mcl")
+        if not stage_current("mcl", **stage):
+            mcl_components(graph_df, clusters_output, inflation, threads, f"{outdir}/mcl_components")
+            record_stage("mcl", **stage)
+        else:
+            print("Output file already exists, using existing file")
+    elif stream:
+        mcl_stream(cache_dir, clusters_output, inflation, threads)
+    elif intern_ids:
+        # A native matrix over the integer ids skips mcl's label parsing, the tab file names the clusters
+        mcl_matrix_path = f"{outdir}/mcl_input.mcx"
+        write_mcl_matrix(category_ids[graph_df["qseqid"].cat.codes.to_numpy()], category_ids[graph_df["sseqid"].cat.codes.to_numpy()], graph_df["neglogeval"].to_numpy(), len(names), mcl_matrix_path)
+        mcl_matrix(mcl_matrix_path, id_table, clusters_output, inflation, threads)
+    else:
+        mcl_input = f"{outdir}/mcl_input.tsv"
+        mcl_df = graph_df[["qseqid", "sseqid", "neglogeval"]]
+        mcl_df.to_csv(mcl_input, sep='\t', header=False, index=False)
+        
+        # Cluster using MCL
+        mcl(mcl_input, clusters_output, inflation, threads)
+    if dedup:
+        expand_duplicates(clusters_output, members_path, mcl_output)
+    gene_dict = parsing_clusters(mcl_output)
     
-    rep_gene_score_dict=analyze(df, gene_dict, outdir)
+    rep_gene_score_dict=analyze(df, gene_dict, outdir, sources=[tsv_path, mcl_output])
     
     # Write representative genes to a fasta file
-    record_list = read_fasta(input)
-    record_dict = {record.id: record for record in record_list}
+    record_dict = fetch_fasta_records(fasta_path, rep_gene_score_dict)
     
     rep_gene_list = []
     for rep_gene in tqdm(rep_gene_score_dict, desc="Getting reps from fasta", unit="genes"):
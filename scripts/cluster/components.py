@@ -0,0 +1,101 @@
+from scripts.utils import running_message, run_command, run_jobs
+from scripts.cluster.native_mcl import edge_codes
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import pandas as pd
+import numpy as np
+import heapq
+import os
+
+def prune_graph(df, top_k=None, min_qcovhsp=0, min_pident=0):
+    '''
+    Selects the hits that become MCL edges
+    :param df: hit dataframe
+    :param top_k: keep at most this many hits per query, best bitscore first, self hits are always kept
+    :param min_qcovhsp: minimum query coverage of a hit
+    :param min_pident: minimum identity of a hit
+    :return: boolean mask over the hits
+    '''
+    mask = (df['qcovhsp'].to_numpy() >= min_qcovhsp) & (df['pident'].to_numpy() >= min_pident)
+    if not top_k:
+        return mask
+
+    query_codes, subject_codes, _ = edge_codes(df)
+    candidates = np.flatnonzero(mask & (query_codes != subject_codes))
+    order = candidates[np.lexsort((-df['bitscore'].to_numpy()[candidates], query_codes[candidates]))]
+    queries = query_codes[order]
+    # Rank of every hit within its query
+    group_starts = np.flatnonzero(np.diff(queries, prepend=-1))
+    ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+
+    pruned = mask & (query_codes == subject_codes)
+    pruned[order[ranks < top_k]] = True
+    return pruned
+
+def balance_components(component_edges, n_batches):
+    '''
+    Spreads components over batches, largest first onto the lightest batch
+    :param component_edges: number of edges of each component
+    :return: batch number of each component
+    '''
+    batches = np.zeros(len(component_edges), dtype=np.int64)
+    loads = [(0, batch) for batch in range(n_batches)]
+    for component in np.argsort(-component_edges, kind="stable"):
+        load, batch = heapq.heappop(loads)
+        batches[component] = batch
+        heapq.heappush(loads, (load + component_edges[component], batch))
+    return batches
+
+@running_message
+def mcl_components(df, output, inflation, threads, workdir):
+    '''
+    Splits the hit graph into connected components, clusters components of one or two proteins directly and
+    runs mcl on the larger ones in parallel batches, then merges everything into one MCL output
+    :param df: hit dataframe with neglogeval weights
+    :param output: merged MCL output, clusters from largest to smallest
+    :param inflation: MCL inflation
+    :param threads: number of threads
+    :param workdir: directory for the batch inputs and outputs
+    :return: None
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    query_codes, subject_codes, labels = edge_codes(df)
+    # Pruned hit tables keep every category, only proteins left on an edge are nodes of the graph
+    present, codes = np.unique(np.concatenate([query_codes, subject_codes]), return_inverse=True)
+    query_codes, subject_codes, labels = codes[:len(df)], codes[len(df):], labels[present]
+    n_nodes = len(labels)
+    graph = coo_matrix((np.ones(len(query_codes)), (query_codes, subject_codes)), shape=(n_nodes, n_nodes))
+    n_components, components = connected_components(graph, directed=False)
+    sizes = np.bincount(components, minlength=n_components)
+
+    # Components of one or two proteins are their own cluster, MCL cannot split them
+    clusters = pd.Series(labels).groupby(components).agg(list)
+    clusters = list(clusters[sizes[clusters.index] <= 2])
+
+    large = sizes > 2
+    edge_components = components[query_codes]
+    component_edges = np.bincount(edge_components[large[edge_components]], minlength=n_components)[large]
+    n_batches = min(int(large.sum()), threads)
+    if n_batches:
+        component_batch = np.full(n_components, -1)
+        component_batch[np.flatnonzero(large)] = balance_components(component_edges, n_batches)
+        edge_batches = component_batch[edge_components]
+
+        jobs = []
+        for batch in range(n_batches):
+            batch_input = f"{workdir}/batch_{batch}.abc"
+            batch_output = f"{workdir}/batch_{batch}.mcl"
+            df[["qseqid", "sseqid", "neglogeval"]][edge_batches == batch].to_csv(batch_input, sep='\t', header=False, index=False)
+            jobs.append(lambda job_threads, batch_input=batch_input, batch_output=batch_output: run_command(
+                f"mcl {batch_input} --abc -I {inflation} -o {batch_output} -te {job_threads}"))
+        print(f"Clustering {int(large.sum())} components in {n_batches} batches, {n_components - int(large.sum())} components of one or two proteins need no MCL")
+        run_jobs(jobs, threads, desc="Clustering graph components")
+
+        for batch in range(n_batches):
+            with open(f"{workdir}/batch_{batch}.mcl") as batch_output:
+                clusters.extend(line.rstrip("\n").split("\t") for line in batch_output if line.strip())
+
+    clusters.sort(key=len, reverse=True)
+    with open(f"{output}.tmp", "w") as out:
+        out.writelines("\t".join(members) + "\n" for members in clusters)
+    os.replace(f"{output}.tmp", output)
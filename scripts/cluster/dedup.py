@@ -0,0 +1,72 @@
+from scripts.utils import running_message, iter_fasta_records
+from scripts.manifest import stage_current, record_stage
+from tqdm import tqdm
+import hashlib
+import os
+
+@running_message
+def collapse_duplicates(fasta_path, unique_path, members_path):
+    '''
+    Keeps the first protein of every exact (case-insensitive) sequence
+    :param fasta_path: input fasta
+    :param unique_path: fasta of the first protein of every distinct sequence
+    :param members_path: tsv of 'representative\tduplicate' lines for the proteins that were collapsed
+    :return: None
+    '''
+    stage = dict(inputs=[fasta_path], outputs=[unique_path, members_path])
+    if stage_current("dedup", **stage):
+        print("Unique fasta already exists, using existing file")
+        return
+
+    representatives = {}
+    n_proteins = 0
+    with open(f"{unique_path}.tmp", "w") as unique, open(f"{members_path}.tmp", "w") as members:
+        for protein, header, lines in tqdm(iter_fasta_records(fasta_path), desc="Collapsing duplicate sequences", unit=" proteins"):
+            n_proteins += 1
+            digest = hashlib.blake2b("".join(line.strip() for line in lines).upper().encode(), digest_size=16).digest()
+            representative = representatives.setdefault(digest, protein)
+            if representative == protein:
+                unique.write(header)
+                unique.writelines(lines)
+            else:
+                members.write(f"{representative}\t{protein}\n")
+    os.replace(f"{unique_path}.tmp", unique_path)
+    os.replace(f"{members_path}.tmp", members_path)
+    print(f"{len(representatives)} unique sequences among {n_proteins} proteins")
+    record_stage("dedup", **stage)
+
+def read_members(members_path):
+    '''
+    :return: dictionary of representative -> list of its collapsed duplicates
+    '''
+    members = {}
+    with open(members_path) as table:
+        for line in table:
+            representative, duplicate = line.rstrip("\n").split("\t")
+            members.setdefault(representative, []).append(duplicate)
+    return members
+
+@running_message
+def expand_duplicates(unique_output, members_path, mcl_output):
+    '''
+    Writes MCL output of the unique sequences back over all proteins: duplicates join the cluster of their
+    representative, and representatives MCL did not report form a cluster with their duplicates
+    :param unique_output: MCL output of the unique sequences
+    :param members_path: member table written by collapse_duplicates
+    :param mcl_output: expanded MCL output
+    :return: None
+    '''
+    stage = dict(inputs=[unique_output, members_path], outputs=[mcl_output])
+    if stage_current("expand_duplicates", **stage):
+        print("Output file already exists, using existing file")
+        return
+
+    members = read_members(members_path)
+    with open(unique_output) as clusters, open(f"{mcl_output}.tmp", "w") as out:
+        for line in clusters:
+            genes = line.rstrip("\n").split("\t")
+            out.write("\t".join(genes + [duplicate for gene in genes for duplicate in members.pop(gene, [])]) + "\n")
+        for representative, duplicates in members.items():
+            out.write("\t".join([representative] + duplicates) + "\n")
+    os.replace(f"{mcl_output}.tmp", mcl_output)
+    record_stage("expand_duplicates", **stage)
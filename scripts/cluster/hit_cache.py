@@ -0,0 +1,103 @@
+from scripts.utils import running_message
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import json
+import os
+
+DIAMOND_COLUMNS = ["qseqid", "sseqid", "pident", "length", "mismatch", "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore", "qlen", "slen", "qcovhsp", "ppos"]
+
+# evalue stays float64: DIAMOND reports values far below the float32 range
+COLUMN_TYPES = {
+    "qseqid": "int32",
+    "sseqid": "int32",
+    "pident": "float32",
+    "length": "int32",
+    "mismatch": "int32",
+    "gapopen": "int32",
+    "qstart": "int32",
+    "qend": "int32",
+    "sstart": "int32",
+    "send": "int32",
+    "evalue": "float64",
+    "bitscore": "float32",
+    "qlen": "int32",
+    "slen": "int32",
+    "qcovhsp": "float32",
+    "ppos": "float32"
+}
+
+@running_message
+def build_hit_cache(tsv_path, cache_dir, chunksize=1000000):
+    '''
+    Converts a DIAMOND tsv once into binary columns with dictionary encoded sequence ids
+    :param tsv_path: DIAMOND output in --outfmt 6 with DIAMOND_COLUMNS
+    :param cache_dir: directory holding the binary columns
+    :param chunksize: number of rows parsed at a time
+    :return: cache_dir
+    '''
+    meta_path = f"{cache_dir}/columns.json"
+    if os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(tsv_path):
+        print("Hit cache already exists, using existing cache")
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    text_columns = {column: "float64" if column == "evalue" else "str" for column in ["qseqid", "sseqid", "evalue"]}
+    numeric_types = {column: dtype for column, dtype in COLUMN_TYPES.items() if column not in text_columns}
+
+    id_codes = {}
+    rows = 0
+    handles = {column: open(f"{cache_dir}/{column}.bin", "wb") for column in DIAMOND_COLUMNS}
+    try:
+        reader = pd.read_csv(tsv_path, sep="\t", names=DIAMOND_COLUMNS, dtype={**text_columns, **numeric_types}, chunksize=chunksize)
+        for chunk in tqdm(reader, desc=f"Caching {tsv_path}", unit=" chunks"):
+            # Factorize the chunk locally, then only map the chunk's distinct ids to global codes
+            local_codes, uniques = pd.factorize(pd.concat([chunk["qseqid"], chunk["sseqid"]], ignore_index=True))
+            global_codes = np.array([id_codes.setdefault(seq_id, len(id_codes)) for seq_id in uniques], dtype=np.int32)
+            codes = global_codes[local_codes]
+            codes[:len(chunk)].tofile(handles["qseqid"])
+            codes[len(chunk):].tofile(handles["sseqid"])
+
+            for column in DIAMOND_COLUMNS[2:]:
+                chunk[column].to_numpy(dtype=COLUMN_TYPES[column]).tofile(handles[column])
+            rows += len(chunk)
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    with open(f"{cache_dir}/ids.txt", "w") as ids_file:
+        for seq_id in id_codes:
+            ids_file.write(f"{seq_id}\n")
+
+    # The metadata is written last, so an interrupted conversion is redone on the next run
+    with open(f"{meta_path}.tmp", "w") as meta:
+        json.dump({"rows": rows, "columns": COLUMN_TYPES}, meta)
+    os.replace(f"{meta_path}.tmp", meta_path)
+    return cache_dir
+
+def read_cache_ids(cache_dir):
+    with open(f"{cache_dir}/ids.txt") as ids_file:
+        return pd.Index([line.rstrip("\n") for line in ids_file])
+
+def load_hits(cache_dir, columns=None):
+    '''
+    Loads a hit cache with memory-mapped numeric columns and categorical sequence ids
+    :param cache_dir: directory written by build_hit_cache
+    :param columns: subset of columns to load, defaults to all
+    :return: dataframe of hits
+    '''
+    with open(f"{cache_dir}/columns.json") as meta:
+        meta = json.load(meta)
+    rows = meta["rows"]
+    columns = columns or DIAMOND_COLUMNS
+
+    ids = None
+    data = {}
+    for column in columns:
+        values = np.memmap(f"{cache_dir}/{column}.bin", dtype=meta["columns"][column], mode="r", shape=(rows,)) if rows else np.zeros(0, dtype=meta["columns"][column])
+        if column in ("qseqid", "sseqid"):
+            if ids is None:
+                ids = read_cache_ids(cache_dir)
+            values = pd.Categorical.from_codes(values, categories=ids, validate=False)
+        data[column] = values
+    return pd.DataFrame(data, copy=False)
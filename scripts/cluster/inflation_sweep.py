@@ -0,0 +1,110 @@
+from scripts.utils import running_message, run_command, run_jobs
+from scripts.manifest import stage_current, record_stage
+from scripts.cluster.analyze import same_cluster_mask
+from scripts.cluster.assignments import cluster_assignments
+from scripts.cluster.intern_ids import write_mcl_matrix
+from scripts.cluster.native_mcl import edge_codes, native_mcl
+import pandas as pd
+import numpy as np
+import os
+
+def inflation_key(inflation):
+    '''
+    Names an inflation in files and stages, repr keeps every digit so close values never share a name
+    '''
+    return repr(float(inflation))
+
+def sweep_output(sweep_dir, inflation):
+    return f"{sweep_dir}/mcl_output_I{inflation_key(inflation)}.txt"
+
+def cluster_summary(df, mcl_output, n_genes):
+    '''
+    Summarizes one clustering of the sweep
+    :param df: full hit dataframe
+    :param mcl_output: MCL output file
+    :param n_genes: number of genes in the graph
+    :return: dictionary of cluster count, size distribution and same/opposite cluster hit fractions
+    '''
+    assignments = cluster_assignments(mcl_output)
+    # Clusters are numbered from 1, genes outside clusters of two or more are singletons
+    sizes = np.bincount(assignments.clusters)[1:]
+    sizes = sizes[sizes > 0]
+    same = same_cluster_mask(df, assignments)
+    return {
+        "clusters": len(sizes),
+        "clustered_genes": int(sizes.sum()),
+        "singletons": n_genes - int(sizes.sum()),
+        "median_size": float(np.median(sizes)) if len(sizes) else 0.0,
+        "mean_size": float(sizes.mean()) if len(sizes) else 0.0,
+        "max_size": int(sizes.max(initial=0)),
+        "same_fraction": float(same.mean()) if len(same) else 0.0,
+        "opposite_fraction": float(1 - same.mean()) if len(same) else 0.0
+    }
+
+@running_message
+def inflation_sweep(df, graph_df, inflations, sweep_dir, threads, sources=(), native=False, mcl_prune=1e-4, mcl_select=1100, graph_params=None):
+    '''
+    Clusters one loaded hit graph at several MCL inflations in parallel and summarizes each clustering
+    :param df: full hit dataframe with neglogeval weights, used for the same/opposite cluster fractions
+    :param graph_df: hits used as MCL edges
+    :param inflations: list of MCL inflations
+    :param sweep_dir: output directory, one mcl_output_I<inflation>.txt per value plus summary.tsv
+    :param threads: number of threads shared by the clusterings
+    :param sources: files the graph was built from
+    :param native: cluster with the in-process sparse MCL instead of the mcl binary
+    :param mcl_prune: pruning threshold of the in-process MCL
+    :param mcl_select: maximum entries per column kept by the in-process MCL
+    :param graph_params: parameters the graph was built with
+    :return: summary DataFrame, one row per inflation
+    '''
+    os.makedirs(sweep_dir, exist_ok=True)
+    graph_params = graph_params or {}
+    inflations = sorted(set(map(float, inflations)))
+    query_codes, subject_codes, labels = edge_codes(graph_df)
+
+    if native:
+        stage_inputs = list(sources)
+        mode_params = {"mode": "native", "prune": mcl_prune, "select": mcl_select, **graph_params}
+    else:
+        # The graph is written once as a native matrix, every mcl run loads it without parsing labels
+        matrix_path = f"{sweep_dir}/graph.mcx"
+        id_table = f"{sweep_dir}/graph.tab"
+        stage = dict(inputs=list(sources), outputs=[matrix_path, id_table], params=graph_params)
+        if not stage_current("sweep_matrix", **stage):
+            with open(f"{id_table}.tmp", "w") as table:
+                table.writelines(f"{code}\t{label}\n" for code, label in enumerate(labels))
+            os.replace(f"{id_table}.tmp", id_table)
+            write_mcl_matrix(query_codes, subject_codes, graph_df["neglogeval"].to_numpy(), len(labels), matrix_path)
+            record_stage("sweep_matrix", **stage)
+        stage_inputs = [matrix_path, id_table]
+        mode_params = {"mode": "matrix"}
+
+    # Stages are checked and recorded here, the jobs only cluster, so the manifest is never written concurrently
+    jobs, pending = [], []
+    for inflation in inflations:
+        output = sweep_output(sweep_dir, inflation)
+        stage = dict(inputs=stage_inputs, outputs=[output], params={**mode_params, "inflation": inflation}, tool=None if native else "mcl")
+        if stage_current(f"mcl_I{inflation_key(inflation)}", **stage):
+            print(f"Clusters at inflation {inflation_key(inflation)} already exist, using existing file")
+            continue
+        if native:
+            jobs.append(lambda job_threads, inflation=inflation, output=output: native_mcl(graph_df, output, inflation, job_threads, mcl_prune, mcl_select))
+        else:
+            def job(job_threads, inflation=inflation, output=output):
+                run_command(f"mcl {matrix_path} -I {inflation} -use-tab {id_table} -o {output}.tmp -te {job_threads}")
+                os.replace(f"{output}.tmp", output)
+            jobs.append(job)
+        pending.append((f"mcl_I{inflation_key(inflation)}", stage))
+    run_jobs(jobs, threads, desc="Clustering inflations")
+    for name, stage in pending:
+        record_stage(name, **stage)
+
+    n_genes = len(edge_codes(df)[2])
+    summary = pd.DataFrame([
+        {"inflation": inflation, **cluster_summary(df, sweep_output(sweep_dir, inflation), n_genes)} for inflation in inflations
+    ])
+    summary_path = f"{sweep_dir}/summary.tsv"
+    summary.to_csv(f"{summary_path}.tmp", sep="\t", index=False)
+    os.replace(f"{summary_path}.tmp", summary_path)
+    print(summary.to_string(index=False))
+    return summary
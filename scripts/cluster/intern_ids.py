@@ -0,0 +1,110 @@
+from scripts.utils import running_message, run_command, fasta_header_id
+from scripts.manifest import stage_current, record_stage
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import os
+
+MATRIX_CHUNK_SIZE = 1000000
+
+@running_message
+def intern_fasta(fasta_path, interned_path, id_table):
+    '''
+    Renames the proteins of a fasta to dense integer ids, 0 to n-1 in file order
+    :param fasta_path: input fasta
+    :param interned_path: fasta with integer headers
+    :param id_table: mcl tab file of '<id>\t<protein name>' lines
+    :return: None
+    '''
+    stage = dict(inputs=[fasta_path], outputs=[interned_path, id_table])
+    if stage_current("intern_ids", **stage):
+        print("Interned fasta already exists, using existing file")
+        return
+
+    n_proteins = 0
+    with open(fasta_path) as fasta, open(f"{interned_path}.tmp", "w") as interned, open(f"{id_table}.tmp", "w") as table:
+        for line in tqdm(fasta, desc="Interning protein ids", unit=" lines"):
+            if line.startswith(">"):
+                table.write(f"{n_proteins}\t{fasta_header_id(line)}\n")
+                interned.write(f">{n_proteins}\n")
+                n_proteins += 1
+            else:
+                interned.write(line)
+    os.replace(f"{interned_path}.tmp", interned_path)
+    os.replace(f"{id_table}.tmp", id_table)
+    record_stage("intern_ids", **stage)
+
+def read_id_table(id_table):
+    '''
+    Reads an id table written by intern_fasta
+    :return: pandas Index of protein names, positioned by integer id
+    '''
+    table = pd.read_csv(id_table, sep="\t", names=["id", "name"], dtype={"id": np.int64, "name": str}, keep_default_na=False)
+    return pd.Index(table["name"].to_numpy()[np.argsort(table["id"].to_numpy())])
+
+def restore_names(df, id_table):
+    '''
+    Renames the integer ids of the categorical qseqid/sseqid columns of a hit table back to protein names,
+    only touching the categories
+    :return: (names, integer id of every category)
+    '''
+    names = read_id_table(id_table)
+    categories = df["qseqid"].cat.categories
+    ids = categories.astype(np.int64).to_numpy()
+    for column in ("qseqid", "sseqid"):
+        df[column] = df[column].cat.rename_categories(names[ids])
+    return names, ids
+
+@running_message
+def write_mcl_matrix(query_ids, subject_ids, weights, n_nodes, matrix_path):
+    '''
+    Writes a hit graph in mcl's native matrix format, keeping the heaviest weight per node pair in both directions
+    :param query_ids: integer id of the query of each hit
+    :param subject_ids: integer id of the subject of each hit
+    :param weights: edge weights
+    :param n_nodes: number of proteins
+    :param matrix_path: output matrix file
+    :return: None
+    '''
+    edges = pd.DataFrame({
+        "row": np.concatenate([query_ids, subject_ids]),
+        "col": np.concatenate([subject_ids, query_ids]),
+        "value": np.concatenate([weights, weights])
+    })
+    edges = edges.groupby(["row", "col"])["value"].max().reset_index()
+    rows, cols = edges["row"].to_numpy(), edges["col"].to_numpy()
+    tokens = (" " + edges["col"].astype(str) + ":" + edges["value"].map("{:.6g}".format)).to_numpy()
+
+    with open(f"{matrix_path}.tmp", "w") as matrix:
+        matrix.write(f"(mclheader\nmcltype matrix\ndimensions {n_nodes}x{n_nodes}\n)\n(mclmatrix\nbegin\n")
+        # Chunks end on row boundaries; each row is '<row> <col>:<value> ... $'
+        start = 0
+        while start < len(edges):
+            stop = min(start + MATRIX_CHUNK_SIZE, len(edges))
+            stop = np.searchsorted(rows, rows[stop - 1], side="right")
+            chunk_rows = rows[start:stop]
+            row_starts = np.flatnonzero(np.diff(chunk_rows, prepend=-1))
+            row_ordinals = np.cumsum(np.diff(chunk_rows, prepend=-1) != 0) - 1
+
+            pieces = np.empty(stop - start + 2 * len(row_starts), dtype=object)
+            pieces[np.arange(stop - start) + 2 * row_ordinals + 1] = tokens[start:stop]
+            pieces[row_starts + 2 * np.arange(len(row_starts))] = chunk_rows[row_starts].astype(str)
+            pieces[np.append(row_starts[1:], stop - start) + 2 * np.arange(len(row_starts)) + 1] = " $\n"
+            matrix.write("".join(pieces))
+            start = stop
+        matrix.write(")\n")
+    os.replace(f"{matrix_path}.tmp", matrix_path)
+
+@running_message
+def mcl_matrix(matrix_path, id_table, output, inflation, threads):
+    '''
+    Clusters a native mcl matrix, writing the clusters with the protein names of the id table
+    '''
+    stage = dict(inputs=[matrix_path, id_table], outputs=[output], params={"mode": "matrix", "inflation": inflation}, tool="mcl")
+    if not stage_current("mcl", **stage):
+        cmd = f"mcl {matrix_path} -I {inflation} -use-tab {id_table} -o {output}.tmp -te {threads}"
+        run_command(cmd)
+        os.replace(f"{output}.tmp", output)
+        record_stage("mcl", **stage)
+    else:
+        print("Output file already exists, using existing file")
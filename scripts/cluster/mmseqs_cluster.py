@@ -1,11 +1,10 @@
-from scripts.utils import running_message, pd_read_csv, read_fasta, write_fasta
-from subprocess import run
+from scripts.utils import running_message, pd_read_csv, fetch_fasta_records, write_fasta, copy_input
 from tqdm import tqdm
 import os
 from scripts.mmseqs_utils import mmseqs_makedb, mmseqs_cluster_cmd, mmseqs_createtsv
 
 @running_message
-def processing_cluster(tsv_path, input, outdir):
+def processing_cluster(tsv_path, fasta_path, outdir):
     columns = ["rep", "gene"]
     df = pd_read_csv(tsv_path, sep="\t", names=columns)
 
@@ -13,8 +12,7 @@ def processing_cluster(tsv_path, input, outdir):
 
     reps_to_keep = rep_gene_counts.index.to_list()
     
-    all_records = read_fasta(input)
-    record_dict = {record.id: record for record in tqdm(all_records, desc="Creating record dictionary", unit=" Records")}
+    record_dict = fetch_fasta_records(fasta_path, reps_to_keep)
     
     rep_records=[]
     for rep in tqdm(reps_to_keep, desc="Matching records to fasta", unit=" Reps"):
@@ -27,14 +25,13 @@ def mmseqs_cluster(input: str, outdir: str, threads: int, sensitivity: int)->Non
     os.makedirs(outdir, exist_ok=True)
     
     fasta_path = f"{outdir}/input.fasta"
-    if not os.path.exists(fasta_path):
-        run(f"cp {input} {fasta_path}", shell=True)
+    copy_input(input, fasta_path)
     
     db = mmseqs_makedb(input, outdir)
     cluster_output = mmseqs_cluster_cmd(db, outdir, threads, sensitivity)
     tsv_path = mmseqs_createtsv(db, cluster_output, outdir)
     
-    processing_cluster(tsv_path, input, outdir)
+    processing_cluster(tsv_path, fasta_path, outdir)
     
 
     
@@ -0,0 +1,146 @@
+from scripts.utils import running_message
+from scripts.cluster.assignments import ClusterAssignments
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csc_matrix, hstack
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import os
+
+def edge_codes(df):
+    '''
+    Maps the qseqid/sseqid columns of a hit table to node codes
+    :param df: hit dataframe
+    :return: query codes, subject codes and node labels
+    '''
+    if isinstance(df['qseqid'].dtype, pd.CategoricalDtype) and isinstance(df['sseqid'].dtype, pd.CategoricalDtype) and df['qseqid'].cat.categories.equals(df['sseqid'].cat.categories):
+        return df['qseqid'].cat.codes.to_numpy(), df['sseqid'].cat.codes.to_numpy(), df['qseqid'].cat.categories
+    codes, labels = pd.factorize(pd.concat([df['qseqid'], df['sseqid']], ignore_index=True))
+    return codes[:len(df)], codes[len(df):], labels
+
+def build_graph(query_codes, subject_codes, weights, n_nodes):
+    '''
+    Builds the symmetric, self-looped, column stochastic start matrix of MCL
+    '''
+    rows = np.concatenate([query_codes, subject_codes])
+    cols = np.concatenate([subject_codes, query_codes])
+    values = np.concatenate([weights, weights]).astype(np.float64)
+
+    # Keep the heaviest edge per node pair, as mcl does when symmetrizing abc input
+    edges = pd.DataFrame({"row": rows, "col": cols, "value": values})
+    edges = edges[edges["row"] != edges["col"]]
+    edges = edges.groupby(["row", "col"], sort=False)["value"].max().reset_index()
+
+    # Self loops get the heaviest edge weight of their node
+    loops = edges.groupby("col")["value"].max()
+    loop_weights = np.ones(n_nodes)
+    loop_weights[loops.index.to_numpy()] = loops.to_numpy()
+
+    matrix = csc_matrix((
+        np.concatenate([edges["value"].to_numpy(), loop_weights]),
+        (np.concatenate([edges["row"].to_numpy(), np.arange(n_nodes)]),
+         np.concatenate([edges["col"].to_numpy(), np.arange(n_nodes)]))),
+        shape=(n_nodes, n_nodes))
+    return normalize(matrix)
+
+def normalize(matrix):
+    column_sums = np.asarray(matrix.sum(axis=0)).ravel()
+    column_sums[column_sums == 0] = 1
+    matrix.data /= np.repeat(column_sums, np.diff(matrix.indptr))
+    return matrix
+
+def expand(matrix, threads):
+    if threads <= 1 or matrix.shape[1] < threads:
+        return matrix.dot(matrix).tocsc()
+    # Column blocks of the product are independent; sparse products release the GIL
+    bounds = np.linspace(0, matrix.shape[1], threads + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        blocks = pool.map(lambda b: matrix.dot(matrix[:, bounds[b]:bounds[b + 1]]), range(threads))
+        return hstack(list(blocks), format="csc")
+
+def prune(matrix, threshold, select):
+    '''
+    Removes entries below threshold and keeps at most select entries per column. The largest entry of every
+    column always survives, like mcl's recovery, so a column is never pruned empty
+    '''
+    counts = np.diff(matrix.indptr)
+    columns = np.repeat(np.arange(matrix.shape[1]), counts)
+    column_max = np.zeros(matrix.shape[1])
+    nonempty = counts > 0
+    column_max[nonempty] = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][nonempty])
+    matrix.data[(matrix.data < threshold) & (matrix.data < column_max[columns])] = 0
+    matrix.eliminate_zeros()
+
+    counts = np.diff(matrix.indptr)
+    if select and counts.max(initial=0) > select:
+        columns = np.repeat(np.arange(matrix.shape[1]), counts)
+        order = np.lexsort((-matrix.data, columns))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - matrix.indptr[columns[order]]
+        matrix.data[rank >= select] = 0
+        matrix.eliminate_zeros()
+    return matrix
+
+def chaos(matrix):
+    '''
+    Largest difference between a column maximum and its sum of squares, 0 once converged
+    '''
+    if matrix.nnz == 0:
+        return 0
+    squares = matrix.copy()
+    squares.data **= 2
+    maxima = matrix.max(axis=0).toarray().ravel()
+    return float(np.max(maxima - np.asarray(squares.sum(axis=0)).ravel()))
+
+def clusters_to_gene_dict(clusters):
+    '''
+    Numbers clusters the way parsing_clusters does: only clusters of two or more genes, in order
+    '''
+    clusters = [genes for genes in clusters if len(genes) > 1]
+    genes = [gene for members in clusters for gene in members]
+    cluster_nums = np.repeat(np.arange(1, len(clusters) + 1, dtype=np.int32), [len(members) for members in clusters])
+    return ClusterAssignments.from_arrays(genes, cluster_nums)
+
+@running_message
+def native_mcl(df, output, inflation, threads, prune_threshold=1e-4, select=1100, max_iterations=100, tolerance=1e-6):
+    '''
+    Clusters a hit table with an in-process sparse MCL
+    :param df: hit dataframe with qseqid, sseqid and neglogeval columns
+    :param output: location to write clusters in mcl --abc output format
+    :param inflation: MCL inflation
+    :param threads: number of threads used for expansion
+    :param prune_threshold: entries below this value are removed after each inflation
+    :param select: maximum number of entries kept per column
+    :param max_iterations: maximum number of expansion/inflation rounds
+    :param tolerance: chaos value at which the process is considered converged
+    :return: ClusterAssignments of gene -> cluster number, as returned by parsing_clusters
+    '''
+    query_codes, subject_codes, labels = edge_codes(df)
+    matrix = build_graph(query_codes, subject_codes, df['neglogeval'].to_numpy(), len(labels))
+
+    with tqdm(total=max_iterations, desc="MCL iterations", unit=" iterations") as pbar:
+        for _ in range(max_iterations):
+            matrix = expand(matrix, threads)
+            matrix.data **= inflation
+            # The threshold applies to the renormalized columns, as in mcl
+            matrix = normalize(prune(normalize(matrix), prune_threshold, select))
+            pbar.update(1)
+            current_chaos = chaos(matrix)
+            pbar.set_postfix(chaos=f"{current_chaos:.2e}")
+            if current_chaos < tolerance:
+                break
+
+    # Attractors and the nodes they draw in share a connected component of the limit matrix
+    n_clusters, component = connected_components(matrix, directed=True, connection="weak")
+    order = np.argsort(component, kind="stable")
+    boundaries = np.cumsum(np.bincount(component, minlength=n_clusters))[:-1]
+    clusters = [labels[members].tolist() for members in np.split(order, boundaries)]
+    clusters.sort(key=len, reverse=True)
+
+    with open(f"{output}.tmp", "w") as f:
+        for genes in clusters:
+            f.write("\t".join(genes) + "\n")
+    os.replace(f"{output}.tmp", output)
+
+    return clusters_to_gene_dict(clusters)
@@ -0,0 +1,185 @@
+from scripts.utils import running_message, read_fasta_ids, fetch_fasta_records, write_fasta
+from scripts.manifest import recorded_params, record_stage
+from scripts.cluster.cluster import makedb, diamond, mcl
+from scripts.cluster.assignments import ClusterAssignments
+from scripts.cluster.analyze import find_representative_gene, same_cluster_mask
+from scripts.cluster.components import prune_graph
+from scripts.cluster.hit_cache import build_hit_cache, load_hits
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import shutil
+import os
+
+def concatenate_files(paths, outpath):
+    with open(f"{outpath}.tmp", "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+    os.replace(f"{outpath}.tmp", outpath)
+
+@running_message
+def assign_to_representatives(df, rep_ids):
+    '''
+    Assigns each new protein to the representative it hits with the highest bitscore. Any hit given is enough
+    to join a cluster, so floors on identity or coverage are applied to df beforehand
+    :param df: hits of the new proteins against the search space
+    :param rep_ids: ids of the existing representatives
+    :return: dictionary of new protein -> representative
+    '''
+    rep_hits = df[df['sseqid'].isin(rep_ids) & ~df['qseqid'].isin(rep_ids)]
+    best_hits = rep_hits.sort_values('bitscore', ascending=False, kind='stable').drop_duplicates('qseqid')
+    return dict(zip(best_hits['qseqid'], best_hits['sseqid']))
+
+@running_message
+def cluster_unassigned(df, unassigned, update_dir, threads, inflation):
+    '''
+    Clusters the new proteins that hit no representative among themselves
+    :param df: hits of the new proteins against the search space
+    :param unassigned: ids of the new proteins without a representative hit
+    :param update_dir: directory of the update run
+    :param threads: number of threads
+    :param inflation: MCL inflation of the original clustering
+    :return: list of clusters, each a list of protein ids
+    '''
+    new_hits = df[df['qseqid'].isin(unassigned) & df['sseqid'].isin(unassigned)]
+    if new_hits.empty:
+        return [[protein] for protein in unassigned]
+
+    mcl_input = f"{update_dir}/mcl_input.tsv"
+    mcl_output = f"{update_dir}/mcl_output.txt"
+    new_hits[["qseqid", "sseqid", "neglogeval"]].to_csv(mcl_input, sep='\t', header=False, index=False)
+    mcl(mcl_input, mcl_output, inflation, threads)
+
+    with open(mcl_output) as f:
+        clusters = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+    # Proteins without any hit among the new set stay singletons
+    clustered = {protein for members in clusters for protein in members}
+    clusters.extend([protein] for protein in unassigned if protein not in clustered)
+    return clusters
+
+def update_cluster(input: str, outdir: str, threads: int, sensitivity: int, min_qcovhsp=0.0, min_pident=0.0)->None:
+    '''
+    Adds new proteins to an existing cluster set without redoing the all-vs-all search.
+    The update is recorded in the manifest of outdir, which 'cluster' then refuses to recluster from scratch
+    :param input: fasta of new proteins
+    :param outdir: output directory of a previous 'cluster' run
+    :param threads: number of threads
+    :param sensitivity: sensitivity of the diamond search
+    :param min_qcovhsp: minimum query coverage of a hit placing a new protein
+    :param min_pident: minimum identity of a hit placing a new protein
+    :return: None
+    '''
+    fasta_path = f"{outdir}/input.fasta"
+    rep_fasta = f"{outdir}/representative_genes.fasta"
+    mcl_output = f"{outdir}/mcl_output.txt"
+    same_cluster = f"{outdir}/same_cluster.tsv"
+    opposite_cluster = f"{outdir}/opposite_cluster.tsv"
+    for path in [fasta_path, rep_fasta, mcl_output, same_cluster, opposite_cluster]:
+        if not os.path.exists(path):
+            print(f'{path} not found, please run cluster command first')
+            raise FileNotFoundError(path)
+
+    known_ids = set(read_fasta_ids(fasta_path))
+    new_ids = [protein for protein in read_fasta_ids(input) if protein not in known_ids]
+    if not new_ids:
+        print("No new proteins found, clusters are up to date")
+        return
+    print(f"Adding {len(new_ids)} new proteins to the cluster set")
+
+    # New proteins are clustered at the inflation of the original run
+    mcl_params = recorded_params("mcl", [mcl_output]) or {}
+    inflation = mcl_params.get("inflation", 1.3)
+    if "inflation" not in mcl_params:
+        print(f"No MCL inflation recorded in {outdir}, using the default of {inflation}")
+
+    update_dir = f"{outdir}/update"
+    os.makedirs(update_dir, exist_ok=True)
+
+    new_records = fetch_fasta_records(input, new_ids)
+    new_fasta = f"{update_dir}/new_proteins.fasta"
+    write_fasta(new_fasta, [new_records[protein] for protein in new_ids])
+
+    # Search the new proteins against the representatives and each other only
+    search_space = f"{update_dir}/search_space.fasta"
+    concatenate_files([rep_fasta, new_fasta], search_space)
+    database_path = f"{update_dir}/database"
+    makedb(search_space, database_path)
+    tsv_path = f"{update_dir}/diamond.tsv"
+    diamond(new_fasta, database_path, tsv_path, 50, threads, sensitivity)
+
+    df = load_hits(build_hit_cache(tsv_path, f"{update_dir}/diamond_cache"))
+    df['qseqid'] = df['qseqid'].astype(str)
+    df['sseqid'] = df['sseqid'].astype(str)
+    evalue = df['evalue'].to_numpy()
+    df['evalue'] = np.where(evalue > 0, evalue, 1e-300)
+    df["neglogeval"] = -np.log10(df['evalue'])
+
+    # The floors decide which hits place a protein, the same/opposite cluster tables still get every hit
+    graph_df = df
+    if min_qcovhsp or min_pident:
+        graph_df = df[prune_graph(df, None, min_qcovhsp, min_pident)]
+        print(f"Kept {len(graph_df)} of {len(df)} hits to place the new proteins")
+
+    rep_ids = set(read_fasta_ids(rep_fasta))
+    assignments = assign_to_representatives(graph_df, rep_ids)
+    unassigned = [protein for protein in new_ids if protein not in assignments]
+    new_clusters = cluster_unassigned(graph_df, unassigned, update_dir, threads, inflation)
+
+    # Extend the clusters of the matched representatives and append the new clusters
+    members_by_rep = {}
+    for protein, rep in assignments.items():
+        members_by_rep.setdefault(rep, []).append(protein)
+
+    # All outputs are staged first and swapped in together at the end, so a crash leaves the
+    # previous cluster set untouched and a rerun sees the same proteins as new
+    staged_output = f"{update_dir}/mcl_output.updated.txt"
+    with open(mcl_output) as f, open(f"{staged_output}.tmp", "w") as out:
+        for line in tqdm(f, desc="Updating clusters", unit=" clusters"):
+            genes = line.rstrip("\n").split("\t")
+            added = [protein for gene in genes for protein in members_by_rep.get(gene, [])]
+            out.write("\t".join(genes + added) + "\n")
+        for members in new_clusters:
+            out.write("\t".join(members) + "\n")
+    os.replace(f"{staged_output}.tmp", staged_output)
+    gene_dict = ClusterAssignments.from_mcl_output(staged_output)
+
+    # New clusters of two or more proteins get a representative, as in the full run
+    new_gene_dict = {protein: gene_dict[protein] for members in new_clusters if len(members) > 1 for protein in members}
+    same_df = df[df['qseqid'].isin(new_gene_dict) & df['sseqid'].isin(new_gene_dict)]
+    same_df = same_df[same_df['qseqid'].map(new_gene_dict) == same_df['sseqid'].map(new_gene_dict)]
+    new_reps = find_representative_gene(same_df, new_gene_dict)
+
+    rep_records = []
+    for rep in new_reps:
+        record = new_records[rep]
+        record.description = f"{gene_dict[record.id]}"
+        rep_records.append(record)
+    new_rep_fasta = f"{update_dir}/new_representatives.fasta"
+    write_fasta(new_rep_fasta, rep_records)
+    staged_reps = f"{update_dir}/representative_genes.updated.fasta"
+    concatenate_files([rep_fasta, new_rep_fasta], staged_reps)
+    staged_input = f"{update_dir}/input.updated.fasta"
+    concatenate_files([fasta_path, new_fasta], staged_input)
+
+    # Existing clusters only gain members, so the hits already classified keep their side and the new hits are appended
+    mask = same_cluster_mask(df, gene_dict)
+    staged_tables = []
+    for table, hits in [(same_cluster, df[mask]), (opposite_cluster, df[~mask])]:
+        columns = pd.read_csv(table, sep="\t", nrows=0).columns
+        new_hits = f"{update_dir}/{os.path.basename(table)}.new"
+        hits[columns].to_csv(new_hits, sep="\t", index=False, header=False)
+        staged_table = f"{update_dir}/{os.path.basename(table)}.updated"
+        concatenate_files([table, new_hits], staged_table)
+        staged_tables.append((staged_table, table))
+
+    # input.fasta is replaced last: it decides which proteins are already clustered
+    os.replace(staged_output, mcl_output)
+    os.replace(staged_reps, rep_fasta)
+    for staged_table, table in staged_tables:
+        os.replace(staged_table, table)
+    os.replace(staged_input, fasta_path)
+    record_stage("update", inputs=[input], outputs=[mcl_output, rep_fasta, fasta_path, same_cluster, opposite_cluster],
+                 params={"inflation": inflation, "min_qcovhsp": min_qcovhsp, "min_pident": min_pident})
+    print(f"{len(assignments)} proteins joined existing clusters, {len(new_clusters)} new clusters formed")
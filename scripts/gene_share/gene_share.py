@@ -1,49 +1,86 @@
-from scripts.utils import read_fasta, read_lines, pd_read_csv
+from scripts.utils import read_fasta_ids, pd_read_csv
+from scripts.cluster.assignments import cluster_assignments
 import pandas as pd
 import os
 import numpy as np
 from scipy.stats import hypergeom
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix, triu
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import shutil
+import hashlib
 
 def calculate_gs_input(input_fasta, mcl_output, rep_fasta):
+    '''
+    Assigns every protein its cluster representative: the representative gene of its MCL cluster, the first
+    member of the cluster in input order when no representative was written, or itself outside any cluster
+    :return: (all genes, DataFrame of Rep and Gene)
+    '''
     print('Prepping diamond cluster output for gene share analysis')
-    rep_records_dict = {record.id: record for record in read_fasta(rep_fasta)}
-
-    cluster_lines = read_lines(mcl_output)
-    all_genes = [record.id for record in read_fasta(input_fasta)]
-
-    gene_dict = {}
-    clu_num = 1
-    for line in cluster_lines:
-        for gene in line.split('\t'):
-            gene_dict[gene.strip()] = clu_num
-        clu_num += 1
-
-    clust_dict = {}
-    for gene in gene_dict:
-        if gene in rep_records_dict:
-            clust_dict[gene_dict[gene]] = gene
-
-    for gene in all_genes:
-        if gene not in gene_dict.keys():
-            gene_dict[gene] = clu_num
-            clu_num += 1
-
-    for gene in gene_dict:
-        if gene_dict[gene] not in clust_dict.keys():
-            clust_dict[gene_dict[gene]] = gene
-
-    df = pd.DataFrame({
-        "Rep": [clust_dict[clust] for clust in gene_dict.values()],
-        "Gene": list(gene_dict.keys())
-    })
-    return all_genes, df
+    all_genes = read_fasta_ids(input_fasta)
+    assignments = cluster_assignments(mcl_output)
+
+    df = pd.DataFrame({"Gene": all_genes})
+    df["Cluster"] = assignments.lookup(df["Gene"])
+    clustered = df[df["Cluster"] != -1]
+    rep_genes = set(read_fasta_ids(rep_fasta))
+    reps = pd.concat([clustered[clustered["Gene"].isin(rep_genes)], clustered]).drop_duplicates("Cluster")
+    df["Rep"] = df["Cluster"].map(reps.set_index("Cluster")["Gene"]).fillna(df["Gene"])
+    return all_genes, df[["Rep", "Gene"]]
+
+_logsf_cache = {}
+LOGSF_CACHE_SIZE = 1000000
+# -log10 of the 1e-100 p-value floor, pairs whose p-value vanishes or underflows get this score
+MAX_SCORE = 100.0
+DENSE_BLOCK_ROWS = 1000
+
+def hypergeom_scores(shared, total_proteins, n, k):
+    '''
+    Computes -log10 P(X >= shared) for many genome pairs, evaluating hypergeom.logsf once
+    per distinct (shared, n, k) triple and memoizing the results across calls
+    :param shared: number of shared clusters of each pair
+    :param total_proteins: total number of clusters
+    :param n: number of proteins of the first genome of each pair
+    :param k: number of proteins of the second genome of each pair
+    :return: numpy array of finite scores, at most MAX_SCORE
+    '''
+    # Multi-copy clusters count a protein more than once, so genomes can hold more proteins than there are
+    # clusters and pairs can share more than the smaller genome holds: clamp both into the hypergeometric support
+    n = np.minimum(np.asarray(n, dtype=np.int64), total_proteins)
+    k = np.minimum(np.asarray(k, dtype=np.int64), total_proteins)
+    shared = np.minimum(np.asarray(shared, dtype=np.int64), np.minimum(n, k))
+    triples = np.stack([shared, n, k], axis=1)
+    if len(triples) == 0:
+        return np.zeros(0)
+    unique, inverse = np.unique(triples, axis=0, return_inverse=True)
+
+    logsf = np.empty(len(unique))
+    missing = []
+    for i, triple in enumerate(unique.tolist()):
+        cached = _logsf_cache.get((total_proteins, *triple))
+        if cached is None:
+            missing.append(i)
+        else:
+            logsf[i] = cached
+
+    if missing:
+        missing = np.array(missing)
+        to_compute = unique[missing]
+        logsf[missing] = hypergeom.logsf(to_compute[:, 0] - 1, total_proteins, to_compute[:, 1], to_compute[:, 2])
+        # Keep the memo bounded by starting over once it would grow past its size limit
+        if len(_logsf_cache) + len(missing) > LOGSF_CACHE_SIZE:
+            _logsf_cache.clear()
+        if len(missing) <= LOGSF_CACHE_SIZE:
+            for triple, value in zip(to_compute.tolist(), logsf[missing].tolist()):
+                _logsf_cache[(total_proteins, *triple)] = value
+
+    # logsf underflows to -inf for pairs far in the tail, those get the maximum score
+    scores = 0.0 - logsf[inverse.ravel()] / np.log(10)
+    return np.minimum(scores, MAX_SCORE)
 
 def calculate_adjacency_matrix(presence_absence_matrix):
     phages = presence_absence_matrix.index
     total_proteins = presence_absence_matrix.shape[1]
-    epsilon = 1e-100  # Small value to avoid log(0)
     
     # Convert presence-absence matrix to sparse matrix
     pamatrix = csr_matrix(presence_absence_matrix.values)
@@ -54,25 +91,135 @@ def calculate_adjacency_matrix(presence_absence_matrix):
 
     # Calculate number of proteins for each phage
     a = pamatrix.sum(axis=1).A1  # Convert to 1D array
-    b = pamatrix.sum(axis=1).A1  # Convert to 1D array
-
-    # Vectorized calculation of hypergeometric p-values
-    M = total_proteins
-    N = a[:, None]  # Column vector
-    K = b[None, :]  # Row vector
-
-    pval_matrix = np.zeros_like(shared_matrix, dtype=float)
-    for k in tqdm(range(shared_matrix.max() + 1)):
-        pval_matrix += (shared_matrix >= k) * hypergeom.sf(k - 1, M, N, K)
+    n_phages = len(a)
 
-    adjacency_matrix = -np.log10(pval_matrix + epsilon)
+    # Pairs are scored per row block, once per distinct (shared, N, K) triple of the block
+    adjacency_matrix = np.empty(shared_matrix.shape)
+    for start in tqdm(range(0, n_phages, DENSE_BLOCK_ROWS), desc="Scoring row blocks", unit=" blocks"):
+        stop = min(start + DENSE_BLOCK_ROWS, n_phages)
+        N = np.repeat(a[start:stop], n_phages)
+        K = np.tile(a, stop - start)
+        adjacency_matrix[start:stop] = hypergeom_scores(shared_matrix[start:stop].ravel(), total_proteins, N, K).reshape(stop - start, n_phages)
     adjacency_matrix_df = pd.DataFrame(adjacency_matrix, index=phages, columns=phages)
 
     return adjacency_matrix_df
-def gene_share(input, mapping, threads, outdir, gen_map):
+
+def sparse_presence_absence(rep_df):
+    '''
+    Builds a sparse node x cluster count matrix without materializing the dense table
+    :param rep_df: dataframe with 'Node' and 'Rep' columns
+    :return: csr matrix and the node labels of its rows
+    '''
+    node_codes, nodes = pd.factorize(rep_df['Node'], sort=True)
+    rep_codes, reps = pd.factorize(rep_df['Rep'], sort=True)
+    counts = np.ones(len(rep_df), dtype=np.int64)
+    # duplicate (node, rep) entries are summed, matching groupby().size()
+    pamatrix = coo_matrix((counts, (node_codes, rep_codes)), shape=(len(nodes), len(reps))).tocsr()
+    return pamatrix, nodes
+
+def score_block(pamatrix, proteins_per_node, start, stop, min_shared=1):
+    '''
+    Scores the genome pairs (i, j) with start <= i < stop and i < j
+    :param pamatrix: sparse node x cluster count matrix
+    :param proteins_per_node: number of proteins of each node
+    :param start: first row of the block
+    :param stop: row after the last row of the block
+    :param min_shared: minimum number of shared clusters for a pair to be scored
+    :return: row indices, column indices, shared counts and scores of the kept pairs
+    '''
+    total_proteins = pamatrix.shape[1]
+    shared_matrix = pamatrix[start:stop].dot(pamatrix.T).tocoo()
+    rows = shared_matrix.row + start
+    keep = (shared_matrix.col > rows) & (shared_matrix.data >= max(min_shared, 1))
+    rows = rows[keep]
+    cols = shared_matrix.col[keep]
+    shared = shared_matrix.data[keep]
+
+    scores = hypergeom_scores(shared, total_proteins, proteins_per_node[rows], proteins_per_node[cols])
+    return rows, cols, shared, scores
+
+_block_state = {}
+
+def _init_block_worker(pamatrix, nodes, min_shared):
+    _block_state['pamatrix'] = pamatrix
+    _block_state['nodes'] = nodes
+    _block_state['min_shared'] = min_shared
+    _block_state['proteins_per_node'] = np.asarray(pamatrix.sum(axis=1)).ravel()
+
+def _score_block_to_shard(start, stop, shard_path):
+    rows, cols, shared, scores = score_block(
+        _block_state['pamatrix'],
+        _block_state['proteins_per_node'],
+        start, stop,
+        _block_state['min_shared'])
+    nodes = _block_state['nodes']
+    edges = pd.DataFrame({
+        "source": nodes[rows],
+        "target": nodes[cols],
+        "shared": shared,
+        "score": scores
+    })
+    # Write under a temporary name so a killed worker never leaves a partial shard behind
+    edges.to_csv(f"{shard_path}.tmp", sep='\t', index=False, header=False)
+    os.replace(f"{shard_path}.tmp", shard_path)
+    return len(edges)
+
+def calculate_blocked_adjacency(pamatrix, nodes, outdir, threads, min_shared=1, block_size=1000):
+    '''
+    Scores genome pairs in row blocks across a process pool, writing one edge shard per block.
+    Shards that already exist are kept while the matrix, nodes and block layout are unchanged, so an
+    interrupted run resumes where it stopped.
+    :param pamatrix: sparse node x cluster count matrix
+    :param nodes: node labels of the matrix rows
+    :param outdir: output directory
+    :param threads: number of worker processes
+    :param min_shared: minimum number of shared clusters for a pair to be scored
+    :param block_size: number of genomes per row block
+    :return: path to the merged edge list
+    '''
+    shard_dir = f"{outdir}/adjacency_blocks"
+    # Shards are only reused for the same matrix contents and node order, not just the same shape
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (pamatrix.indptr, pamatrix.indices, pamatrix.data):
+        digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+    digest.update("\n".join(map(str, nodes)).encode())
+    layout = f"{digest.hexdigest()}\t{len(nodes)}\t{pamatrix.shape[1]}\t{min_shared}\t{block_size}\n"
+    layout_path = f"{shard_dir}/layout.txt"
+    if os.path.exists(layout_path):
+        with open(layout_path) as f:
+            if f.read() != layout:
+                print("Adjacency block layout changed, discarding existing shards")
+                shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(layout_path, 'w') as f:
+        f.write(layout)
+
+    blocks = []
+    for block_num, start in enumerate(range(0, len(nodes), block_size)):
+        shard_path = f"{shard_dir}/block_{block_num:06d}.tsv"
+        blocks.append((start, min(start + block_size, len(nodes)), shard_path))
+    pending = [block for block in blocks if not os.path.exists(block[2])]
+    print(f"{len(blocks) - len(pending)} of {len(blocks)} adjacency blocks already done")
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=threads, initializer=_init_block_worker, initargs=(pamatrix, nodes, min_shared)) as pool:
+            futures = [pool.submit(_score_block_to_shard, *block) for block in pending]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Scoring adjacency blocks", unit="blocks"):
+                future.result()
+
+    edges_file = f"{outdir}/adjacency_edges.tsv"
+    with open(f"{edges_file}.tmp", 'w') as out:
+        out.write("source\ttarget\tshared\tscore\n")
+        for _, _, shard_path in blocks:
+            with open(shard_path) as shard:
+                shutil.copyfileobj(shard, out)
+    os.replace(f"{edges_file}.tmp", edges_file)
+    return edges_file
+
+def gene_share(input, mapping, threads, outdir, gen_map, sparse=False, min_shared=1, block_size=1000):
     if os.path.exists(f"{input}/cluster_output.tsv"):
         rep_df = pd_read_csv(f"{input}/cluster_output.tsv", sep='\t', names=['Rep', 'Gene'])
-        all_genes = [record.id for record in read_fasta(f"{input}/input.fasta")]
+        all_genes = read_fasta_ids(f"{input}/input.fasta")
     elif os.path.exists(f"{input}/mcl_output.txt") and os.path.exists(f"{input}/representative_genes.fasta"):
         all_genes, rep_df = calculate_gs_input(f"{input}/input.fasta", f"{input}/mcl_output.txt", f"{input}/representative_genes.fasta")
     else:
@@ -87,6 +234,14 @@ def gene_share(input, mapping, threads, outdir, gen_map):
         gene_to_organism = {gene: '_'.join(gene.split('_')[:-1]) for gene in all_genes}
         
         rep_df['Node'] = rep_df['Gene'].apply(lambda x: gene_to_organism[x])
+
+        if sparse:
+            print("Calculating sparse adjacency edges")
+            pamatrix, nodes = sparse_presence_absence(rep_df)
+            edges_file = calculate_blocked_adjacency(pamatrix, nodes, outdir, threads, min_shared, block_size)
+            print(f"Adjacency edges saved to {edges_file}")
+            return
+
         presence_absence_matrix = (rep_df.groupby(['Node', 'Rep'])
                                            .size()
                                            .unstack(fill_value=0))
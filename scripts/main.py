@@ -1,10 +1,13 @@
 from scripts.cluster.cluster import cluster
 from scripts.cluster.mmseqs_cluster import mmseqs_cluster
+from scripts.cluster.update import update_cluster
 from scripts.network.network import network
 from scripts.gene_share.gene_share import gene_share
 from scripts.arguments import arguments
 from scripts.amg.amg import amg
-from scripts.utils import init_logging
+from scripts.benchmark.benchmark import benchmark
+from scripts.utils import init_logging, init_metrics
+from scripts.manifest import read_manifest, MANIFEST_NAME
 from sys import exit
 import os
 
@@ -12,7 +15,7 @@ import os
 def main():
     args = arguments()
 
-    subcommands = ['cluster', 'network', 'gene_share', 'amg']
+    subcommands = ['cluster', 'network', 'gene_share', 'amg', 'benchmark']
     
     if not args.command in subcommands:
         print(f"No valid subcommand provided please specify: {subcommands}. Use --help for more information.")
@@ -21,10 +24,22 @@ def main():
     os.makedirs(args.outdir, exist_ok=True)
     log_filename = f"{args.outdir}/output.log"
     init_logging(log_filename)
+    init_metrics(args.outdir, trace_memory=args.trace_memory, profile=args.profile)
     
 
     if args.command == 'cluster':
-        if args.mmseqs:
+        if args.update:
+            update_cluster(
+                input=args.input,
+                outdir=args.outdir,
+                threads=args.threads,
+                sensitivity=args.sensitivity,
+                min_qcovhsp=args.min_qcovhsp,
+                min_pident=args.min_pident)
+        elif "update" in read_manifest(f"{args.outdir}/{MANIFEST_NAME}")["stages"]:
+            print(f"{args.outdir} holds clusters extended with --update, clustering it from scratch would discard the added proteins. Please use a new output directory.")
+            exit(1)
+        elif args.mmseqs:
             
             mmseqs_cluster(
                 input=args.input, 
@@ -36,7 +51,19 @@ def main():
                 input=args.input, 
                 outdir=args.outdir, 
                 threads=args.threads,
-                sensitivity=args.sensitivity)
+                sensitivity=args.sensitivity,
+                native=args.native_mcl,
+                mcl_prune=args.mcl_prune,
+                mcl_select=args.mcl_select,
+                stream=args.stream_mcl,
+                intern_ids=args.intern_ids,
+                dedup=args.dedup,
+                top_k=args.top_k,
+                min_qcovhsp=args.min_qcovhsp,
+                min_pident=args.min_pident,
+                component_mcl=args.component_mcl,
+                inflation=args.inflation,
+                sweep_inflation=args.sweep_inflation)
     elif args.command == 'network':
         network(
             input=args.input, 
@@ -44,14 +71,23 @@ def main():
             threads=args.threads, 
             outdir=args.outdir,
             type=args.type,
-            mmseqs=args.mmseqs)
+            mmseqs=args.mmseqs,
+            block_size=args.block_size,
+            index_chunks=args.index_chunks,
+            jobs=args.jobs,
+            tmp_dir=args.tmpdir,
+            shards=args.shards,
+            min_orf_length=args.min_orf_length)
     elif args.command == 'gene_share':
         gene_share(
             input=args.input, 
             mapping=args.mapping, 
             threads=args.threads, 
             outdir=args.outdir,
-            gen_map = args.gen_mapping_file
+            gen_map = args.gen_mapping_file,
+            sparse=args.sparse,
+            min_shared=args.min_shared,
+            block_size=args.block_size
         )
     elif args.command == 'amg':
         amg(
@@ -60,5 +96,17 @@ def main():
             host_genomes=args.host_genomes, 
             protein_distance=args.protein_distance, 
             threads=args.threads, 
-            outdir=args.outdir
+            outdir=args.outdir,
+            regions=args.region
+        )
+    elif args.command == 'benchmark':
+        benchmark(
+            outdir=args.outdir,
+            sizes=args.sizes,
+            threads=args.threads,
+            repeats=args.repeats,
+            seed=args.seed,
+            stages=args.stages,
+            pipeline=args.pipeline,
+            keep_data=args.keep_data
         )
\ No newline at end of file
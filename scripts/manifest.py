@@ -0,0 +1,150 @@
+from glob import glob
+import subprocess
+import threading
+import tempfile
+import hashlib
+import logging
+import json
+import os
+import re
+
+MANIFEST_NAME = "manifest.json"
+
+# Files written by mmseqs for a database prefix (data, header db, split parts, ...)
+MMSEQS_DB_SUFFIX = re.compile(r"^(_h)?(\.(index|dbtype|lookup|source|\d+))?$")
+
+TOOL_VERSION_COMMANDS = {
+    "diamond": ["diamond", "version"],
+    "mcl": ["mcl", "--version"],
+    "mmseqs": ["mmseqs", "version"]
+}
+
+_tool_versions = {}
+manifest_lock = threading.Lock()
+
+def tool_version(tool):
+    '''
+    Returns the first line of a tool's version output, cached per process
+    :param tool: name of the tool in TOOL_VERSION_COMMANDS
+    :return: version string, or 'unknown' if the tool cannot report one
+    '''
+    if tool not in _tool_versions:
+        try:
+            result = subprocess.run(TOOL_VERSION_COMMANDS[tool], capture_output=True, text=True)
+            lines = (result.stdout or result.stderr).strip().splitlines()
+            _tool_versions[tool] = lines[0] if lines else "unknown"
+        except (OSError, KeyError):
+            _tool_versions[tool] = "unknown"
+    return _tool_versions[tool]
+
+def expand_paths(paths):
+    '''
+    Expands each path to the files it stands for: the file itself, or the files of an mmseqs database prefix
+    '''
+    files = []
+    for path in paths:
+        for candidate in sorted(glob(f"{glob_escape(path)}*")):
+            if os.path.isfile(candidate) and MMSEQS_DB_SUFFIX.match(candidate[len(path):]):
+                files.append(candidate)
+    return files
+
+def glob_escape(path):
+    return re.sub(r"([*?\[])", r"[\1]", path)
+
+def file_digest(path, known_files):
+    '''
+    Hashes a file, reusing the recorded digest when its size and modification time are unchanged
+    '''
+    stat = os.stat(path)
+    known = known_files.get(os.path.abspath(path))
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["digest"]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+    known_files[os.path.abspath(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest}
+    return digest
+
+def manifest_path(outputs):
+    return f"{os.path.dirname(os.path.abspath(outputs[0]))}/{MANIFEST_NAME}"
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return {"stages": {}, "files": {}}
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(path, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{MANIFEST_NAME}.", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+def stage_key(inputs, params, tool, known_files):
+    key = {
+        "inputs": {os.path.abspath(path): file_digest(path, known_files) for path in expand_paths(inputs)},
+        "params": params or {},
+        "tool": tool_version(tool) if tool else None
+    }
+    return hashlib.blake2b(json.dumps(key, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+def output_digests(outputs, known_files):
+    return {os.path.abspath(path): file_digest(path, known_files) for path in expand_paths(outputs)}
+
+def stage_current(stage, inputs, outputs, params=None, tool=None):
+    '''
+    Checks whether a stage's recorded inputs, parameters, tool version and outputs still match
+    :param stage: name of the stage
+    :param inputs: input files or database prefixes
+    :param outputs: output files or database prefixes, the manifest lives next to the first one
+    :param params: parameters that change the stage's output
+    :param tool: external tool whose version is part of the stage key
+    :return: True if the stage can be skipped
+    '''
+    path = manifest_path(outputs)
+    manifest = read_manifest(path)
+    entry = manifest["stages"].get(stage)
+    if entry is None or not expand_paths(outputs):
+        return False
+
+    known_files = manifest["files"]
+    current = entry["key"] == stage_key(inputs, params, tool, known_files) and entry["outputs"] == output_digests(outputs, known_files)
+    if not current:
+        logging.info(f"Stage {stage} is out of date, rerunning")
+    return current
+
+def record_stage(stage, inputs, outputs, params=None, tool=None):
+    '''
+    Records a completed stage in the manifest next to its outputs
+    '''
+    path = manifest_path(outputs)
+    known_files = read_manifest(path)["files"]
+    entry = {
+        "key": stage_key(inputs, params, tool, known_files),
+        "outputs": output_digests(outputs, known_files),
+        "params": params or {}
+    }
+    # Parallel jobs record into the same manifest: files are hashed concurrently, the read-modify-write is serialized
+    with manifest_lock:
+        manifest = read_manifest(path)
+        manifest["files"].update(known_files)
+        manifest["stages"][stage] = entry
+        write_manifest(path, manifest)
+
+def recorded_params(stage, outputs):
+    '''
+    Returns the parameters a stage was last recorded with in the manifest next to outputs
+    :return: dictionary of parameters, None if the stage or its parameters were never recorded
+    '''
+    entry = read_manifest(manifest_path(outputs))["stages"].get(stage)
+    return entry.get("params") if entry else None
+
+def clear_outputs(outputs):
+    '''
+    Removes the leftovers of an interrupted or outdated run of a stage
+    '''
+    for path in expand_paths(outputs):
+        os.remove(path)
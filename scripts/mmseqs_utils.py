@@ -1,12 +1,16 @@
 import os
 from scripts.utils import running_message, run_command
+from scripts.manifest import stage_current, record_stage, clear_outputs
 
 @running_message
 def mmseqs_makedb(input, outdir):
     db = f"{outdir}/mmseqs_db"
-    if not os.path.exists(f"{outdir}/mmseqs_db"):
+    stage = dict(inputs=[input], outputs=[db], tool="mmseqs")
+    if not stage_current("mmseqs_makedb", **stage):
+        clear_outputs([db])
         cmd = f"mmseqs createdb {input} {outdir}/mmseqs_db"
-        run_command(cmd, shell=True)
+        run_command(cmd)
+        record_stage("mmseqs_makedb", **stage)
     else:
         print("Database already exists, using existing database")
     return db
@@ -17,9 +21,13 @@ def mmseqs_cluster_cmd(db, outdir, threads, sensitivity, coverage=0.5, min_id =
     os.makedirs(tmp, exist_ok=True)
     
     cluster_output = f"{outdir}/cluster_output"
-    if not os.path.exists(f"{cluster_output}.index"):
+    params = {"sensitivity": sensitivity, "coverage": coverage, "min_id": min_id, "e_value": e_value}
+    stage = dict(inputs=[db], outputs=[cluster_output], params=params, tool="mmseqs")
+    if not stage_current("mmseqs_cluster_cmd", **stage):
+        clear_outputs([cluster_output])
         cmd = f"mmseqs cluster -s {sensitivity} -c {coverage} --min-seq-id {min_id} -e {e_value} --threads {threads} {db} {cluster_output} {tmp}"
-        run_command(cmd, shell=True)
+        run_command(cmd)
+        record_stage("mmseqs_cluster_cmd", **stage)
     else:
         print("Output file already exists, using existing file")
     return cluster_output
@@ -27,16 +35,33 @@ def mmseqs_cluster_cmd(db, outdir, threads, sensitivity, coverage=0.5, min_id =
 @running_message
 def mmseqs_createtsv(db, cluster_output, outdir):
     tsv_path = f"{outdir}/cluster_output.tsv"
-    if not os.path.exists(tsv_path):
-        cmd = f"mmseqs createtsv {db} {db} {cluster_output} {tsv_path}"
-        run_command(cmd, shell=True)
+    stage = dict(inputs=[db, cluster_output], outputs=[tsv_path], tool="mmseqs")
+    if not stage_current("mmseqs_createtsv", **stage):
+        cmd = f"mmseqs createtsv {db} {db} {cluster_output} {tsv_path}.tmp"
+        run_command(cmd)
+        os.replace(f"{tsv_path}.tmp", tsv_path)
+        record_stage("mmseqs_createtsv", **stage)
     else:
         print("Output file already exists, using existing file")
     return tsv_path
 
 @running_message
-def mmseqs_search(query_db, ref_db, outdir, tmp_path):
-    cmd = f"mmseqs search {query_db}/mmseqs_db {ref_db}/mmseqs_db {outdir}/network_int {tmp_path}"
-    run_command(cmd, shell=True, check=True)
-    cmd2 = f"mmseqs convertalis {query_db}/mmseqs_db {ref_db}/mmseqs_db {outdir}/network_int {outdir}/network.m8"
-    run_command(cmd2, shell=True, check=True)
+def mmseqs_search(query_db, ref_db, outdir, tmp_path=None, threads=None, addition=""):
+    os.makedirs(outdir, exist_ok=True)
+    if tmp_path is None:
+        tmp_path = f"{outdir}/tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    thread_flag = f" --threads {threads}" if threads else ""
+
+    network_m8 = f"{outdir}/network.m8"
+    stage = dict(inputs=[f"{query_db}/mmseqs_db", f"{ref_db}/mmseqs_db"], outputs=[network_m8], params={"addition": addition}, tool="mmseqs")
+    if stage_current("mmseqs_search", **stage):
+        print("Output file already exists, using existing file")
+        return
+    clear_outputs([f"{outdir}/network_int"])
+    cmd = f"mmseqs search {query_db}/mmseqs_db {ref_db}/mmseqs_db {outdir}/network_int {tmp_path}{thread_flag} {addition}".strip()
+    run_command(cmd)
+    cmd2 = f"mmseqs convertalis {query_db}/mmseqs_db {ref_db}/mmseqs_db {outdir}/network_int {network_m8}.tmp{thread_flag}"
+    run_command(cmd2)
+    os.replace(f"{network_m8}.tmp", network_m8)
+    record_stage("mmseqs_search", **stage)
@@ -1,2 +1,50 @@
-def diamond_network(*args):
-    pass
\ No newline at end of file
+from scripts.cluster.cluster import makedb
+from scripts.network.mmseqs_network import break_fasta, merge_hit_tables
+from scripts.manifest import stage_current, record_stage
+from scripts.utils import running_message, run_command, run_jobs
+import os
+
+@running_message
+def diamond_search(query, database, output, threads, block_size, index_chunks):
+    params = {"block_size": block_size, "index_chunks": index_chunks}
+    stage = dict(inputs=[query, f"{database}.dmnd"], outputs=[output], params=params, tool="diamond")
+    # Shards share one manifest, so each shard gets its own stage entry
+    stage_name = f"diamond_search:{os.path.basename(database)}"
+    if not stage_current(stage_name, **stage):
+        cmd = f"diamond blastp -q {query} -d {database} -o {output}.tmp --outfmt 6 --threads {threads} -b {block_size} -c {index_chunks}"
+        run_command(cmd)
+        os.replace(f"{output}.tmp", output)
+        record_stage(stage_name, **stage)
+    else:
+        print("Output file already exists, using existing file")
+
+@running_message
+def diamond_network(query, outdir, reference_db, threads, block_size=2.0, index_chunks=4, jobs=1, shards=None):
+    '''
+    Searches the representative genes against a sharded DIAMOND reference database
+    :param query: representative genes fasta
+    :param outdir: output directory
+    :param reference_db: protein fasta of the reference
+    :param threads: number of threads
+    :param block_size: DIAMOND block size in billions of letters (-b)
+    :param index_chunks: number of DIAMOND index chunks (-c)
+    :param jobs: number of shards searched at once, threads are split evenly between them
+    :param shards: number of reference shards, defaults to threads
+    :return: path to the merged hit table
+    '''
+    ref_db_path = f"{outdir}/reference_db"
+    os.makedirs(ref_db_path, exist_ok=True)
+
+    ref_files_list = break_fasta(reference_db, ref_db_path, shards or threads)
+
+    databases = ['.'.join(ref_file.split('.')[0:-1]) for ref_file in ref_files_list]
+    makedb_jobs = [lambda _, ref_file=ref_file, database=database: makedb(ref_file, database, f"makedb:{os.path.basename(database)}") for ref_file, database in zip(ref_files_list, databases)]
+    run_jobs(makedb_jobs, threads, max_jobs=jobs, desc="Building DIAMOND databases")
+
+    shard_outputs = [f"{database}_network.m8" for database in databases]
+    search_jobs = [lambda job_threads, database=database, shard_output=shard_output: diamond_search(query, database, shard_output, job_threads, block_size, index_chunks) for database, shard_output in zip(databases, shard_outputs)]
+    run_jobs(search_jobs, threads, max_jobs=jobs, desc="Searching homologs in reference database")
+
+    network_m8 = f"{outdir}/network.m8"
+    merge_hit_tables(shard_outputs, network_m8)
+    return network_m8
@@ -1,57 +1,144 @@
-from Bio import SeqIO # type: ignore
 from Bio.Seq import Seq # type: ignore
 from multiprocessing import Pool
 from tqdm import tqdm
-from scripts.utils import running_message
+from scripts.utils import running_message, read_record_chunks, fasta_header_id
+import numpy as np
+import itertools
+from functools import partial
+import os
 
+NUCLEOTIDES = "ACGTURYSWKMBDHVN"
+N_CODE = NUCLEOTIDES.index("N")
+TRANSLATE_CHUNK_SIZE = 1 << 22
+
+def build_tables():
+    '''
+    Builds byte -> nucleotide code, code -> complement code and codon -> amino acid lookup tables
+    '''
+    symbol_codes = np.full(256, N_CODE, dtype=np.uint16)
+    for code, base in enumerate(NUCLEOTIDES):
+        symbol_codes[ord(base)] = code
+        symbol_codes[ord(base.lower())] = code
+
+    complement_codes = np.array([NUCLEOTIDES.index(str(Seq(base).complement()).replace("U", "A")) for base in NUCLEOTIDES], dtype=np.uint16)
+
+    # Every codon of ambiguity codes is translated once with Biopython's standard table
+    amino_acids = np.full(len(NUCLEOTIDES) ** 3, ord("X"), dtype=np.uint8)
+    for i, codon in enumerate(itertools.product(NUCLEOTIDES, repeat=3)):
+        try:
+            amino_acids[i] = ord(str(Seq("".join(codon)).translate()))
+        except Exception:
+            pass
+    return symbol_codes, complement_codes, amino_acids
+
+SYMBOL_CODES, COMPLEMENT_CODES, AMINO_ACIDS = build_tables()
+
+def translate_codes(codes):
+    n_codons = len(codes) // 3
+    codons = codes[:n_codons * 3].reshape(n_codons, 3)
+    protein = AMINO_ACIDS[(codons[:, 0] * 16 + codons[:, 1]) * 16 + codons[:, 2]]
+    return protein[:len(protein) // 3 * 3].tobytes().decode()
 
 def translate_dna(dna_sequence):
-    frames = []
-    seq_len = len(dna_sequence)
-    
-    if seq_len % 3 != 0:
-        dna_sequence += 'N' * (3 - seq_len % 3)
-        seq_len = len(dna_sequence)
+    codes = SYMBOL_CODES[np.frombuffer(dna_sequence.encode() if isinstance(dna_sequence, str) else dna_sequence, dtype=np.uint8)]
     
-    for i in range(3):
-        protein = str(Seq(dna_sequence[i:]).translate())
-        frames.append(protein[:len(protein) // 3 * 3])
+    if len(codes) % 3 != 0:
+        codes = np.concatenate([codes, np.full(3 - len(codes) % 3, N_CODE, dtype=codes.dtype)])
 
-    reverse_complement = str(Seq(dna_sequence).reverse_complement())
-    for i in range(3):
-        protein = str(Seq(reverse_complement[i:]).translate())
-        frames.append(protein[:len(protein) // 3 * 3])
+    frames = [translate_codes(codes[i:]) for i in range(3)]
+
+    reverse_complement = COMPLEMENT_CODES[codes][::-1]
+    frames.extend(translate_codes(reverse_complement[i:]) for i in range(3))
 
     return frames
 
-def process_record(record):
-    dna_sequence = str(record.seq)
-    protein_frames = translate_dna(dna_sequence)
-    return [f'>{record.id}_frame{i+1}\n{protein}' for i, protein in enumerate(protein_frames)]
+def find_orfs(dna_sequence, min_orf_length):
+    '''
+    Splits the six frames of a sequence at stop codons and keeps the open reading frames
+    :param dna_sequence: nucleotide sequence
+    :param min_orf_length: minimum ORF length in amino acids
+    :return: list of (frame, start, end, protein) with 1-based contig coordinates, start > end on the reverse strand
+    '''
+    codes = SYMBOL_CODES[np.frombuffer(dna_sequence.encode() if isinstance(dna_sequence, str) else dna_sequence, dtype=np.uint8)]
+    seq_len = len(codes)
+    reverse_complement = COMPLEMENT_CODES[codes][::-1]
+
+    # Unlike the full frames, ORFs are built from complete codons only, so no padding is needed
+    orfs = []
+    for frame in range(6):
+        offset = frame % 3
+        strand = codes if frame < 3 else reverse_complement
+        n_codons = max(seq_len - offset, 0) // 3
+        codons = strand[offset:offset + n_codons * 3].reshape(n_codons, 3)
+        protein = AMINO_ACIDS[(codons[:, 0] * 16 + codons[:, 1]) * 16 + codons[:, 2]]
+
+        stops = np.flatnonzero(protein == ord("*"))
+        starts = np.concatenate([[0], stops + 1])
+        ends = np.concatenate([stops, [n_codons]])
+        keep = ends - starts >= max(min_orf_length, 1)
+        for start, end in zip(starts[keep], ends[keep]):
+            first, last = offset + 3 * start, offset + 3 * end - 1
+            if frame < 3:
+                contig_start, contig_end = first + 1, last + 1
+            else:
+                contig_start, contig_end = seq_len - first, seq_len - last
+            orfs.append((frame + 1, int(contig_start), int(contig_end), protein[start:end].tobytes().decode()))
+    return orfs
+
+def process_record(record, min_orf_length=None):
+    header, _, sequence = record.partition(b"\n")
+    record_id = fasta_header_id(header).decode()
+    sequence = sequence.replace(b"\n", b"").replace(b"\r", b"").replace(b" ", b"")
+    if min_orf_length:
+        return [f'>{record_id}_frame{frame}_{start}_{end}\n{protein}' for frame, start, end, protein in find_orfs(sequence, min_orf_length)]
+    protein_frames = translate_dna(sequence)
+    return [f'>{record_id}_frame{i+1}\n{protein}' for i, protein in enumerate(protein_frames)]
+
+def process_chunk(records, min_orf_length=None):
+    translated = []
+    for record in records:
+        entries = process_record(record, min_orf_length)
+        if entries:
+            translated.append('\n'.join(entries) + '\n')
+    return "".join(translated)
+
+def map_orf_hits(hits, column="target", start_column="tstart", end_column="tend"):
+    '''
+    Maps hits on ORFs written by translate(min_orf_length=...) back to contig coordinates
+    :param hits: hit dataframe, e.g. network.m8
+    :param column: column holding the ORF names
+    :param start_column: column of the 1-based hit start on the ORF, in amino acids
+    :param end_column: column of the 1-based hit end on the ORF, in amino acids
+    :return: copy of hits with contig, strand, contig_start and contig_end columns
+    '''
+    hits = hits.copy()
+    orf = hits[column].str.extract(r"^(?P<contig>.*)_frame(?P<frame>[1-6])_(?P<start>\d+)_(?P<end>\d+)$")
+    forward = orf["frame"].astype(int) <= 3
+    direction = np.where(forward, 1, -1)
+    orf_start = orf["start"].astype(int)
+
+    hits["contig"] = orf["contig"]
+    hits["strand"] = np.where(forward, "+", "-")
+    hits["contig_start"] = orf_start + direction * 3 * (hits[start_column] - 1)
+    hits["contig_end"] = orf_start + direction * (3 * hits[end_column] - 1)
+    return hits
 
 @running_message
-def translate(input_file, output_file, threads):
-    chunk_size = 1000
-    
-    with open(output_file, 'w') as output_handle:
-        with Pool(processes=threads) as pool:
-            total_records = sum(1 for _ in SeqIO.parse(input_file, 'fasta'))
-            progress_bar = tqdm(total=total_records, unit='records')
-
-            def process_chunk(records):
-                results = pool.map(process_record, records)
-                for chunk_results in results:
-                    output_handle.write('\n'.join(chunk_results) + '\n')
-                progress_bar.update(len(records))
-
-            records = []
-            for record in SeqIO.parse(input_file, 'fasta'):
-                records.append(record)
-                if len(records) == chunk_size:
-                    process_chunk(records)
-                    records = []
-
-            if records:
-                process_chunk(records)
-
-            progress_bar.close()
\ No newline at end of file
+def translate(input_file, output_file, threads, min_orf_length=None):
+    '''
+    Translates a nucleotide fasta in six frames
+    :param input_file: nucleotide fasta
+    :param output_file: location of the translated fasta
+    :param threads: number of worker processes
+    :param min_orf_length: if set, write only stop-free segments of at least this many amino acids,
+        named <id>_frame<frame>_<start>_<end> after their contig coordinates
+    :return: None
+    '''
+    total_size = os.path.getsize(input_file)
+    translate_chunk = partial(process_chunk, min_orf_length=min_orf_length)
+
+    with open(output_file, 'w') as output_handle, Pool(processes=threads) as pool, \
+            tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024) as progress_bar:
+        # imap keeps reading and translating ahead while earlier chunks are written
+        for translated in pool.imap(translate_chunk, read_record_chunks(input_file, TRANSLATE_CHUNK_SIZE, progress_bar)):
+            output_handle.write(translated)
@@ -1,87 +1,122 @@
 from scripts.cluster.mmseqs_cluster import mmseqs_makedb
 from scripts.mmseqs_utils import mmseqs_search
-from scripts.utils import running_message
-from Bio import SeqIO # type: ignore
+from scripts.utils import running_message, run_jobs, read_record_chunks
+from scripts.manifest import stage_current, record_stage
 from tqdm import tqdm
-import threading
+import pandas as pd
 import logging
+import heapq
 import os
 
-def break_fasta(fasta, outdir, threads):
+SPLIT_BUFFER_SIZE = 1 << 24
+
+def count_residues(record):
+    sequence = record[record.find(b"\n") + 1:]
+    return len(sequence) - sequence.count(b"\n") - sequence.count(b"\r")
+
+def break_fasta(fasta, outdir, shards):
+    '''
+    Splits a fasta file into shards of similar residue counts, working on raw bytes
+    :param fasta: fasta file to split
+    :param outdir: directory of the shards
+    :param shards: number of shards
+    :return: list of shard paths
+    '''
     total_size = os.path.getsize(fasta)
     os.makedirs(outdir, exist_ok=True)
 
-    files_list= [f"{outdir}/part_{i}.fasta" for i in range(threads)]
-    verify_run = True
-
-    for file in files_list:
-        if os.path.exists(file):
-            pass
-        else:
-            verify_run = False
-            break
-    
-    if verify_run:
+    files_list= [f"{outdir}/part_{i}.fasta" for i in range(shards)]
+    stage = dict(inputs=[fasta], outputs=files_list, params={"shards": shards})
+    if stage_current("break_fasta", **stage):
         logging.info("prior split files found, using existing files")
         return files_list
-    
-    broken_files = [open(f"{outdir}/part_{i}.fasta", 'w') for i in range(threads)]
 
-    with open(fasta) as f, tqdm(total = total_size,
-                                  desc= "Reading Fasta",
-                                  unit = 'B',
-                                  unit_scale = True,
-                                  unit_divisor = 1024) as pbar:
-        records_written = 0
-        for record in SeqIO.parse(f, 'fasta'):
-            sublist_index = records_written % threads
-            SeqIO.write(record, broken_files[sublist_index], 'fasta')
-            records_written += 1
-            pbar.update(len(record.format('fasta')))
+    # Search cost follows residues, so each record goes to the shard with the fewest residues so far
+    loads = [(0, i) for i in range(shards)]
+    broken_files = [open(f"{file}.tmp", 'wb', buffering=SPLIT_BUFFER_SIZE) for file in files_list]
+
+    with tqdm(total=total_size, desc="Reading Fasta", unit='B', unit_scale=True, unit_divisor=1024) as pbar:
+        for records in read_record_chunks(fasta, SPLIT_BUFFER_SIZE, pbar):
+            for record in records:
+                load, index = heapq.heappop(loads)
+                broken_files[index].write(record)
+                heapq.heappush(loads, (load + count_residues(record), index))
 
     for broken_file in broken_files:
         broken_file.close()
+    for file in files_list:
+        os.replace(f"{file}.tmp", file)
+    record_stage("break_fasta", **stage)
     
-    return [f"{outdir}/part_{i}.fasta" for i in range(threads)]
+    return files_list
             
 
+M8_COLUMNS = ["query", "target", "pident", "alnlen", "mismatch", "numgapopen", "qstart", "qend", "tstart", "tend", "evalue", "bitscore"]
+
+@running_message
+def merge_hit_tables(shard_outputs, output):
+    '''
+    Merges per-shard hit tables into one table sorted by query and decreasing bitscore
+    :param shard_outputs: list of m8 files
+    :param output: location of the merged m8 file
+    :return: None
+    '''
+    tables = [pd.read_csv(path, sep="\t", names=M8_COLUMNS, float_precision="round_trip") for path in shard_outputs if os.path.getsize(path) > 0]
+    if not tables:
+        open(output, "w").close()
+        return
+    hits = pd.concat(tables, ignore_index=True).drop_duplicates()
+    hits = hits.sort_values(["query", "bitscore", "target"], ascending=[True, False, True], kind="stable")
+    hits.to_csv(f"{output}.tmp", sep="\t", header=False, index=False)
+    os.replace(f"{output}.tmp", output)
+
 @running_message
-def mmseqs_network(query, outdir, reference_db, threads):
+def mmseqs_network(query, outdir, reference_db, threads, jobs=None, tmp_dir=None, shards=None):
+    '''
+    Searches the representative genes against a sharded mmseqs reference database
+    :param query: representative genes fasta
+    :param outdir: output directory
+    :param reference_db: protein fasta of the reference
+    :param threads: total number of threads
+    :param jobs: number of shards searched at once, threads are split evenly between them
+    :param tmp_dir: scratch directory for mmseqs, defaults to <outdir>/tmp
+    :param shards: number of reference shards, defaults to threads
+    :return: path to the merged hit table
+    '''
     ref_db_path = f"{outdir}/reference_db"
     query_db_path = f"{outdir}/query_db"
-    tmp_path = f"/media/biolinux/nvme0n1p1/sulman_mmseqs_tem"
+    if tmp_dir is None:
+        tmp_dir = f"{outdir}/tmp"
+    if jobs is None:
+        jobs = max(1, threads // 8)
 
     os.makedirs(outdir, exist_ok=True)
     os.makedirs(ref_db_path, exist_ok=True)
     os.makedirs(query_db_path, exist_ok=True)
 
     
-    ref_files_list = break_fasta(reference_db, ref_db_path, threads)
+    ref_files_list = break_fasta(reference_db, ref_db_path, shards or threads)
     
     ref_db_path_list=[]
     for file in ref_files_list:
         ref_path = f"{'.'.join(file.split('.')[0:-1])}"
         os.makedirs(ref_path, exist_ok=True)
         ref_db_path_list.append(ref_path)
-    
-    thread_list = range(threads)
-    threading_process = []
 
-    for i in thread_list:
-        x = threading.Thread(target=mmseqs_makedb, args=(ref_files_list[i], ref_db_path_list[i]))
-        threading_process.append(x)
-        x.start()
-    
-    for index, threading_process in enumerate(threading_process):
-        threading_process.join()
-        print(f"Thread {index} finished.")
-        
-    mmseqs_makedb(query, query_db_path)
+    # createdb is I/O bound, so at most `jobs` of them run at once
+    makedb_jobs = [lambda _, file=file, ref_path=ref_path: mmseqs_makedb(file, ref_path) for file, ref_path in zip(ref_files_list, ref_db_path_list)]
+    makedb_jobs.append(lambda _: mmseqs_makedb(query, query_db_path))
+    run_jobs(makedb_jobs, threads, max_jobs=jobs, desc="Building mmseqs databases")
+
+    shard_outputs = []
+    search_jobs = []
+    for ref_db in ref_db_path_list:
+        shard_name = os.path.basename(ref_db)
+        out_path = f"{outdir}/search/{shard_name}"
+        shard_outputs.append(f"{out_path}/network.m8")
+        search_jobs.append(lambda job_threads, ref_db=ref_db, out_path=out_path, shard_name=shard_name: mmseqs_search(query_db_path, ref_db, out_path, f"{tmp_dir}/{shard_name}", job_threads))
+    run_jobs(search_jobs, threads, max_jobs=jobs, desc="Searching homologs in reference database")
 
-    for ref_db in tqdm(ref_db_path_list, desc="searching homologs in reference database", unit="Part"):
-        tmp_path = f"{tmp_path}/{ref_db}"
-        out_path = f"{outdir}/{ref_db}"
-        os.makedirs(out_path, exist_ok=True)
-        os.makedirs(tmp_path, exist_ok=True)
-        
-        mmseqs_search(query_db_path, ref_db, out_path, tmp_path)
\ No newline at end of file
+    network_m8 = f"{outdir}/network.m8"
+    merge_hit_tables(shard_outputs, network_m8)
+    return network_m8
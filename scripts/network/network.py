@@ -1,33 +1,67 @@
-from scripts.network.dna_translator import translate
+from scripts.network.dna_translator import translate, map_orf_hits
 from scripts.network.diamond_network import diamond_network
 from scripts.network.mmseqs_network import mmseqs_network
+from scripts.manifest import stage_current, record_stage
+from scripts.utils import running_message, pd_read_csv
+import pandas as pd
 import os
 
-def network(input, reference, threads, outdir, type, mmseqs):
+# Both backends write the 12 standard BLAST tabular columns to network.m8
+NETWORK_COLUMNS = ["query", "target", "pident", "alnlen", "mismatch", "numgapopen", "qstart", "qend", "tstart", "tend", "evalue", "bitscore"]
+
+@running_message
+def map_network_to_contigs(network_m8, output):
+    '''
+    Rewrites hits on the ORFs of the reference in contig coordinates
+    :param network_m8: hits of the representatives against ORFs named <contig>_frame<frame>_<start>_<end>
+    :param output: tsv with the hit columns plus contig, strand, contig_start and contig_end
+    :return: None
+    '''
+    stage = dict(inputs=[network_m8], outputs=[output])
+    if stage_current("map_orf_hits", **stage):
+        print("Contig coordinates already exist, using existing file")
+        return
+    if os.path.getsize(network_m8) == 0:
+        hits = pd.DataFrame(columns=NETWORK_COLUMNS)
+    else:
+        hits = pd_read_csv(network_m8, sep="\t", names=NETWORK_COLUMNS)
+    map_orf_hits(hits).to_csv(f"{output}.tmp", sep="\t", index=False)
+    os.replace(f"{output}.tmp", output)
+    record_stage("map_orf_hits", **stage)
+
+def network(input, reference, threads, outdir, type, mmseqs, block_size=2.0, index_chunks=4, jobs=None, tmp_dir=None, shards=None, min_orf_length=None):
     rep_seq_path = f"{input}/representative_genes.fasta"
     
     os.makedirs(outdir, exist_ok=True)
     
     if type == 'nucl':
         translated_path = f"{outdir}/translated_reference_db.fasta"
-        translate(reference, translated_path, threads)
+        translate(reference, translated_path, threads, min_orf_length)
     else:
         translated_path = reference
     
     if mmseqs:
-        mmseqs_network(
+        network_m8 = mmseqs_network(
             query = rep_seq_path,
             outdir = outdir,
             threads = threads,
             reference_db = translated_path,
+            jobs = jobs,
+            tmp_dir = tmp_dir,
+            shards = shards,
         )
     else:
-        diamond_network(
+        network_m8 = diamond_network(
             query = rep_seq_path,
             outdir = outdir,
             threads = threads,
             reference_db = translated_path,
+            block_size = block_size,
+            index_chunks = index_chunks,
+            jobs = jobs or 1,
+            shards = shards,
         )
     
-    
-    
\ No newline at end of file
+    if min_orf_length:
+        # ORF names carry their contig coordinates, the hits are also written against the contigs themselves
+        map_network_to_contigs(network_m8, f"{outdir}/network.contigs.tsv")
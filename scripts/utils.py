@@ -1,4 +1,5 @@
 from Bio import SeqIO # type: ignore
+from scripts.manifest import stage_current, record_stage
 import os
 from datetime import datetime, timedelta
 import pandas as pd # type: ignore
@@ -7,7 +8,16 @@ import io
 import logging
 import sys
 import subprocess
+import selectors
+import threading
+import tracemalloc
+import resource
+import cProfile
+import json
+import time
+import shutil
 import shlex
+from concurrent.futures import ThreadPoolExecutor
 
 def get_unique_log_filename(base_log_filename):
     i = 1
@@ -37,6 +47,7 @@ def init_logging(log_filename):
     while os.path.exists(log_filename):
         log_filename = get_unique_log_filename(log_filename)
     print(f"Logging to {log_filename}")
+    metrics_settings["log_file"] = log_filename
     # Configure logging to use the TeeHandler
     tee_handler = TeeHandler(log_filename)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -45,38 +56,231 @@ def init_logging(log_filename):
     logging.basicConfig(level=logging.INFO, handlers=[tee_handler])
 
 
-def run_command(cmd, **kwargs):
-    if not 'stderr' in kwargs:
-        kwargs['stderr'] = subprocess.PIPE
-    if not 'stdout' in kwargs:
-        kwargs['stdout'] = subprocess.PIPE
-    if not 'text' in kwargs:
-        kwargs['text'] = True
-    if not 'bufsize' in kwargs:
-        kwargs['bufsize'] = 1
+# Each thread keeps the usage of the commands it ran, run_jobs hands the records of its jobs back to the caller
+command_usage = threading.local()
 
+def thread_command_usage():
+    '''
+    Returns the usage records of the commands run by the current thread and the jobs it ran through run_jobs
+    '''
+    if not hasattr(command_usage, "records"):
+        command_usage.records = []
+    return command_usage.records
 
+def run_command(cmd, shell=False, check=True, stdin_chunks=None):
+    '''
+    Runs an external command, logging stdout and stderr as they arrive and recording its resource usage
+    :param cmd: command string, or argument list when shell is False
+    :param shell: run the command through the shell
+    :param check: raise CalledProcessError when the command fails
+    :param stdin_chunks: optional iterable of bytes written to the command's stdin
+    :return: CompletedProcess with a 'usage' dictionary of wall time, CPU time and peak RSS
+    '''
     logging.info(f"Running command: {cmd}")
-    
-    cmd_list = shlex.split(cmd)
+    args = cmd if shell or not isinstance(cmd, str) else shlex.split(cmd)
 
-    with subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1) as process:
-        for stdout_line in iter(process.stdout.readline, ""):
-            logging.info(stdout_line.strip())
+    start = time.perf_counter()
+    process = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.PIPE if stdin_chunks is not None else None)
 
-        for stderr_line in iter(process.stderr.readline, ""):
-            logging.error(stderr_line.strip())
+    # stdin is fed from a thread so a full output pipe can never block the writer, and vice versa
+    feed_errors = []
+    writer = None
+    if stdin_chunks is not None:
+        def feed_stdin():
+            try:
+                for chunk in stdin_chunks:
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            except Exception as e:
+                feed_errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        writer = threading.Thread(target=feed_stdin, daemon=True)
+        writer.start()
 
-        process.stdout.close()
-        process.stderr.close()
-        return_code = process.wait()
+    # Drain stdout and stderr together so neither pipe can fill up and stall the tool
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, logging.info)
+    selector.register(process.stderr, selectors.EVENT_READ, logging.error)
+    partial_lines = {process.stdout: b"", process.stderr: b""}
+    while selector.get_map():
+        for key, _ in selector.select():
+            data = os.read(key.fd, 1 << 16)
+            if not data:
+                selector.unregister(key.fileobj)
+                lines = [partial_lines[key.fileobj]]
+            else:
+                lines = (partial_lines[key.fileobj] + data).split(b"\n")
+                partial_lines[key.fileobj] = lines.pop()
+            for line in lines:
+                line = line.decode(errors="replace").strip()
+                if line:
+                    key.data(line)
+    selector.close()
+    if writer is not None:
+        writer.join()
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process.stdout.close()
+    process.stderr.close()
+
+    usage = {
+        "command": cmd if isinstance(cmd, str) else shlex.join(cmd),
+        "returncode": process.returncode,
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss_mb": rusage.ru_maxrss / 1024
+    }
+    thread_command_usage().append(usage)
+    logging.info(f"Command resources: wall {usage['wall_seconds']:.2f} s, CPU {usage['cpu_seconds']:.2f} s, peak RSS {usage['peak_rss_mb']:.1f} MB")
 
-        if return_code:
-            logging.error(f"Command '{cmd}' failed with return code {return_code}")
-            raise subprocess.CalledProcessError(return_code, cmd)
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode and check:
+        logging.error(f"Command '{cmd}' failed with return code {process.returncode}")
+        raise subprocess.CalledProcessError(process.returncode, cmd)
 
     logging.info(f"Command '{cmd}' completed successfully")
-    return subprocess.CompletedProcess(cmd, return_code)
+    completed = subprocess.CompletedProcess(cmd, process.returncode)
+    completed.usage = usage
+    return completed
+
+def copy_input(input, fasta_path):
+    '''
+    Copies the input fasta into the output directory, redoing the copy when the input changes
+    :param input: input fasta file
+    :param fasta_path: location of the copy
+    :return: None
+    '''
+    stage = dict(inputs=[input], outputs=[fasta_path])
+    if not stage_current("copy_input", **stage):
+        shutil.copyfile(input, f"{fasta_path}.tmp")
+        os.replace(f"{fasta_path}.tmp", fasta_path)
+        record_stage("copy_input", **stage)
+
+def run_jobs(jobs, threads, max_jobs=None, desc="Running jobs"):
+    '''
+    Runs jobs concurrently with per-job thread budgets that sum to at most threads
+    :param jobs: list of callables taking the number of threads they may use
+    :param threads: total thread budget
+    :param max_jobs: maximum number of jobs running at once, defaults to threads
+    :param desc: progress bar description
+    :return: list of job results, in the order of jobs
+    '''
+    if not jobs:
+        return []
+    concurrent = max(1, min(len(jobs), max_jobs or threads, threads))
+    threads_per_job = max(1, threads // concurrent)
+    logging.info(f"{desc}: {len(jobs)} jobs, {concurrent} at a time with {threads_per_job} threads each")
+
+    def run_job(job):
+        # Pool threads are reused, so every job starts a fresh usage list and returns it with its result
+        command_usage.records = []
+        return job(threads_per_job), command_usage.records
+
+    with ThreadPoolExecutor(max_workers=concurrent) as pool, tqdm(total=len(jobs), desc=desc, unit=" jobs") as pbar:
+        futures = [pool.submit(run_job, job) for job in jobs]
+        for future in futures:
+            future.add_done_callback(lambda _: pbar.update(1))
+        results = [future.result() for future in futures]
+
+    usage = thread_command_usage()
+    for _, job_usage in results:
+        usage.extend(job_usage)
+    return [result for result, _ in results]
+
+metrics_settings = {"metrics_file": None, "profile_dir": None, "log_file": None}
+metrics_lock = threading.Lock()
+# Traced peak of every running stage, tracemalloc keeps one process-wide peak that each stage resets
+traced_peaks = {}
+traced_lock = threading.Lock()
+
+def init_metrics(outdir, trace_memory=False, profile=False):
+    '''
+    Sends per-stage performance records of running_message to <outdir>/metrics.jsonl
+    :param outdir: output directory
+    :param trace_memory: record peak Python memory of each stage with tracemalloc (slows Python code down)
+    :param profile: dump a cProfile of each top-level stage to <outdir>/profiles
+    :return: None
+    '''
+    metrics_settings["metrics_file"] = f"{outdir}/metrics.jsonl"
+    if trace_memory:
+        tracemalloc.start()
+    if profile:
+        metrics_settings["profile_dir"] = f"{outdir}/profiles"
+        os.makedirs(metrics_settings["profile_dir"], exist_ok=True)
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError):
+        return None
+
+def measure_size(value):
+    '''
+    Returns (bytes, rows) of a stage argument or result: file sizes for existing paths, lengths for tables,
+    mappings and other sized objects, summed over lists of them
+    '''
+    if isinstance(value, (str, bytes)):
+        return (os.path.getsize(value), 0) if isinstance(value, str) and os.path.isfile(value) else (0, 0)
+    if isinstance(value, (list, tuple)):
+        sizes = [measure_size(item) for item in value]
+        return sum(size for size, _ in sizes), sum(rows for _, rows in sizes)
+    if hasattr(value, "__len__"):
+        return 0, len(value)
+    return 0, 0
+
+def file_snapshot(values):
+    '''
+    Stats the files a stage could write through its arguments: path arguments themselves, files sharing a
+    path as prefix (database -> database.dmnd) and the files directly inside directory arguments
+    :param values: stage arguments, lists and tuples are searched for paths too
+    :return: dictionary of file path -> (inode, size, mtime)
+    '''
+    # The log and the metrics of the run grow during every stage, they are no stage output
+    bookkeeping = {os.path.normpath(path) for path in (metrics_settings["metrics_file"], metrics_settings["log_file"]) if path}
+    snapshot = {}
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            snapshot.update(file_snapshot(value))
+            continue
+        if not isinstance(value, str) or not (os.sep in value or os.path.exists(value)):
+            continue
+        if os.path.isdir(value):
+            directory, prefix = value, None
+        else:
+            directory, prefix = os.path.dirname(value) or ".", os.path.basename(value)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    path = os.path.normpath(entry.path)
+                    if (prefix is None or entry.name == prefix or entry.name.startswith(f"{prefix}.")) and path not in bookkeeping and entry.is_file():
+                        stat = entry.stat()
+                        snapshot[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            continue
+    return snapshot
+
+def fold_traced_peak():
+    '''
+    Credits the tracemalloc peak since the last reset to every running stage, then resets it.
+    Must be called with traced_lock held
+    '''
+    peak = tracemalloc.get_traced_memory()[1]
+    for stage in traced_peaks:
+        traced_peaks[stage] = max(traced_peaks[stage], peak)
+    tracemalloc.reset_peak()
+
+def write_metrics(record):
+    with metrics_lock, open(metrics_settings["metrics_file"], "a") as metrics:
+        metrics.write(json.dumps(record, default=str) + "\n")
 
 def running_message(function):
     def wrapper(*args, **kwargs):
@@ -110,23 +314,84 @@ def running_message(function):
         
         logging.info(f"Time: {current_time} - Running {function.__name__} with inputs: {function.__name__}({signature})")
 
+        recording = metrics_settings["metrics_file"] is not None
+        if recording:
+            input_sizes = [measure_size(value) for value in list(args) + list(kwargs.values())]
+            files_before = file_snapshot(list(args) + list(kwargs.values()))
+            stage_usage = thread_command_usage()
+            first_command = len(stage_usage)
+            cpu_start = time.process_time()
+            children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+            wall_start = time.perf_counter()
+            rss_start = current_rss_mb()
+            stage_key = object()
+            if tracemalloc.is_tracing():
+                # Enclosing stages keep the peak reached so far, this stage starts from the current size
+                with traced_lock:
+                    fold_traced_peak()
+                    traced_peaks[stage_key] = tracemalloc.get_traced_memory()[0]
+
+        # Only one profiler can be active, so nested and threaded stages are covered by the outer one
+        profiler = None
+        if metrics_settings["profile_dir"] and threading.current_thread() is threading.main_thread() and sys.getprofile() is None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        status = "completed"
+        result = None
         try:
             result = function(*args, **kwargs)
             return result
         except Exception as e:
+            status = "failed"
             logging.exception(f"Exception occurred in function {function.__name__}: {e}")
             raise
         finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(f"{metrics_settings['profile_dir']}/{function.__name__}_{T1.strftime('%Y%m%d_%H%M%S_%f')}.prof")
+
             T2 = datetime.now()
             current_time2 = T2.strftime("%H:%M:%S")
             total_time = format_timedelta(T2 - T1)
             if 'verify_output' in kwargs:
-                if os.stat(kwargs['verify_output'])== 0:
+                if not os.path.exists(kwargs['verify_output']) or os.path.getsize(kwargs['verify_output']) == 0:
+                    status = "failed"
                     logging.error(f"Time: {current_time2} - {function.__name__} Failed")
                     logging.error(f"Total time taken: {total_time}")
             logging.info(f"Time: {current_time2} - {function.__name__} Completed")
             logging.info(f"Total time taken: {total_time}")
 
+            if recording:
+                children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+                python_peak = None
+                if stage_key in traced_peaks:
+                    with traced_lock:
+                        fold_traced_peak()
+                        python_peak = traced_peaks.pop(stage_key) / (1 << 20)
+                rss_end = current_rss_mb()
+                # Output bytes are the files created or replaced through the arguments, output rows the length of the result
+                files_after = file_snapshot(list(args) + list(kwargs.values()))
+                written = [stat[1] for path, stat in files_after.items() if files_before.get(path) != stat]
+                write_metrics({
+                    "stage": function.__name__,
+                    "status": status,
+                    "start": T1.isoformat(),
+                    "wall_seconds": time.perf_counter() - wall_start,
+                    "cpu_seconds": time.process_time() - cpu_start,
+                    "child_cpu_seconds": (children_end.ru_utime + children_end.ru_stime) - (children_start.ru_utime + children_start.ru_stime),
+                    "rss_mb": rss_end,
+                    "rss_delta_mb": rss_end - rss_start if rss_end is not None and rss_start is not None else None,
+                    # ru_maxrss is the peak of the whole process so far, not of this stage
+                    "process_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                    "python_peak_mb": python_peak,
+                    "input_bytes": sum(size for size, _ in input_sizes),
+                    "input_rows": sum(rows for _, rows in input_sizes),
+                    "output_bytes": sum(written),
+                    "output_rows": measure_size(result)[1],
+                    "commands": stage_usage[first_command:]
+                })
+
     return wrapper
 
 def read_fasta(fastafile):
@@ -150,6 +415,135 @@ def read_fasta(fastafile):
     
     return records
 
+def fasta_header_id(header):
+    '''
+    Returns the record id of a fasta header line, str or bytes: its first word, empty for a bare '>'
+    '''
+    fields = header[1:].split(None, 1)
+    return fields[0] if fields else header[:0]
+
+def iter_fasta_records(fastafile):
+    '''
+    Streams the records of a fasta as (record id, header line, sequence lines)
+    '''
+    header, lines = None, []
+    with open(fastafile) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                if header is not None:
+                    yield fasta_header_id(header), header, lines
+                header, lines = line, []
+            elif header is not None:
+                lines.append(line)
+    if header is not None:
+        yield fasta_header_id(header), header, lines
+
+def build_fasta_index(fastafile, index_path=None):
+    '''
+    Builds an offset index (id, byte offset, byte length) of a fasta file in one streaming pass
+    :param fastafile: fasta file to index
+    :param index_path: location of the index, defaults to <fastafile>.idx
+    :return: path to the index
+    '''
+    if index_path is None:
+        index_path = f"{fastafile}.idx"
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(fastafile):
+        return index_path
+
+    total_size = os.path.getsize(fastafile)
+    tmp_path = f"{index_path}.tmp"
+    with open(fastafile, "rb") as f, open(tmp_path, "w") as index, tqdm(total=total_size, desc="Indexing FASTA file", unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+        offset = 0
+        record_id = None
+        record_start = 0
+        for line in f:
+            if line.startswith(b">"):
+                if record_id is not None:
+                    index.write(f"{record_id}\t{record_start}\t{offset - record_start}\n")
+                record_id = fasta_header_id(line).decode()
+                record_start = offset
+            offset += len(line)
+            pbar.update(len(line))
+        if record_id is not None:
+            index.write(f"{record_id}\t{record_start}\t{offset - record_start}\n")
+    os.replace(tmp_path, index_path)
+    return index_path
+
+def iter_fasta_index(fastafile):
+    with open(build_fasta_index(fastafile)) as index:
+        for line in index:
+            record_id, offset, length = line.rstrip("\n").split("\t")
+            yield record_id, int(offset), int(length)
+
+def read_fasta_ids(fastafile):
+    '''
+    Reads the record ids of a fasta file from its offset index
+    :param fastafile: fasta file
+    :return: list of record ids
+    '''
+    return [record_id for record_id, _, _ in iter_fasta_index(fastafile)]
+
+def fetch_fasta_records(fastafile, ids):
+    '''
+    Fetches selected records from a fasta file by seeking to their indexed offsets
+    :param fastafile: fasta file
+    :param ids: record ids to fetch
+    :return: dictionary of record id -> SeqRecord
+    '''
+    wanted = set(ids)
+    locations = sorted((offset, length) for record_id, offset, length in iter_fasta_index(fastafile) if record_id in wanted)
+
+    records = {}
+    with open(fastafile, "rb") as f:
+        for offset, length in tqdm(locations, desc="Fetching FASTA records", unit=" Records"):
+            f.seek(offset)
+            record = SeqIO.read(io.StringIO(f.read(length).decode()), "fasta")
+            records[record.id] = record
+    return records
+
+def split_records(data):
+    '''
+    Splits a block of complete fasta records into one bytes object per record
+    '''
+    pieces = data.split(b"\n>")
+    last = len(pieces) - 1
+    for i, piece in enumerate(pieces):
+        if i > 0:
+            piece = b">" + piece
+        if i < last or not piece.endswith(b"\n"):
+            piece += b"\n"
+        yield piece
+
+def read_record_chunks(fastafile, chunk_size, progress_bar=None):
+    '''
+    Reads a fasta file in raw byte blocks and yields the complete records of each block
+    :param fastafile: fasta file
+    :param chunk_size: number of bytes read at a time
+    :param progress_bar: optional tqdm bar advanced by the bytes read
+    :return: generator of lists of raw fasta records
+    '''
+    with open(fastafile, "rb") as f:
+        remainder = b""
+        while True:
+            block = f.read(chunk_size)
+            data = remainder + block
+            if block:
+                # Only hand over records whose end has been read
+                cut = data.rfind(b"\n>")
+                if cut == -1:
+                    remainder = data
+                    if progress_bar is not None:
+                        progress_bar.update(len(block))
+                    continue
+                data, remainder = data[:cut + 1], data[cut + 1:]
+            if progress_bar is not None:
+                progress_bar.update(len(block))
+            records = [record for record in split_records(data) if record.startswith(b">")] if data.strip() else []
+            if records:
+                yield records
+            if not block:
+                break
+
 def write_fasta(outpath: str, recordlist: list)->None:
     '''
     Writes a fasta file to a given location
@@ -161,6 +555,19 @@ def write_fasta(outpath: str, recordlist: list)->None:
         SeqIO.write(recordlist, output_handle, "fasta")
 
 
+def write_tsv_chunks(df, outpath, chunksize=1000000):
+    '''
+    Writes a dataframe to a tsv file in chunks to bound the formatting memory
+    :param df: dataframe to write
+    :param outpath: location to write tsv
+    :param chunksize: number of rows formatted at a time
+    :return: None
+    '''
+    with open(outpath, "w") as output_handle:
+        if df.empty:
+            df.to_csv(output_handle, sep="\t", index=False)
+        for start in range(0, len(df), chunksize):
+            df.iloc[start:start + chunksize].to_csv(output_handle, sep="\t", index=False, header=start == 0)
     
 def read_lines(file_path):
     file_size = os.path.getsize(file_path)
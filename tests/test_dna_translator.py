@@ -0,0 +1,24 @@
+import pandas as pd
+from Bio.Seq import Seq
+from scripts.network.dna_translator import find_orfs, map_orf_hits
+
+CONTIG = "ATGAAACGTTTGCTGGATTAGCCATGGCTTCTAAAGGTGAAGAACTGTTCACCGGTGTTGTTCCGATCCTGGTTGAACTGGATTAA"
+
+
+def test_orf_hits_map_back_to_their_codons():
+    orfs = find_orfs(CONTIG, 5)
+    hits = pd.DataFrame({
+        "target": [f"contig1_frame{frame}_{start}_{end}" for frame, start, end, _ in orfs],
+        "tstart": 2,
+        "tend": [len(protein) - 1 for _, _, _, protein in orfs]
+    })
+    mapped = map_orf_hits(hits)
+
+    assert set(mapped["strand"]) == {"+", "-"}
+    for hit, (_, _, _, protein) in zip(mapped.itertuples(), orfs):
+        first, last = sorted((hit.contig_start, hit.contig_end))
+        segment = Seq(CONTIG[first - 1:last])
+        if hit.strand == "-":
+            segment = segment.reverse_complement()
+        assert hit.contig == "contig1"
+        assert str(segment.translate()) == protein[1:-1]
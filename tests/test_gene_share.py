@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import hypergeom
+from scripts.gene_share.gene_share import MAX_SCORE, calculate_adjacency_matrix, calculate_blocked_adjacency, hypergeom_scores, score_block, sparse_presence_absence
+
+
+def test_scores_match_hypergeom_tail():
+    shared, n, k = np.array([1, 2, 3]), np.array([5, 5, 4]), np.array([6, 3, 4])
+    expected = -hypergeom.logsf(shared - 1, 20, n, k) / np.log(10)
+    np.testing.assert_allclose(hypergeom_scores(shared, 20, n, k), expected)
+
+
+def test_multi_copy_pairs_are_clamped_into_the_support():
+    # Genome a carries three copies of cluster x: it holds more proteins than there are clusters,
+    # and its pairs share more clusters than the smaller genome holds
+    rep_df = pd.DataFrame({
+        "Node": ["a", "a", "a", "a", "b", "b", "c"],
+        "Rep": ["x", "x", "x", "y", "x", "y", "z"]
+    })
+    pamatrix, nodes = sparse_presence_absence(rep_df)
+    proteins_per_node = np.asarray(pamatrix.sum(axis=1)).ravel()
+    rows, cols, shared, scores = score_block(pamatrix, proteins_per_node, 0, len(nodes))
+
+    assert list(zip(nodes[rows], nodes[cols])) == [("a", "b")]
+    assert shared[0] == 4
+    assert np.isfinite(scores).all()
+    # Clamped to shared=2 of n=3 (all clusters) and k=2: the pair is certain, not maximally significant
+    np.testing.assert_allclose(scores, [0.0], atol=1e-12)
+
+
+def test_dense_matrix_has_no_invalid_maximal_scores():
+    presence_absence = pd.DataFrame([[3, 1, 0, 0], [1, 1, 0, 0], [0, 0, 1, 1]], index=["a", "b", "c"], columns=["w", "x", "y", "z"])
+    adjacency = calculate_adjacency_matrix(presence_absence)
+
+    assert np.isfinite(adjacency.values).all()
+    assert adjacency.loc["a", "c"] == 0.0
+    assert adjacency.loc["a", "b"] < MAX_SCORE
+
+
+def test_underflowing_tail_gets_the_maximum_score():
+    scores = hypergeom_scores([5000], 100000, [5000], [5000])
+    assert scores[0] == MAX_SCORE
+
+
+def test_blocked_adjacency_discards_shards_of_other_contents(tmp_path):
+    # Both tables give a 3 x 3 matrix with the same number of entries, only the shared clusters differ
+    first = pd.DataFrame({"Node": ["a", "a", "b", "c"], "Rep": ["x", "y", "x", "z"]})
+    second = pd.DataFrame({"Node": ["a", "a", "b", "c"], "Rep": ["x", "y", "z", "x"]})
+    for rep_df in (first, second):
+        pamatrix, nodes = sparse_presence_absence(rep_df)
+        edges = pd.read_csv(calculate_blocked_adjacency(pamatrix, nodes, tmp_path, 1, block_size=2), sep="\t")
+
+    assert list(zip(edges["source"], edges["target"])) == [("a", "c")]
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scripts.amg.amg import colocation_counts, write_neighborhoods
+from scripts.amg.interval_index import build_interval_index, colocated_counts, load_interval_index, neighborhood, proximity_counts
+
+
+@pytest.fixture
+def hits():
+    rng = np.random.default_rng(0)
+    n = 400
+    start = rng.integers(1, 50000, n)
+    length = rng.integers(100, 3000, n)
+    # About half the hits are on the minus strand, with tstart > tend
+    minus = rng.random(n) < 0.5
+    return pd.DataFrame({
+        "query": [f"pc{i}" for i in rng.integers(0, 30, n)],
+        "target": [f"contig{i}" for i in rng.integers(0, 5, n)],
+        "tstart": np.where(minus, start + length, start),
+        "tend": np.where(minus, start, start + length)
+    })
+
+
+@pytest.fixture
+def index(hits, tmp_path):
+    return load_interval_index(build_interval_index(hits, str(tmp_path / "index")))
+
+
+def intervals(hits):
+    return hits.assign(start=hits[["tstart", "tend"]].min(axis=1), end=hits[["tstart", "tend"]].max(axis=1))
+
+
+@pytest.mark.parametrize("distance", [0, 500, 5000])
+def test_neighborhood_matches_a_scan(hits, index, distance):
+    found = neighborhood(index, "contig2", 20000, 21000, distance)
+
+    expected = intervals(hits)
+    expected = expected[(expected["target"] == "contig2") & (expected["start"] <= 21000 + distance) & (expected["end"] >= 20000 - distance)]
+    assert sorted(zip(found["query"], found["start"], found["end"])) == sorted(zip(expected["query"], expected["start"], expected["end"]))
+
+
+@pytest.mark.parametrize("distance", [0, 500, 5000])
+def test_colocated_counts_match_a_scan(hits, index, distance):
+    pcs = {f"pc{i}" for i in range(10)}
+    partners = {f"pc{i}" for i in range(5, 20)}
+    counts = colocated_counts(index, pcs, partners, distance)
+
+    table = intervals(hits)
+    partner_hits = table[table["query"].isin(partners - pcs)]
+    expected = {}
+    for hit in table[table["query"].isin(pcs)].itertuples():
+        same_contig = partner_hits[partner_hits["target"] == hit.target]
+        near = ((same_contig["start"] <= hit.end + distance) & (same_contig["end"] >= hit.start - distance)).any()
+        expected[hit.query] = expected.get(hit.query, 0) + int(near)
+    assert counts.to_dict() == expected
+
+
+def test_proximity_counts_cover_every_hit(hits, index):
+    alone, total = proximity_counts(index, [0, 1000])
+
+    assert total.sum() == len(hits)
+    assert (alone[1000] <= alone[0]).all() and (alone[0] <= total).all()
+
+
+def test_colocation_counts_test_each_group_against_the_other(index):
+    with_go, without_go = {f"pc{i}" for i in range(10)}, {f"pc{i}" for i in range(10, 30)}
+    counts = colocation_counts(index, with_go, without_go, 500)
+
+    assert counts.to_dict() == {**colocated_counts(index, with_go, without_go, 500).to_dict(), **colocated_counts(index, without_go, with_go, 500).to_dict()}
+    assert set(counts.index) == with_go | without_go
+
+
+def test_neighborhoods_skip_contigs_without_hits(index, tmp_path):
+    outpath = tmp_path / "neighborhoods.tsv"
+    write_neighborhoods(index, ["contig1:100-5000", "missing:1-10"], [0, 1000], {"pc0"}, outpath)
+
+    neighborhoods = pd.read_csv(outpath, sep="\t")
+    assert set(neighborhoods["region"]) == {"contig1:100-5000"}
+    for distance in (0, 1000):
+        rows = neighborhoods[neighborhoods["distance"] == distance]
+        assert rows["query"].tolist() == neighborhood(index, "contig1", 100, 5000, distance)["query"].tolist()
+    assert (neighborhoods["go_metabolic"] == (neighborhoods["query"] == "pc0")).all()
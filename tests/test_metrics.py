@@ -0,0 +1,57 @@
+import json
+from scripts.cluster.assignments import ClusterAssignments
+from scripts.utils import metrics_settings, running_message
+
+
+@running_message
+def write_table(input, output):
+    with open(input) as source, open(output, "w") as out:
+        out.write(source.read() * 3)
+
+
+@running_message
+def make_database(input, database):
+    with open(f"{database}.dmnd", "w") as out:
+        out.write("x" * 100)
+
+
+@running_message
+def assign(genes):
+    return ClusterAssignments.from_arrays(genes, range(len(genes)))
+
+
+def read_metrics(tmp_path, monkeypatch, stage, *args):
+    monkeypatch.setitem(metrics_settings, "metrics_file", str(tmp_path / "metrics.jsonl"))
+    stage(*args)
+    with open(tmp_path / "metrics.jsonl") as metrics:
+        return [json.loads(line) for line in metrics][-1]
+
+
+def test_file_stage_records_written_bytes(tmp_path, monkeypatch):
+    (tmp_path / "input.tsv").write_text("a\tb\n")
+    record = read_metrics(tmp_path, monkeypatch, write_table, str(tmp_path / "input.tsv"), str(tmp_path / "output.tsv"))
+
+    assert record["input_bytes"] == 4
+    assert record["output_bytes"] == 12
+
+
+def test_prefix_outputs_are_measured(tmp_path, monkeypatch):
+    (tmp_path / "input.fasta").write_text(">a\nMK\n")
+    record = read_metrics(tmp_path, monkeypatch, make_database, str(tmp_path / "input.fasta"), str(tmp_path / "database"))
+
+    assert record["output_bytes"] == 100
+
+
+def test_unchanged_files_are_not_outputs(tmp_path, monkeypatch):
+    (tmp_path / "input.tsv").write_text("a\tb\n")
+    record = read_metrics(tmp_path, monkeypatch, write_table, str(tmp_path / "input.tsv"), str(tmp_path / "input.tsv.copy"))
+    record = read_metrics(tmp_path, monkeypatch, make_database, str(tmp_path / "input.tsv"), str(tmp_path / "other"))
+
+    assert record["output_bytes"] == 100
+
+
+def test_mapping_results_count_rows(tmp_path, monkeypatch):
+    record = read_metrics(tmp_path, monkeypatch, assign, ["a", "b", "c"])
+
+    assert record["input_rows"] == 0
+    assert record["output_rows"] == 3